@@ -0,0 +1,172 @@
+"""Startup benchmark for twod.
+
+Runs ``main()`` of the CLI in fresh interpreters with ``-X importtime`` and
+reports wall time, time spent importing and the heaviest imports for the
+quick commands (``--version``, ``--help`` and ``--check-config``) as JSON.
+
+Run from the repository root::
+
+    $ python -m benchmarks.startup --runs 20
+
+Note that import times include compiling modules if bytecode caching is
+disabled, e.g. with ``PYTHONDONTWRITEBYTECODE``.
+
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+from argparse import ArgumentParser
+from tempfile import mkdtemp
+from time import monotonic
+
+from benchmarks.ticks import percentile
+
+SCENARIOS = {
+    'version': ['-V'],
+    'help': ['-h'],
+    'check-config': ['-C', '-c', '{config}'],
+}
+
+CONFIG = """
+[general]
+user     = bench@example.com
+token    = token
+host_url = https://api.twodns.de/hosts/bench.dd-dns.de
+
+[ip_service]
+ip_urls  = https://icanhazip.com https://ipinfo.io/ip
+"""
+
+
+def parse_importtime(text):
+    """Parse ``-X importtime`` output.
+
+    Returns list of ``(name, depth, self_us, cumulative_us, children)``
+    for the imports at the top level, in import order. ``children`` lists
+    the direct children in the same format.
+
+    """
+    pending = []
+    for line in text.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if not fields[0].strip().isdigit():
+            # Header line
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        children = []
+        # Children are printed before their parent
+        while pending and pending[-1][1] > depth:
+            children.insert(0, pending.pop())
+        pending.append((name.strip(), depth, int(fields[0]), int(fields[1]),
+                        [c for c in children if c[1] == depth + 1]))
+    return pending
+
+
+def measure(argv, env):
+    """Run CLI with ``argv`` once.
+
+    Returns wall time in seconds and the parsed import times.
+
+    """
+    code = ("import sys\n"
+            "sys.argv = ['twod'] + %r\n"
+            "from twod.twod import main\n"
+            "main()\n" % (argv,))
+    start = monotonic()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          env=env, universal_newlines=True)
+    wall = monotonic() - start
+    if proc.returncode:
+        raise RuntimeError("twod %s failed: %s" %
+                           (' '.join(argv), proc.stderr.strip()))
+    return wall, parse_importtime(proc.stderr)
+
+
+def summarize(runs, top):
+    """Summarize ``runs`` of one scenario."""
+    walls = [wall for wall, imports in runs]
+    # Everything after ``site`` is imported on behalf of twod
+    totals = []
+    for wall, imports in runs:
+        names = [i[0] for i in imports]
+        start = names.index('site') + 1 if 'site' in names else 0
+        totals.append(sum(i[3] for i in imports[start:]))
+    heaviest = {}
+    for wall, imports in runs:
+        for name, depth, own, cumulative, children in imports:
+            if name != 'twod.twod':
+                continue
+            for child in children:
+                heaviest.setdefault(child[0], []).append(child[3])
+    heaviest = sorted(((percentile(v, 0.5), k) for k, v in heaviest.items()),
+                      reverse=True)[:top]
+    return {
+        'wall_ms': {
+            'p50': percentile(walls, 0.5) * 1000,
+            'min': min(walls) * 1000,
+            'max': max(walls) * 1000,
+        },
+        'import_ms': {
+            'p50': percentile(totals, 0.5) / 1000.0,
+            'min': min(totals) / 1000.0,
+        },
+        'heaviest_imports_ms': [(name, us / 1000.0) for us, name in heaviest],
+    }
+
+
+def run(args):
+    """Run benchmark described by parsed ``args``.
+
+    Returns results as dict.
+
+    """
+    directory = mkdtemp(prefix='twod-bench-')
+    config = os.path.join(directory, 'twodrc')
+    with open(config, 'w') as f:
+        f.write(CONFIG)
+    env = dict(os.environ)
+    # Make the repository importable regardless of the working directory
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [p for p in [env.get('PYTHONPATH')] if p])
+    results = {'params': vars(args), 'scenarios': {}}
+    for scenario in args.scenario or sorted(SCENARIOS):
+        argv = [a.format(config=config) for a in SCENARIOS[scenario]]
+        runs = [measure(argv, env) for _ in range(args.runs)]
+        results['scenarios'][scenario] = summarize(runs, args.top)
+    return results
+
+
+def parser():
+    parser = ArgumentParser(description="twod startup benchmark")
+    parser.add_argument('--runs', type=int, default=10,
+                        help="interpreters to start per scenario")
+    parser.add_argument('--scenario', action='append',
+                        choices=sorted(SCENARIOS),
+                        help="scenario to run, may be repeated (default all)")
+    parser.add_argument('--top', type=int, default=5,
+                        help="number of heaviest imports to report")
+    parser.add_argument('--output', metavar='FILE',
+                        help="write results to FILE instead of stdout")
+    return parser
+
+
+def main(argv=None):
+    results = run(parser().parse_args(argv))
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if results['params']['output']:
+        with open(results['params']['output'], 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
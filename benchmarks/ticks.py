@@ -0,0 +1,201 @@
+"""Tick latency benchmark for twod.
+
+Starts a local stand-in for the TwoDNS API and the IP services, drives
+``_Data`` through a number of ticks and reports tick latency percentiles,
+requests and connections per tick and memory usage as JSON.
+
+Run from the repository root::
+
+    $ python -m benchmarks.ticks --ticks 100 --hosts 20 --latency 0.005
+
+"""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+from argparse import ArgumentParser
+from tempfile import mkdtemp
+from time import monotonic
+
+from tests.servers import StandIn
+from twod.twod import Twod, _Data
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of ``values``."""
+    ordered = sorted(values)
+    return ordered[max(0, int(round(fraction * len(ordered))) - 1)]
+
+
+def rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def make_cert(directory):
+    """Create self-signed certificate for 127.0.0.1 and trust it."""
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-days', '1', '-subj', '/CN=127.0.0.1',
+         '-addext', 'subjectAltName=IP:127.0.0.1',
+         '-keyout', key, '-out', cert],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Picked up by requests and by ssl.create_default_context
+    os.environ['REQUESTS_CA_BUNDLE'] = os.environ['SSL_CERT_FILE'] = cert
+    return cert, key
+
+
+def write_config(directory, url, args):
+    hosts = ''.join("""
+[host:h%d]
+host_url = %s/hosts/h%d
+""" % (i, url, i) for i in range(args.hosts))
+    ip_urls = ' '.join('%s/ip%d' % (url, i) for i in range(args.services))
+    path = os.path.join(directory, 'twodrc')
+    with open(path, 'w') as f:
+        f.write("""
+[general]
+user     = bench@example.com
+token    = token
+timeout  = %s
+engine   = %s
+pool_size = %d
+%s
+[ip_service]
+mode     = %s
+ip_urls  = %s
+
+[logging]
+level    = CRITICAL
+""" % (args.timeout, args.engine, args.pool_size, hosts, args.mode, ip_urls))
+    return path
+
+
+def run(args):
+    """Run benchmark described by parsed ``args``.
+
+    Returns results as dict.
+
+    """
+    directory = mkdtemp(prefix='twod-bench-')
+    certfile = keyfile = None
+    if args.tls:
+        certfile, keyfile = make_cert(directory)
+    standin = StandIn(
+        ext_ip='192.0.2.1',
+        records=dict(('h%d' % i, '192.0.2.1') for i in range(args.hosts)),
+        latency=args.latency, error_rate=args.error_rate,
+        body_size=args.body_size, certfile=certfile, keyfile=keyfile)
+    with standin:
+        conf = Twod(write_config(directory, standin.url, args)).conf
+        rss_before = rss()
+        start = monotonic()
+        if args.engine == 'asyncio':
+            durations, data = asyncio.run(_drive_async(conf, standin, args))
+        else:
+            durations, data = _drive(conf, standin, args)
+        total = monotonic() - start
+        requests = len(standin.requests)
+        connections = standin.connections
+    return {
+        'params': vars(args),
+        'ticks': len(durations),
+        'total_seconds': total,
+        'tick_seconds': {
+            'p50': percentile(durations, 0.5),
+            'p99': percentile(durations, 0.99),
+            'max': max(durations),
+            'mean': sum(durations) / len(durations),
+        },
+        'requests_per_tick': float(requests) / len(durations),
+        'connections_opened': connections,
+        'rss_bytes': rss(),
+        'rss_growth_bytes': rss() - rss_before,
+    }
+
+
+def _prepare_tick(data, standin, args, tick):
+    if args.change_every and tick and not tick % args.change_every:
+        standin.ext_ip = '192.0.2.%d' % (tick // args.change_every % 250 + 1)
+    for host in data.hosts:
+        host.next_check = 0
+
+
+def _drive(conf, standin, args):
+    data = _Data(conf)
+    durations = []
+    for tick in range(args.ticks):
+        _prepare_tick(data, standin, args, tick)
+        start = monotonic()
+        data.tick()
+        durations.append(monotonic() - start)
+    data.close()
+    return durations, data
+
+
+async def _drive_async(conf, standin, args):
+    from twod._aio import _AsyncData
+    data = _AsyncData(conf)
+    await data.start()
+    durations = []
+    for tick in range(args.ticks):
+        _prepare_tick(data, standin, args, tick)
+        start = monotonic()
+        await data.tick()
+        durations.append(monotonic() - start)
+    data.close()
+    return durations, data
+
+
+def parser():
+    parser = ArgumentParser(description="twod tick latency benchmark")
+    parser.add_argument('--ticks', type=int, default=50)
+    parser.add_argument('--hosts', type=int, default=1)
+    parser.add_argument('--services', type=int, default=2,
+                        help="number of IP service URLs")
+    parser.add_argument('--engine', choices=('sync', 'asyncio'),
+                        default='sync')
+    parser.add_argument('--mode', default='round_robin',
+                        help="ip_service mode")
+    parser.add_argument('--pool-size', type=int, default=2)
+    parser.add_argument('--timeout', type=float, default=5)
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds added to every response")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="share of requests answered with 503")
+    parser.add_argument('--body-size', type=int, default=0,
+                        help="minimum TwoDNS response body size in bytes")
+    parser.add_argument('--change-every', type=int, default=0,
+                        help="change the external IP every N ticks")
+    parser.add_argument('--tls', action='store_true',
+                        help="serve HTTPS with a self-signed certificate")
+    parser.add_argument('--output', metavar='FILE',
+                        help="write results to FILE instead of stdout")
+    return parser
+
+
+def main(argv=None):
+    results = run(parser().parse_args(argv))
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if results['params']['output']:
+        with open(results['params']['output'], 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
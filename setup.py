@@ -1,13 +1,10 @@
-#!/usr/bin/python2
+#!/usr/bin/env python3
 
 """Setup script for twod."""
 
 from setuptools import setup, find_packages
 import codecs
 import os
-import sys
-
-import setuptools
 
 here = os.path.abspath(os.path.dirname(__file__))
 
@@ -24,26 +21,13 @@ def get_version(fname='twod/_version.py'):
                 return (line.split('=')[-1].strip().strip('"'))
 
 INSTALL_REQUIRES = [
-    'requests>=2.8.1',
+    # twod._transport extends urllib3, which requests vendored before 2.16
+    'requests>=2.25',
+    'urllib3>=1.26,<3',
     'lockfile>=0.9.1',
+    'python-daemon>2.1.1',
 ]
 
-EXTRAS_REQUIRE = {}
-
-# Different versions of dependencies depending on python version
-if sys.version_info[0:2] < (3, 0):
-    INSTALL_REQUIRES.append("python-daemon<2.0")
-else:
-    INSTALL_REQUIRES.append("python-daemon>2.1.1")
-
-# Additional requirements for python 2
-if int(setuptools.__version__.split(".", 1)[0]) < 18:
-    assert "bdist_wheel" not in sys.argv, "setuptools 18 required for wheels."
-    if sys.version_info[0:2] < (3, 0):
-        INSTALL_REQUIRES.append("configparser>=3.5.0")
-else:
-    EXTRAS_REQUIRE[":python_version<'3.0'"] = ["configparser>=3.5.0"]
-
 setup(
     name="twod",
 
@@ -67,17 +51,17 @@ setup(
 
         'License :: OSI Approved :: GPLv3 License',
 
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
     ],
 
     keywords='daemon dns',
 
-    packages=find_packages(exclude=["docs", "tests*"]),
+    packages=find_packages(exclude=["docs", "tests*", "benchmarks*"]),
+
+    python_requires='>=3.7',
 
     install_requires=INSTALL_REQUIRES,
-    extras_require=EXTRAS_REQUIRE,
 
     package_data={},
 
@@ -2,6 +2,8 @@
 
 import pytest
 
+from tests.servers import StandIn
+
 
 # Config fixtures
 @pytest.fixture
@@ -161,6 +163,75 @@ level    = WARNING
     return tmpdir
 
 
+@pytest.fixture
+def multi_host_config(tmpdir):
+    """Valid configuration with several hosts."""
+    f = tmpdir.join("twodrc")
+    f.write("""
+[general]
+user     = username@example.com
+token = token
+interval = 9000
+timeout = 9000
+
+[host:one]
+host_url = https://api.twodns.de/hosts/one.dd-dns.de
+
+[host:two]
+user     = other@example.com
+token    = other-token
+host_url = https://api.twodns.de/hosts/two.dd-dns.de
+interval = 600
+
+[ip_service]
+ip_urls  = https://icanhazip.com https://ipinfo.io/ip
+""")
+    return tmpdir
+
+
+@pytest.fixture
+def dual_stack_config(tmpdir):
+    """Valid configuration tracking IPv4 and IPv6."""
+    f = tmpdir.join("twodrc")
+    f.write("""
+[general]
+user     = username@example.com
+token = token
+host_url = https://api.twodns.de/hosts/example.dd-dns.de
+interval = 9000
+timeout = 9000
+
+[ip_service]
+ip_urls  = https://icanhazip.com https://ipinfo.io/ip
+families = 4 6
+""")
+    return tmpdir
+
+
+@pytest.fixture
+def inventory_config(tmpdir):
+    """Valid configuration reading hosts from an inventory."""
+    f = tmpdir.join("twodrc")
+    f.write("""
+[general]
+user      = username@example.com
+token     = token
+inventory = {inventory}
+interval  = 9000
+
+[ip_service]
+ip_urls  = https://icanhazip.com https://ipinfo.io/ip
+""".format(inventory=tmpdir.join("hosts.jsonl")))
+    tmpdir.join("hosts.jsonl").write("""
+{"host_url": "https://api.twodns.de/hosts/one.dd-dns.de"}
+# Comments and blank lines are skipped
+
+{"name": "two", "host_url": "https://api.twodns.de/hosts/2.dd-dns.de", \
+"user": "other@example.com", "token": "other-token", "interval": 600}
+""")
+    return tmpdir
+
+
 @pytest.fixture
 def valid_config_path(valid_config):
     """Path to valid config."""
@@ -177,6 +248,30 @@ def valid_config_mode_rr_path(valid_config_mode_rr):
     return pathstring
 
 
+@pytest.fixture
+def dual_stack_config_path(dual_stack_config):
+    """Path to config tracking IPv4 and IPv6."""
+    pathstring = ('{dir}/{base}/twodrc'.format(
+        dir=dual_stack_config.dirname, base=dual_stack_config.basename))
+    return pathstring
+
+
+@pytest.fixture
+def inventory_config_path(inventory_config):
+    """Path to config reading hosts from an inventory."""
+    pathstring = ('{dir}/{base}/twodrc'.format(
+        dir=inventory_config.dirname, base=inventory_config.basename))
+    return pathstring
+
+
+@pytest.fixture
+def multi_host_config_path(multi_host_config):
+    """Path to config with several hosts."""
+    pathstring = ('{dir}/{base}/twodrc'.format(
+        dir=multi_host_config.dirname, base=multi_host_config.basename))
+    return pathstring
+
+
 @pytest.fixture
 def invalid_host_config_path(invalid_host_config):
     """Path to valid config with invalid host entry."""
@@ -219,6 +314,53 @@ def missing_section_config_path(missing_section_config):
     return pathstring
 
 
+@pytest.fixture
+def standin():
+    """Running stand-in for TwoDNS and an IP service."""
+    server = StandIn(records={'one': '127.0.0.2', 'two': '127.0.0.2'})
+    with server:
+        yield server
+
+
+@pytest.fixture
+def standin_config(tmpdir, standin):
+    """Factory for configs with two hosts served by the stand-in.
+
+    Takes extra lines for the ``general`` and ``ip_service`` sections and
+    the paths of the IP services.
+
+    """
+    def make(general='', ip_service='', ip_paths=('/ip',)):
+        f = tmpdir.join("twodrc")
+        f.write("""
+[general]
+user     = username@example.com
+token    = token
+timeout  = 1
+{general}
+
+[host:one]
+host_url = {url}/hosts/one
+
+[host:two]
+user     = other@example.com
+host_url = {url}/hosts/two
+
+[ip_service]
+ip_urls  = {ip_urls}
+{ip_service}
+""".format(url=standin.url, general=general, ip_service=ip_service,
+           ip_urls=' '.join(standin.url + p for p in ip_paths)))
+        return str(f)
+    return make
+
+
+@pytest.fixture
+def standin_config_path(standin_config):
+    """Path to config with two hosts served by the stand-in."""
+    return standin_config()
+
+
 # Data fixtures
 @pytest.fixture
 def twodns_response():
@@ -0,0 +1,17 @@
+"""Mocked HTTP responses."""
+
+import mock
+
+
+def response(text):
+    """Mocked ``requests`` response with body ``text``.
+
+    The body can be read as ``text`` or streamed with ``iter_content``.
+
+    """
+    content = text.encode('utf-8')
+
+    def iter_content(chunk_size=1):
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+    return mock.Mock(text=text, content=content, iter_content=iter_content)
@@ -0,0 +1,215 @@
+"""Local stand-ins for the TwoDNS API and IP services."""
+
+import ssl
+import threading
+
+from base64 import b64decode
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps, loads
+from random import random
+from time import sleep, time
+
+
+class _Server(ThreadingHTTPServer):
+    """Threading HTTP server counting accepted connections."""
+
+    daemon_threads = True
+    context = None
+    connections = 0
+
+    def get_request(self):
+        sock, address = super(_Server, self).get_request()
+        self.connections += 1
+        if self.context:
+            sock = self.context.wrap_socket(sock, server_side=True,
+                                            do_handshake_on_connect=False)
+        return sock, address
+
+
+class StandIn(object):
+    """Threaded HTTP server answering like TwoDNS and an IP service.
+
+    * ``GET /ip*`` returns ``ext_ip`` as plain text.
+    * ``GET /hosts/NAME`` returns the record of ``NAME`` as JSON.
+    * ``PUT /hosts/NAME`` updates the record of ``NAME``.
+
+    ``delays`` maps paths to seconds to wait before answering, ``statuses``
+    maps paths to HTTP status codes to answer with instead. ``latency`` is
+    added to every request, ``error_rate`` is the share of requests answered
+    with 503 and ``body_size`` pads TwoDNS responses to at least that many
+    bytes. IP service answers are sent one byte every ``trickle`` seconds,
+    their headers one byte every ``trickle_headers`` seconds.
+    With ``certfile`` and ``keyfile`` the server speaks HTTPS. With
+    ``validators`` records carry ``ETag`` and ``Last-Modified`` headers and
+    conditional requests for unchanged records are answered with 304.
+    429 answers carry ``Retry-After: retry_after`` if set.
+
+    Every request is appended to ``requests`` as ``(method, path, user)``,
+    every answer to ``statuses_sent``.
+    ``connections`` counts accepted connections.
+
+    """
+
+    def __init__(self, ext_ip='127.0.0.3', records=None, delays=None,
+                 statuses=None, latency=0, error_rate=0, body_size=0,
+                 certfile=None, keyfile=None, validators=False,
+                 retry_after=None, trickle=0, trickle_headers=0):
+        self.ext_ip = ext_ip
+        self.records = dict(records or {})
+        self.delays = dict(delays or {})
+        self.statuses = dict(statuses or {})
+        self.latency = latency
+        self.error_rate = error_rate
+        self.body_size = body_size
+        self.validators = validators
+        self.retry_after = retry_after
+        self.trickle = trickle
+        self.trickle_headers = trickle_headers
+        # Record name -> time of last change
+        self.modified = dict.fromkeys(self.records, time())
+        self.requests = []
+        self.statuses_sent = []
+        self.server = _Server(('127.0.0.1', 0), self._handler())
+        scheme = 'http'
+        if certfile:
+            self.server.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.server.context.load_cert_chain(certfile, keyfile)
+            scheme = 'https'
+        self.url = '%s://127.0.0.1:%d' % (scheme, self.server.server_port)
+        self.thread = None
+
+    @property
+    def connections(self):
+        return self.server.connections
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Send headers and body in one segment, clients would otherwise
+            # wait for delayed ACKs
+            wbufsize = 65536
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _user(self):
+                auth = self.headers.get('Authorization', '')
+                if not auth.startswith('Basic '):
+                    return None
+                return b64decode(auth[6:]).decode('utf-8').split(':')[0]
+
+            def _reply(self, status, body=b'', content_type='text/plain',
+                       headers=()):
+                standin.statuses_sent.append(status)
+                ip_service = self.path.startswith('/ip')
+                # Trailing whitespace is ignored by JSON parsers
+                if status != 304 and not ip_service:
+                    body += b' ' * (standin.body_size - len(body))
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for header in headers:
+                    self.send_header(*header)
+                if ip_service and standin.trickle_headers:
+                    self._headers_buffer.append(b'\r\n')
+                    head = b''.join(self._headers_buffer)
+                    self._headers_buffer = []
+                    if not self._trickle(head, standin.trickle_headers):
+                        return
+                else:
+                    self.end_headers()
+                if not (ip_service and standin.trickle):
+                    self.wfile.write(body)
+                    return
+                self._trickle(body, standin.trickle)
+
+            def _trickle(self, data, delay):
+                """Send ``data`` one byte every ``delay`` seconds.
+
+                Returns False if the client gave up.
+
+                """
+                try:
+                    for i in range(len(data)):
+                        self.wfile.write(data[i:i + 1])
+                        self.wfile.flush()
+                        sleep(delay)
+                except OSError:
+                    return False
+                return True
+
+            def _handle(self, method):
+                standin.requests.append((method, self.path, self._user()))
+                sleep(standin.latency + standin.delays.get(self.path, 0))
+                body = b''
+                if 'Content-Length' in self.headers:
+                    body = self.rfile.read(int(self.headers['Content-Length']))
+                if self.path in standin.statuses:
+                    status = standin.statuses[self.path]
+                    headers = ()
+                    if status == 429 and standin.retry_after:
+                        headers = (('Retry-After', standin.retry_after),)
+                    return self._reply(status, headers=headers)
+                if standin.error_rate and random() < standin.error_rate:
+                    return self._reply(503)
+                if self.path.startswith('/ip') and method == 'GET':
+                    return self._reply(200, standin.ext_ip.encode('ascii'))
+                name = self.path.rpartition('/')[2]
+                if (not self.path.startswith('/hosts/') or
+                        name not in standin.records):
+                    return self._reply(404)
+                if method == 'PUT':
+                    standin.records[name] = loads(body)['ip_address']
+                    standin.modified[name] = time()
+                record = {'fqdn': name, 'ip_address': standin.records[name]}
+                body = dumps(record).encode('utf-8')
+                if not standin.validators:
+                    return self._reply(200, body, 'application/json')
+                modified = standin.modified.get(name, 0)
+                headers = (
+                    ('ETag', '"%s"' % sha1(body).hexdigest()),
+                    ('Last-Modified', formatdate(modified, usegmt=True)),
+                )
+                if method == 'GET' and self._not_modified(headers[0][1],
+                                                          modified):
+                    return self._reply(304, headers=headers)
+                self._reply(200, body, 'application/json', headers)
+
+            def _not_modified(self, etag, modified):
+                if 'If-None-Match' in self.headers:
+                    return self.headers['If-None-Match'] == etag
+                if 'If-Modified-Since' in self.headers:
+                    since = parsedate_to_datetime(
+                        self.headers['If-Modified-Since'])
+                    return int(modified) <= since.timestamp()
+                return False
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_PUT(self):
+                self._handle('PUT')
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
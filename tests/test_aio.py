@@ -0,0 +1,150 @@
+"""Tests for twod's asyncio engine."""
+
+import asyncio
+
+from time import time
+
+from twod.twod import Twod, _Data
+from twod._aio import _AsyncData
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class TestAsyncEngine:
+    """Test asyncio engine against local stand-ins."""
+
+    def test_start(self, caplog, standin, standin_config_path):
+        """Test concurrent retrieval of recorded IPs."""
+        data = _AsyncData(Twod(standin_config_path).conf)
+        assert data.rec_ip is None
+        run(data.start())
+        assert [str(h.rec_ip) for h in data.hosts] == ['127.0.0.2'] * 2
+        assert ('GET', '/hosts/two', 'other@example.com') in standin.requests
+
+    def test_tick_same_as_sync(self, caplog, standin, standin_config_path):
+        """Test that both engines issue the same requests."""
+        conf = Twod(standin_config_path).conf
+
+        async def tick():
+            data = _AsyncData(conf)
+            await data.start()
+            await data.tick()
+            data.close()
+            return data
+
+        data = run(tick())
+        async_requests = sorted(standin.requests)
+        assert [str(h.rec_ip) for h in data.hosts] == ['127.0.0.3'] * 2
+
+        standin.records.update(one='127.0.0.2', two='127.0.0.2')
+        del standin.requests[:]
+        data = _Data(conf)
+        data.tick()
+        data.close()
+        assert sorted(standin.requests) == async_requests
+        assert [str(h.rec_ip) for h in data.hosts] == ['127.0.0.3'] * 2
+
+    def test_slow_host(self, caplog, standin, standin_config_path):
+        """Test that a slow host does not stall the others."""
+        standin.delays['/hosts/one'] = 3
+        data = _AsyncData(Twod(standin_config_path).conf)
+        data.hosts[0].rec_ip = data.hosts[1].rec_ip = '127.0.0.2'
+
+        start = time()
+        run(data.tick())
+        assert time() - start < 2
+        assert str(data.hosts[0].rec_ip) == '127.0.0.2'
+        assert str(data.hosts[1].rec_ip) == '127.0.0.3'
+        assert standin.records['two'] == '127.0.0.3'
+        assert "one: Failed to update IP: Server did not respond" in (
+            caplog.text)
+
+    def test_race(self, caplog, standin, standin_config):
+        """Test that slower IP services are cancelled in race mode."""
+        standin.delays['/ip-slow'] = 3
+        data = _AsyncData(Twod(standin_config(
+            ip_service='mode = race\nhedge_delay = 0',
+            ip_paths=('/ip-slow', '/ip'))).conf)
+
+        start = time()
+        assert str(run(data._get_ext_ip())) == '127.0.0.3'
+        assert time() - start < 1
+
+    def test_http_error(self, caplog, standin, standin_config_path):
+        """Test that HTTP errors are reported like the default engine."""
+        standin.statuses['/ip'] = 503
+        data = _AsyncData(Twod(standin_config_path).conf)
+        assert run(data._get_ext_ip()) is False
+        assert "Error while fetching external IP: 503 Server Error" in (
+            caplog.text)
+
+    def test_refresh_conditional(self, caplog, standin, standin_config):
+        """Test that unchanged records are answered with 304."""
+        standin.validators = True
+        standin.ext_ip = '127.0.0.2'
+        data = _AsyncData(Twod(standin_config(
+            general='refresh_interval = 1')).conf)
+
+        async def ticks():
+            await data.start()
+            for host in data.hosts:
+                host.rec_clock -= 1
+            await data.tick()
+            data.close()
+
+        run(ticks())
+        assert sorted(standin.statuses_sent) == [200, 200, 200, 304, 304]
+        assert [str(h.rec_ip) for h in data.hosts] == ['127.0.0.2'] * 2
+
+    def test_spread(self, caplog, standin, standin_config):
+        """Test that spread hosts share one discovery."""
+        data = _AsyncData(Twod(standin_config(general='spread = yes')).conf)
+
+        async def ticks():
+            await data.start()
+            assert standin.requests == []
+            for host in data.hosts:
+                host.next_check = 0
+                await data.tick()
+            data.close()
+
+        run(ticks())
+        assert sorted(r[1] for r in standin.requests if r[0] == 'GET') == [
+            '/hosts/one', '/hosts/two', '/ip']
+        assert [str(h.rec_ip) for h in data.hosts] == ['127.0.0.3'] * 2
+
+    def test_too_many_requests(self, caplog, standin, standin_config_path):
+        """Test that 429 answers pause the account of the host."""
+        standin.statuses['/hosts/one'] = 429
+        standin.retry_after = '60'
+        data = _AsyncData(Twod(standin_config_path).conf)
+
+        async def ticks():
+            await data.start()
+            await data.tick()
+            data.close()
+
+        run(ticks())
+        assert "one: Rate limited while fetching IP from TwoDNS" in caplog.text
+        assert 59 < data.limiter.delay(data.hosts[0].limits) <= 60
+        assert data.limiter.delay(data.hosts[1].limits) == 0
+
+    def test_bounded(self, caplog, standin, standin_config_path):
+        """Test that oversized and trickling answers are aborted."""
+        data = _AsyncData(Twod(standin_config_path).conf)
+
+        async def fetch():
+            ips = [await data._get_ext_ip()]
+            standin.ext_ip = '127.0.0.3'
+            standin.trickle = 0.3
+            ips.append(await data._get_ext_ip())
+            data.close()
+            return ips
+
+        standin.ext_ip = '127.0.0.3' + ' ' * 100
+        start = time()
+        assert run(fetch()) == [False, False]
+        assert time() - start < 1.5
+        assert "Response larger than 64 bytes" in caplog.text
@@ -0,0 +1,48 @@
+"""Smoke tests for twod's benchmarks."""
+
+from benchmarks import startup, ticks
+
+
+class TestBench:
+    """Test benchmark driver."""
+
+    def test_ticks(self):
+        """Test that the tick benchmark reports its results."""
+        results = ticks.run(ticks.parser().parse_args(
+            ['--ticks', '4', '--hosts', '2', '--change-every', '2']))
+        assert results['ticks'] == 4
+        # 2 initial GETs, 4 discoveries and 2 PUTs
+        assert results['requests_per_tick'] == 2.0
+        # Kept alive across ticks, one per concurrently checked host
+        assert results['connections_opened'] == 2
+        assert 0 < results['tick_seconds']['p50'] <= (
+            results['tick_seconds']['p99'])
+
+    def test_ticks_async(self):
+        """Test the tick benchmark with the asyncio engine."""
+        results = ticks.run(ticks.parser().parse_args(
+            ['--ticks', '2', '--engine', 'asyncio']))
+        assert results['ticks'] == 2
+        assert results['rss_bytes'] > 0
+
+    def test_startup(self):
+        """Test that the startup benchmark reports its results."""
+        results = startup.run(startup.parser().parse_args(
+            ['--runs', '1', '--scenario', 'check-config']))
+        scenario = results['scenarios']['check-config']
+        assert scenario['wall_ms']['p50'] > 0
+        assert 0 < scenario['import_ms']['p50'] < scenario['wall_ms']['p50']
+        names = [name for name, ms in scenario['heaviest_imports_ms']]
+        assert 'requests' not in names
+
+    def test_parse_importtime(self):
+        """Test parsing of ``-X importtime`` output."""
+        imports = startup.parse_importtime(
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:        50 |         50 |     _json\n"
+            "import time:       100 |        150 |   json.decoder\n"
+            "import time:        20 |         70 |   json.scanner\n"
+            "import time:        30 |        200 | json\n")
+        assert [(i[0], i[3]) for i in imports] == [('json', 200)]
+        assert [c[0] for c in imports[0][4]] == ['json.decoder',
+                                                 'json.scanner']
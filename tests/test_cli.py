@@ -1,5 +1,8 @@
 """Tests for the CLI of twod."""
 
+import subprocess
+import sys
+
 import pytest
 import mock
 
@@ -64,3 +67,71 @@ class TestCLI:
             main()
         out, err = capsys.readouterr()
         assert "twod {}".format(__version__) in out + err
+
+    def test_check_config(self, capsys, monkeypatch, tmpdir,
+                          valid_config_path):
+        """Test --check-config argument."""
+        monkeypatch.setattr('sys.argv', ['twod.py', '-C', '-c',
+                            valid_config_path])
+        main()
+        out, err = capsys.readouterr()
+        assert "Configuration OK" in out
+
+        config = tmpdir.join('twodrc')
+        config.write(config.read().replace('random', 'invalid_mode'))
+        with pytest.raises(SystemExit):
+            main()
+        out, err = capsys.readouterr()
+        assert "Invalid mode" in err
+
+    def test_check_config_imports(self, valid_config_path):
+        """Test that --check-config does not import the network stack."""
+        code = ("import sys\n"
+                "from twod.twod import main\n"
+                "sys.argv = ['twod', '-C', '-c', %r]\n"
+                "main()\n"
+                "print(sorted(m for m in ('daemon', 'lockfile', 'requests', "
+                "'urllib3', 'concurrent.futures') if m in sys.modules))\n" %
+                valid_config_path)
+        out = subprocess.check_output([sys.executable, '-c', code])
+        assert out.decode().splitlines() == ["Configuration OK", "[]"]
+
+    def test_once(self, capsys, caplog, monkeypatch, tmpdir, standin,
+                  standin_config):
+        """Test --once argument and its exit status."""
+        config = standin_config(general='state_file = %s' %
+                                tmpdir.join('state'))
+        monkeypatch.setattr('sys.argv', ['twod.py', '--once', '-c', config])
+        with pytest.raises(SystemExit) as e:
+            main()
+        assert e.value.code == 3
+        assert standin.records == {'one': '127.0.0.3', 'two': '127.0.0.3'}
+
+        # Saved records are trusted, only the IP service is asked
+        del standin.requests[:]
+        with pytest.raises(SystemExit) as e:
+            main()
+        assert e.value.code == 0
+        assert [r[:2] for r in standin.requests] == [('GET', '/ip')]
+
+        standin.statuses['/ip'] = 503
+        monkeypatch.setattr('sys.argv', ['twod.py', '--once', '-e', 'sync',
+                                         '-c', config])
+        with pytest.raises(SystemExit) as e:
+            main()
+        assert e.value.code == 4
+
+    def test_once_engine(self, monkeypatch, standin, standin_config):
+        """Test that --once keeps the configured engine."""
+        engines = []
+        monkeypatch.setattr('twod.twod.Twod.run_once', lambda self: (
+            engines.append(self.conf['engine']) or 0))
+        for general, args in (('engine = sync', []),
+                              ('engine = sync', ['-e', 'asyncio']),
+                              ('engine = asyncio', [])):
+            monkeypatch.setattr('sys.argv', ['twod.py', '--once', '-c',
+                                             standin_config(general=general)]
+                                + args)
+            with pytest.raises(SystemExit):
+                main()
+        assert engines == ['sync', 'asyncio', 'asyncio']
@@ -16,6 +16,139 @@ class TestConfig:
         cls = Twod(valid_config_path)
         assert cls.interval == 9000
 
+    @mock.patch('twod.twod._Data')
+    def test_config_multi_host(self, mock_data, capsys, monkeypatch,
+                               multi_host_config_path):
+        """Test parsing of ``host:NAME`` sections."""
+        cls = Twod(multi_host_config_path)
+        one, two = cls.conf['hosts']
+        assert one['name'] == 'one'
+        assert one['user'] == 'username@example.com'
+        assert one['interval'] == 9000
+        assert two['name'] == 'two'
+        assert two['token'] == 'other-token'
+        assert two['url'] == 'https://api.twodns.de/hosts/two.dd-dns.de'
+        assert two['interval'] == 600
+        assert cls.conf['ip_mode'] == 'random'
+
+    @mock.patch('twod.twod._Data')
+    def test_config_metrics(self, mock_data, capsys, tmpdir,
+                            valid_config_path):
+        """Test parsing of the metrics listen address."""
+        config = tmpdir.join('twodrc')
+        config.write(config.read() + '\n[metrics]\nlisten = [::1]:9469\n')
+        assert Twod(str(config)).conf['metrics_listen'] == ('::1', 9469)
+
+        config.write(config.read().replace('[::1]:9469', '9469'))
+        with pytest.raises(SystemExit):
+            Twod(str(config))
+        out, err = capsys.readouterr()
+        assert "Invalid listen address: '9469'" in err
+
+    @mock.patch('twod.twod._Data')
+    def test_config_families(self, mock_data, capsys, tmpdir,
+                             dual_stack_config_path):
+        """Test parsing of the tracked address families."""
+        assert Twod(dual_stack_config_path).conf['families'] == (4, 6)
+
+        config = tmpdir.join('twodrc')
+        config.write(config.read().replace('4 6', '5'))
+        with pytest.raises(SystemExit):
+            Twod(str(config))
+        out, err = capsys.readouterr()
+        assert "Invalid families: '5'" in err
+
+    @mock.patch('twod.twod._Data')
+    def test_config_schedule(self, mock_data, capsys, tmpdir,
+                             valid_config_path):
+        """Test parsing of scheduling settings."""
+        conf = Twod(valid_config_path).conf
+        assert (conf['splay'], conf['catch_up']) == (0, 'now')
+
+        config = tmpdir.join('twodrc')
+        valid = config.read()
+        for lines, error in (
+                ('interval = 0', "Invalid interval: '0.0'"),
+                ('interval = 9000\nsplay = -1', "Invalid splay: '-1.0'"),
+                ('interval = 9000\ncatch_up = later',
+                 "Invalid catch_up: 'later'")):
+            config.write(valid.replace('interval = 9000', lines))
+            with pytest.raises(SystemExit):
+                Twod(str(config))
+            out, err = capsys.readouterr()
+            assert error in err
+
+    @mock.patch('twod.twod._Data')
+    def test_config_inventory(self, mock_data, capsys, tmpdir,
+                              inventory_config_path):
+        """Test reading hosts from a JSONL inventory."""
+        conf = Twod(inventory_config_path).conf
+        assert conf['hosts'] == []
+        assert conf['spread'] is True
+        assert conf['cache_ttl'] == 60
+        one, two = conf['inventory']
+        assert one == {
+            'name': 'one.dd-dns.de',
+            'user': 'username@example.com',
+            'token': 'token',
+            'url': 'https://api.twodns.de/hosts/one.dd-dns.de',
+            'interval': 9000,
+        }
+        assert two['name'] == 'two'
+        assert two['token'] == 'other-token'
+        assert two['interval'] == 600
+        # Read again on every iteration
+        assert len(list(conf['inventory'])) == 2
+
+        inventory = tmpdir.join('hosts.jsonl')
+        inventory.write(inventory.read() + '{"host_url": "invalid_url"}\n')
+        with pytest.raises(SystemExit):
+            Twod(inventory_config_path)
+        out, err = capsys.readouterr()
+        assert "hosts.jsonl:6: Invalid host: Invalid URL: 'invalid_url'" in err
+
+        # Hosts are known by name, in sections and inventory alike
+        config = tmpdir.join('twodrc')
+        config.write(config.read() + """
+[host:one]
+host_url = https://api.twodns.de/hosts/one.dd-dns.de
+""")
+        inventory.write('{"name": "one", "host_url": '
+                        '"https://api.twodns.de/hosts/1.dd-dns.de"}\n')
+        with pytest.raises(SystemExit):
+            Twod(inventory_config_path)
+        out, err = capsys.readouterr()
+        assert "Duplicate host: 'one'" in err
+
+        # An empty inventory is no host
+        config.write(config.read().split('[host:one]')[0])
+        inventory.write('# Nothing yet\n')
+        with pytest.raises(SystemExit):
+            Twod(inventory_config_path)
+        out, err = capsys.readouterr()
+        assert "No hosts configured" in err
+
+    @mock.patch('twod.twod._Data')
+    def test_config_inventory_csv(self, mock_data, capsys, tmpdir,
+                                  inventory_config_path):
+        """Test reading hosts from a CSV inventory."""
+        config = tmpdir.join('twodrc')
+        config.write(config.read().replace('hosts.jsonl', 'hosts.csv'))
+        inventory = tmpdir.join('hosts.csv')
+        inventory.write('name,host_url,interval\n'
+                        'one,https://api.twodns.de/hosts/one.dd-dns.de,\n'
+                        'two,https://api.twodns.de/hosts/two.dd-dns.de,60\n')
+        one, two = Twod(str(config)).conf['inventory']
+        assert one['name'] == 'one'
+        assert one['interval'] == 9000
+        assert two['interval'] == 60
+
+        inventory.write(inventory.read() + 'three,,\n')
+        with pytest.raises(SystemExit):
+            Twod(str(config))
+        out, err = capsys.readouterr()
+        assert "hosts.csv:4: Invalid host: No host_url" in err
+
     @mock.patch('twod.twod._Data')
     def test_config_missing_username(self, mock_data, capsys, monkeypatch,
                                      missing_username_config_path):
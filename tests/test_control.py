@@ -0,0 +1,112 @@
+"""Tests for twod's control socket."""
+
+import os
+import socket
+import stat
+
+from json import loads
+from time import time
+
+import pytest
+
+from twod.twod import Twod, _Data, main
+from twod._control import _ControlServer, _request
+
+
+class TestControl:
+    """Test commands sent to the running daemon."""
+
+    def test_commands(self, tmpdir, standin, standin_config):
+        """Test status queries and on-demand checks."""
+        path = str(tmpdir.join('control'))
+        data = _Data(Twod(standin_config(
+            general='control_socket = %s' % path,
+            ip_service='shared_cache = %s' % tmpdir.join('shared'))).conf)
+        server = _ControlServer(path, data.control)
+        data.tick()
+        reply = _request(path, 'status')
+        assert sorted(reply['hosts']) == ['one', 'two']
+        assert reply['hosts']['one']['rec_ip'] == '127.0.0.3'
+        assert reply['hosts']['one']['next_check'] > 1000
+        assert reply['next_check'] > 1000
+        service = reply['services'][standin.url + '/ip']
+        assert service['requests'] == 1
+        assert service['success_rate'] == 1.0
+
+        assert _request(path, 'check-now', ['one']) == {'scheduled': ['one']}
+        start = time()
+        data.wait(10)
+        assert time() - start < 1
+        del standin.requests[:]
+        data.tick()
+        assert [r[1] for r in standin.requests] == ['/ip']
+
+        # The shared cache holds our last discovery, it is skipped too
+        standin.ext_ip = '127.0.0.4'
+        _request(path, 'check-now')
+        data.wait(10)
+        del standin.requests[:]
+        data.tick()
+        assert sorted(r[1] for r in standin.requests) == [
+            '/hosts/one', '/hosts/two', '/ip']
+        assert standin.records == {'one': '127.0.0.4', 'two': '127.0.0.4'}
+
+        # Records are read again before checking, the external IP comes
+        # from the shared cache
+        _request(path, 'refresh-record')
+        del standin.requests[:]
+        data.tick()
+        assert sorted(r[1] for r in standin.requests) == [
+            '/hosts/one', '/hosts/two']
+
+        assert _request(path, 'check-now', ['three']) == {
+            'error': "Unknown host: 'three'"}
+        assert _request(path, 'reboot') == {
+            'error': "Unknown command: 'reboot'"}
+
+        # A second daemon does not take over the socket
+        with pytest.raises(IOError):
+            _ControlServer(path, data.control)
+        server.close()
+        data.close()
+
+    def test_socket_path(self, tmpdir):
+        """Test that only stale sockets are replaced."""
+        path = str(tmpdir.join('control'))
+        tmpdir.join('control').write('keep')
+        with pytest.raises(IOError) as e:
+            _ControlServer(path, None)
+        assert "is not a socket" in str(e.value)
+        assert tmpdir.join('control').read() == 'keep'
+
+        os.unlink(path)
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        server = _ControlServer(path, lambda command, args: {'ok': True})
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        assert _request(path, 'status') == {'ok': True}
+        server.close()
+
+    def test_ctl(self, capsys, monkeypatch, tmpdir, standin,
+                 standin_config):
+        """Test ``twod ctl``."""
+        path = str(tmpdir.join('control'))
+        config = standin_config(general='control_socket = %s' % path)
+        monkeypatch.setattr('sys.argv', ['twod.py', '-c', config, 'ctl',
+                                         'check-now', 'two'])
+        with pytest.raises(SystemExit) as e:
+            main()
+        assert e.value.code == 1
+        out, err = capsys.readouterr()
+        assert "Unable to reach twod" in err
+
+        data = _Data(Twod(config).conf)
+        server = _ControlServer(path, data.control)
+        with pytest.raises(SystemExit) as e:
+            main()
+        assert e.value.code == 0
+        out, err = capsys.readouterr()
+        assert loads(out) == {'scheduled': ['two']}
+        server.close()
+        data.close()
@@ -1,9 +1,13 @@
 """Tests for twod's main function."""
 
+import logging
 import mock
 from requests import exceptions
+from time import time
 
-from twod.twod import Twod, _Data
+from tests.mocks import response
+from twod._ip import _parse_ip
+from twod.twod import Twod, _Breaker, _Data, _ServiceGenerator
 
 
 class TestData:
@@ -12,13 +16,13 @@ class TestData:
     @mock.patch('twod.twod.Session.get')
     def test_get_rec_ip(self, mock_get, capsys, valid_config_path):
         """Test retrieval of recorded IP."""
-        MyMock = mock.Mock(text=u'{"ip_address": "127.0.0.2"}')
+        MyMock = response(u'{"ip_address": "127.0.0.2"}')
         mock_get.return_value = MyMock
         cls = Twod(valid_config_path)
         data = _Data(cls.conf)
 
         assert cls.interval == 9000
-        assert data.rec_ip == '127.0.0.2'
+        assert str(data.rec_ip) == '127.0.0.2'
 
     def test_get_rec_ip_invalid_host(self, capsys, caplog,
                                      invalid_host_config_path):
@@ -35,28 +39,28 @@ class TestData:
     def test_get_ext_ip(self, mock_get, capsys, caplog,
                         valid_config_path):
         """Test retrieval of external IP."""
-        MyMock = mock.Mock(text=u'{"ip_address": "127.0.0.2"}')
-        MyMock2 = mock.Mock(text="127.0.0.3")
+        MyMock = response(u'{"ip_address": "127.0.0.2"}')
+        MyMock2 = response("127.0.0.3")
         mock_get.return_value = MyMock
         cls = Twod(valid_config_path)
         data = _Data(cls.conf)
 
         assert cls.interval == 9000
-        assert data.rec_ip == '127.0.0.2'
+        assert str(data.rec_ip) == '127.0.0.2'
 
         mock_get.return_value = MyMock2
-        assert data._get_ext_ip() == '127.0.0.3'
+        assert str(data._get_ext_ip()) == '127.0.0.3'
 
     def test_get_ext_ip_invalid_host(self, capsys, caplog,
                                      invalid_host_config_path):
         """Test config parsing with invalid IP service URLs."""
-        MyMock = mock.Mock(text=u'{"ip_address": "127.0.0.2"}')
+        MyMock = response(u'{"ip_address": "127.0.0.2"}')
         patcher = mock.patch('twod.twod.Session.get')
         my_mock = patcher.start()
         my_mock.return_value = MyMock
         cls = Twod(invalid_host_config_path)
         data = _Data(cls.conf)
-        assert data.rec_ip == "127.0.0.2"
+        assert str(data.rec_ip) == "127.0.0.2"
 
         patcher.stop()
         assert data._get_ext_ip() is False
@@ -67,7 +71,7 @@ class TestData:
     def test_get_ext_ip_rr(self, mock_get, capsys, caplog,
                            valid_config_mode_rr_path):
         """Test round robin URL selection mode."""
-        MyMock = mock.Mock(text=u'{"ip_address": "127.0.0.2"}')
+        MyMock = response(u'{"ip_address": "127.0.0.2"}')
         mock_get.return_value = MyMock
         cls = Twod(valid_config_mode_rr_path)
         data = _Data(cls.conf)
@@ -81,24 +85,61 @@ class TestData:
         assert data._get_service_url() == 'https://nr_three'
         assert data._get_service_url() == 'https://nr_one'
 
+    def test_adaptive(self):
+        """Test that adaptive mode prefers fast and reliable services."""
+        gen = _ServiceGenerator(['https://fast', 'https://slow',
+                                 'https://down'], 'adaptive', explore=0.1)
+
+        # Every service is tried once first
+        for service in ('https://fast', 'https://slow', 'https://down'):
+            assert gen.next() == service
+            gen.record(service, {'https://fast': 0.05}.get(service, 2),
+                       service != 'https://down')
+        for _ in range(5):
+            gen.record('https://down', 16, False)
+
+        picks = [gen.next() for _ in range(1000)]
+        assert picks.count('https://fast') > 800
+        # Exploration keeps the failing service in rotation
+        assert 0 < picks.count('https://down') < 100
+
+        stats = gen.stats()
+        assert stats['https://fast']['latency'] == 0.05
+        assert stats['https://down']['requests'] == 6
+        assert stats['https://down']['failures'] == 6
+        assert stats['https://down']['success_rate'] < 0.2
+
+    @mock.patch('twod.twod.Session.get')
+    def test_get_ext_ip_records_stats(self, mock_get, capsys, caplog,
+                                      valid_config_path):
+        """Test that every IP service request is recorded."""
+        mock_get.return_value = response(u'{"ip_address": "127.0.0.2"}')
+        cls = Twod(valid_config_path)
+        data = _Data(cls.conf)
+
+        mock_get.return_value = response("no ip")
+        url = data.gen.services[0]
+        assert data._fetch_ext_ip(url) is False
+        assert data.gen.stats()[url]['failures'] == 1
+
     @mock.patch('twod.twod.Session.get')
     def test_check(self, mock_get, capsys, caplog,
                    valid_config_path):
         """Test IP comparison."""
-        MyMock = mock.Mock(text=u'{"ip_address": "127.0.0.2"}')
-        MyMock2 = mock.Mock(text="127.0.0.3")
-        MyMock3 = mock.Mock(text="127.0.0.2")
+        MyMock = response(u'{"ip_address": "127.0.0.2"}')
+        MyMock2 = response("127.0.0.3")
+        MyMock3 = response("127.0.0.2")
         mock_get.return_value = MyMock
         cls = Twod(valid_config_path)
         data = _Data(cls.conf)
 
         assert cls.interval == 9000
-        assert data.rec_ip == '127.0.0.2'
+        assert str(data.rec_ip) == '127.0.0.2'
 
         # external and recorded IP are different, return external IP
         mock_get.return_value = MyMock2
-        assert data._get_ext_ip() == '127.0.0.3'
-        assert data._check_ip() == '127.0.0.3'
+        assert str(data._get_ext_ip()) == '127.0.0.3'
+        assert str(data._check_ip()) == '127.0.0.3'
 
         # external and recorded IP are the same, return False
         mock_get.return_value = MyMock3
@@ -109,7 +150,7 @@ class TestData:
     def test_update(self, mock_put, mock_get, capsys, caplog,
                     valid_config_path):
         """Test IP update."""
-        MyMock = mock.Mock(text=u'{"ip_address": "127.0.0.2"}')
+        MyMock = response(u'{"ip_address": "127.0.0.2"}')
         MyMock2 = mock.Mock(status_code=200)
         mock_get.return_value = MyMock
         mock_put.return_value = MyMock2
@@ -117,14 +158,14 @@ class TestData:
         data = _Data(cls.conf)
 
         data._update_ip('127.0.0.3')
-        assert data.rec_ip == '127.0.0.3'
+        assert str(data.rec_ip) == '127.0.0.3'
 
     @mock.patch('twod.twod.Session.get')
     @mock.patch('twod.twod.Session.put')
     def test_update_fail(self, mock_put, mock_get, capsys, caplog,
                          valid_config_path):
         """Test IP update failure."""
-        MyMock = mock.Mock(text=u'{"ip_address": "127.0.0.2"}')
+        MyMock = response(u'{"ip_address": "127.0.0.2"}')
 
         def http_error(*args, **kwargs):
             raise exceptions.HTTPError("Service Unavailable")
@@ -136,5 +177,351 @@ class TestData:
         data = _Data(cls.conf)
 
         data._update_ip('127.0.0.3')
-        assert data.rec_ip == '127.0.0.2'
+        assert str(data.rec_ip) == '127.0.0.2'
         assert "Error while updating IP" in caplog.text
+
+    @mock.patch('twod.twod.Session.get')
+    def test_session_reused(self, mock_get, capsys, caplog,
+                            valid_config_path):
+        """Test that all requests share one pooled session."""
+        mock_get.return_value = response(u'{"ip_address": "127.0.0.2"}')
+        cls = Twod(valid_config_path)
+        data = _Data(cls.conf)
+        session = data.session
+
+        mock_get.return_value = response("127.0.0.3")
+        assert str(data._get_ext_ip()) == '127.0.0.3'
+        assert data.session is session
+        assert session.adapters['https://']._pool_maxsize == 2
+
+    @mock.patch('twod.twod.Session.get')
+    @mock.patch('twod.twod.Session.close')
+    def test_session_idle_eviction(self, mock_close, mock_get, capsys, caplog,
+                                   valid_config_path):
+        """Test that idle connections are dropped after ``keepalive``."""
+        mock_get.return_value = response(u'{"ip_address": "127.0.0.2"}')
+        cls = Twod(valid_config_path)
+        data = _Data(cls.conf)
+
+        mock_get.return_value = response("127.0.0.3")
+        data._get_ext_ip()
+        assert not mock_close.called
+
+        data.last_used -= data.keepalive + 1
+        data._get_ext_ip()
+        assert mock_close.called
+
+    @mock.patch('twod.twod.Session.get')
+    @mock.patch('twod.twod.Session.put')
+    def test_tick_multi_host(self, mock_put, mock_get, capsys, caplog,
+                             multi_host_config_path):
+        """Test that one discovery is shared by all due hosts."""
+        mock_get.return_value = response(u'{"ip_address": "127.0.0.2"}')
+        mock_put.return_value = mock.Mock(status_code=200)
+        cls = Twod(multi_host_config_path)
+        data = _Data(cls.conf)
+        assert [str(h.rec_ip) for h in data.hosts] == ['127.0.0.2'] * 2
+
+        mock_get.reset_mock()
+        mock_get.return_value = response("127.0.0.3")
+        data.tick()
+        assert mock_get.call_count == 1
+        assert mock_put.call_count == 2
+        assert [str(h.rec_ip) for h in data.hosts] == ['127.0.0.3'] * 2
+
+        # Nothing is due until the shorter interval has passed
+        data.tick()
+        assert mock_get.call_count == 1
+        assert 599 < data.next_delay() <= 600
+
+    @mock.patch('twod.twod.Session.get')
+    @mock.patch('twod.twod.Session.put')
+    def test_tick_dual_stack(self, mock_put, mock_get, capsys, caplog,
+                             dual_stack_config_path):
+        """Test that only the family whose IP changed is updated."""
+        mock_get.return_value = mock.Mock(
+            text=u'{"ip_address": "127.0.0.3", "ipv6_address": "::2"}')
+        mock_put.return_value = mock.Mock(status_code=200)
+        cls = Twod(dual_stack_config_path)
+        data = _Data(cls.conf)
+        host = data.hosts[0]
+        assert (str(host.rec_ip), str(host.rec_ip6)) == ('127.0.0.3', '::2')
+        assert set(data.sessions) == set([4, 6])
+
+        ext_ips = {4: _parse_ip('127.0.0.3'), 6: _parse_ip('::3')}
+        with mock.patch.object(data, '_get_ext_ip',
+                               side_effect=ext_ips.get) as mock_ext:
+            data.tick()
+            assert sorted(c[0][0] for c in mock_ext.call_args_list) == [4, 6]
+            mock_put.assert_called_once_with(
+                host.url, auth=host.ident, data='{"ipv6_address": "::3"}',
+                verify=True, timeout=data.timeout)
+            assert (host.ext_ip, host.ext_ip6) == (ext_ips[4], ext_ips[6])
+            assert str(host.rec_ip6) == '::3'
+
+            host.next_check = 0
+            data.tick()
+            assert mock_put.call_count == 1
+
+    @mock.patch('twod.twod.Session.get')
+    def test_get_ext_ip_family(self, mock_get, capsys, caplog,
+                               dual_stack_config_path):
+        """Test that IPs of the wrong family are rejected."""
+        mock_get.return_value = mock.Mock(
+            text=u'{"ip_address": "127.0.0.2", "ipv6_address": "::2"}')
+        data = _Data(Twod(dual_stack_config_path).conf)
+
+        mock_get.return_value = response("127.0.0.3")
+        assert str(data._get_ext_ip(4)) == '127.0.0.3'
+        assert data._get_ext_ip(6) is False
+        assert "returned invalid IP" in caplog.text
+
+    @mock.patch('twod.twod.Session.get')
+    @mock.patch('twod.twod.Session.put')
+    def test_canonical_ip(self, mock_put, mock_get, capsys, caplog,
+                          dual_stack_config_path):
+        """Test that other spellings of the recorded IPs are no change."""
+        mock_get.return_value = response(
+            u'{"ip_address": "127.0.0.3", "ipv6_address": "2001:DB8:0:0::2"}')
+        data = _Data(Twod(dual_stack_config_path).conf)
+        host = data.hosts[0]
+        assert str(host.rec_ip6) == '2001:db8::2'
+        # Equal IPs hash alike, strings are no IPs
+        assert {host.rec_ip6, _parse_ip('2001:db8::2')} == {host.rec_ip6}
+        assert host.rec_ip6 != '2001:db8::2'
+
+        spellings = {4: '::ffff:127.0.0.3\n', 6: '2001:db8:0000::0002%eth0'}
+        with mock.patch.object(
+                data, '_poll_ext_ip', side_effect=lambda family: (
+                    data._parse_ext_ip(spellings[family], family))):
+            data.tick()
+        assert not mock_put.called
+        assert (str(host.ext_ip), str(host.ext_ip6)) == (
+            '127.0.0.3', '2001:db8::2')
+        # Mapped IPv4 addresses are no IPv6 addresses
+        assert data._parse_ext_ip('::ffff:127.0.0.3', 6) is False
+
+    def test_reject(self, capsys, caplog, standin, standin_config):
+        """Test that IPs rejected by the policy are ignored."""
+        cls = Twod(standin_config(
+            ip_service='reject = link_local, 127.0.0.0/30'))
+        data = _Data(cls.conf)
+        for host in data.hosts:
+            host.next_check = 0
+        data.tick()
+        assert ("returned 127.0.0.3, which is rejected as 127.0.0.0/30" in
+                caplog.text)
+        assert [str(h.rec_ip) for h in data.hosts] == ['127.0.0.2'] * 2
+        assert data.policy.rejects(_parse_ip('fe80::1')) == 'link_local'
+        assert data.policy.rejects(_parse_ip('127.0.0.4')) is None
+        data.close()
+
+    def test_tick_spread(self, capsys, caplog, standin, standin_config):
+        """Test that spread checks share cached discoveries."""
+        cls = Twod(standin_config(general='spread = yes\ninterval = 600'))
+        start = time()
+        data = _Data(cls.conf)
+        # Records are only read at the first check of each host
+        assert standin.requests == []
+        one, two = data.hosts
+        assert start <= one.next_check <= start + 600
+        assert start <= two.next_check <= start + 600
+        assert one.next_check != two.next_check
+
+        def tick(host):
+            host.next_check = 0
+            data.tick()
+            return [r[1] for r in standin.requests if r[0] == 'GET']
+
+        assert tick(one) == ['/ip', '/hosts/one']
+        assert str(one.rec_ip) == '127.0.0.3'
+        # The next host reuses the discovery until ``cache_ttl`` has passed
+        del standin.requests[:]
+        assert tick(two) == ['/hosts/two']
+        assert str(two.rec_ip) == '127.0.0.3'
+        data.ext_cache = (data.ext_cache[0] - 60, data.ext_cache[1])
+        del standin.requests[:]
+        assert tick(one) == ['/ip']
+        data.close()
+
+    def test_refresh_conditional(self, capsys, caplog, standin,
+                                 standin_config):
+        """Test that records are re-read with conditional requests."""
+        standin.validators = True
+        standin.ext_ip = '127.0.0.2'
+        cls = Twod(standin_config(general='refresh_every = 2'))
+        data = _Data(cls.conf)
+        assert standin.statuses_sent == [200, 200]
+
+        def tick():
+            del standin.statuses_sent[:]
+            for host in data.hosts:
+                host.next_check = 0
+            data.tick()
+
+        tick()
+        assert standin.statuses_sent == [200]
+        tick()
+        assert standin.statuses_sent == [200]
+
+        # Unchanged records cost a 304 and no parsing
+        with mock.patch.object(data, '_parse_record') as mock_parse:
+            tick()
+        assert sorted(standin.statuses_sent) == [200, 304, 304]
+        assert not mock_parse.called
+
+        # A record changed elsewhere is noticed and corrected
+        standin.records['one'] = '127.0.0.9'
+        with caplog.at_level(logging.INFO, logger='twod'):
+            tick()
+            tick()
+        assert sorted(standin.statuses_sent) == [200, 200, 200, 304]
+        assert "one: Record changed to 127.0.0.9 outside of twod" in (
+            caplog.text)
+        assert standin.records['one'] == '127.0.0.2'
+        data.close()
+
+    @mock.patch('twod.twod.Session.get')
+    def test_invalid_record(self, mock_get, caplog, valid_config_path):
+        """Test that bodies which are no record count as failures."""
+        mock_get.return_value = response('<html>Log in</html>')
+        data = _Data(Twod(valid_config_path).conf)
+        assert "TwoDNS returned invalid record" in caplog.text
+        assert data.rec_ip is False
+
+        mock_get.return_value = response('["127.0.0.2"]')
+        assert data._get_record() is False
+        assert [counts for (kind, _), counts in data.metrics.requests.items()
+                if kind == 'twodns_get'] == [[0, 2]]
+        data.close()
+
+    def test_get_ext_ip_race(self, capsys, caplog, standin, standin_config):
+        """Test that the fastest IP service wins in race mode."""
+        standin.delays['/ip-slow'] = 3
+        cls = Twod(standin_config(
+            ip_service='mode = race\nhedge_delay = 0',
+            ip_paths=('/ip-slow', '/ip')))
+        data = _Data(cls.conf)
+
+        start = time()
+        assert str(data._get_ext_ip()) == '127.0.0.3'
+        assert time() - start < 1
+        # Let the abandoned request time out before the test ends
+        data.executor.shutdown(wait=True)
+        data.close()
+
+    def test_get_ext_ip_hedge(self, capsys, caplog, standin, standin_config):
+        """Test that failed requests are hedged right away."""
+        standin.statuses['/ip-down'] = 503
+        cls = Twod(standin_config(
+            ip_service='mode = race\nhedge_delay = 5',
+            ip_paths=('/ip-down', '/ip')))
+        data = _Data(cls.conf)
+
+        start = time()
+        assert str(data._get_ext_ip()) == '127.0.0.3'
+        assert time() - start < 1
+        assert "Error while fetching external IP: 503" in caplog.text
+        data.close()
+
+    def test_get_ext_ip_bounded(self, capsys, caplog, standin,
+                                standin_config_path):
+        """Test that oversized and trickling answers are aborted."""
+        data = _Data(Twod(standin_config_path).conf)
+        url = standin.url + '/ip'
+
+        standin.ext_ip = '127.0.0.3' + ' ' * 100
+        assert data._get_ext_ip() is False
+        assert "Response larger than 64 bytes" in caplog.text
+
+        standin.ext_ip = '127.0.0.3'
+        standin.trickle = 0.3
+        start = time()
+        assert data._get_ext_ip() is False
+        assert time() - start < 1.5
+        assert data.metrics.requests[('ip_service', url)] == [0, 2]
+
+        standin.trickle = 0
+        assert str(data._get_ext_ip()) == '127.0.0.3'
+        data.close()
+
+    def test_get_ext_ip_trickled_headers(self, capsys, caplog, standin,
+                                         standin_config_path):
+        """Test that answers with trickling headers are aborted in time."""
+        data = _Data(Twod(standin_config_path).conf)
+        url = standin.url + '/ip'
+
+        standin.trickle_headers = 0.1
+        start = time()
+        assert data._get_ext_ip() is False
+        assert time() - start < 1.5
+        assert data.metrics.requests[('ip_service', url)] == [0, 1]
+
+        standin.trickle_headers = 0
+        assert str(data._get_ext_ip()) == '127.0.0.3'
+        data.close()
+
+    def test_breaker(self):
+        """Test circuit breaker state transitions."""
+        breaker = _Breaker(threshold=2, base=10, cap=100)
+        assert breaker.allow()
+        assert breaker.failure() is None
+        assert breaker.allow()
+        delay = breaker.failure()
+        assert 5 <= delay <= 10
+        assert breaker.state == 'open'
+        assert not breaker.allow()
+
+        # Half-open lets a single trial through
+        breaker.until = 0
+        assert breaker.allow()
+        assert breaker.state == 'half-open'
+        assert not breaker.allow()
+        # Failed trial opens it again for twice as long
+        assert 10 <= breaker.failure() <= 20
+
+        breaker.until = 0
+        assert breaker.allow()
+        breaker.success()
+        assert breaker.state == 'closed'
+        assert breaker.allow()
+
+    @mock.patch('twod.twod.Session.get')
+    def test_breaker_skips_service(self, mock_get, capsys, caplog,
+                                   valid_config_path):
+        """Test that services with an open breaker are skipped."""
+        mock_get.return_value = response(u'{"ip_address": "127.0.0.2"}')
+        cls = Twod(valid_config_path)
+        data = _Data(cls.conf)
+
+        for url in data.gen.services:
+            for _ in range(data.threshold):
+                data._record(url, 0, False, 'ip_service')
+        mock_get.reset_mock()
+        assert data._get_ext_ip() is False
+        assert not mock_get.called
+        assert "All IP services are unavailable" in caplog.text
+
+    @mock.patch('twod.twod.Session.get')
+    @mock.patch('twod.twod.Session.put')
+    def test_update_fail_retry(self, mock_put, mock_get, capsys, caplog,
+                               valid_config_path):
+        """Test that failed updates are retried before the next interval."""
+        mock_get.return_value = response(u'{"ip_address": "127.0.0.2"}')
+        mock_put.side_effect = exceptions.HTTPError("Service Unavailable")
+        cls = Twod(valid_config_path)
+        data = _Data(cls.conf)
+
+        mock_get.return_value = response("127.0.0.3")
+        data.tick()
+        assert str(data.rec_ip) == '127.0.0.2'
+        assert 15 <= data.next_delay() <= 30
+        assert data.hosts[0].retries == 1
+
+        mock_put.side_effect = None
+        mock_put.return_value = mock.Mock(status_code=200)
+        data.hosts[0].next_check = 0
+        data.tick()
+        assert str(data.rec_ip) == '127.0.0.3'
+        assert data.hosts[0].retries == 0
+        assert data.next_delay() > 8000
@@ -0,0 +1,139 @@
+"""Tests for twod's thread pool."""
+
+from threading import Event
+from time import sleep, time
+
+import mock
+import pytest
+
+from twod.twod import Twod, _Data
+from twod._executor import _Executor
+
+
+class TestExecutor:
+    """Test concurrent blocking calls."""
+
+    def test_deadline(self):
+        """Test that calls stop at their next check after the deadline."""
+        executor = _Executor(2)
+
+        def call(seconds):
+            sleep(seconds)
+            executor.check()
+            return seconds
+        results, late, skipped = executor.run_all(call, [0, 0.2], 0.1, 0.5)
+        assert (results, late, skipped) == ([0, None], 0, [])
+        executor.shutdown()
+
+    def test_queued(self):
+        """Test that calls waiting for a thread get their full time."""
+        executor = _Executor(2)
+
+        def call(seconds):
+            sleep(seconds)
+            executor.check()
+            return seconds
+        results, late, skipped = executor.run_all(call, [0.2] * 6, 0.3)
+        assert (results, late, skipped) == ([0.2] * 6, 0, [])
+        executor.shutdown()
+
+    def test_skipped(self):
+        """Test that calls not started while others overran are reported."""
+        executor = _Executor(1)
+        release = Event()
+        results, late, skipped = executor.run_all(
+            lambda item: release.wait(1), [0, 1], 0.1, 0.1)
+        release.set()
+        assert (results, late, skipped) == ([None, None], 1, [1])
+        executor.shutdown()
+
+    def test_shutdown(self):
+        """Test that shutdown cancels queued and running calls."""
+        executor = _Executor(1)
+        started, release = Event(), Event()
+
+        def call():
+            started.set()
+            release.wait(1)
+            executor.check()
+        running = executor.submit(call)
+        queued = executor.submit(call)
+        started.wait(1)
+        executor.shutdown()
+        release.set()
+        assert queued.cancelled()
+        assert "Shutting down" in str(running.exception(1))
+
+    def test_concurrent_ticks(self, caplog, standin, standin_config_path):
+        """Test that hosts are checked concurrently."""
+        standin.delays['/hosts/one'] = standin.delays['/hosts/two'] = 0.4
+        start = time()
+        data = _Data(Twod(standin_config_path).conf)
+        assert time() - start < 0.7
+        assert [str(h.rec_ip) for h in data.hosts] == ['127.0.0.2'] * 2
+
+        start = time()
+        data.tick()
+        assert time() - start < 0.7
+        assert standin.records == {'one': '127.0.0.3', 'two': '127.0.0.3'}
+
+        # A slow host does not hold up the others
+        standin.ext_ip = '127.0.0.4'
+        standin.delays['/hosts/one'] = 3
+        del standin.delays['/hosts/two']
+        for host in data.hosts:
+            host.next_check = 0
+        start = time()
+        data.tick()
+        assert time() - start < 1.5
+        assert "one: Failed to update IP" in caplog.text
+        assert str(data.hosts[1].rec_ip) == '127.0.0.4'
+        data.close()
+
+    def test_many_hosts(self, tmpdir, standin):
+        """Test that hosts queued behind others are still checked."""
+        config = tmpdir.join('twodrc')
+        config.write("""
+[general]
+user     = username@example.com
+token    = token
+timeout  = 0.5
+threads  = 2
+%s
+[ip_service]
+ip_urls  = %s/ip
+""" % (''.join('[host:h%d]\nhost_url = %s/hosts/h%d\n' % (i, standin.url, i)
+               for i in range(24)), standin.url))
+        standin.records = dict(('h%d' % i, '127.0.0.2') for i in range(24))
+        standin.latency = 0.3
+        data = _Data(Twod(str(config)).conf)
+        assert all(str(host.rec_ip) == '127.0.0.2' for host in data.hosts)
+
+        data.tick()
+        assert set(standin.records.values()) == {'127.0.0.3'}
+        assert all(host.retries == 0 for host in data.hosts)
+        data.close()
+
+    def test_run_shutdown(self, monkeypatch, standin, standin_config):
+        """Test that the pool is shut down when the daemon stops."""
+        cls = Twod(standin_config())
+        closed = []
+        close = _Data.close
+
+        def closing(data):
+            closed.append(data)
+            close(data)
+        monkeypatch.setattr(_Data, 'close', closing)
+        monkeypatch.setattr('twod.twod.sleep',
+                            mock.Mock(side_effect=SystemExit))
+        with pytest.raises(SystemExit):
+            cls.run()
+        assert len(closed) == 1
+        assert closed[0].executor.closed.is_set()
+
+        # Also while records are read at startup
+        monkeypatch.setattr(_Data, '_start',
+                            mock.Mock(side_effect=KeyboardInterrupt))
+        with pytest.raises(KeyboardInterrupt):
+            cls.run()
+        assert len(closed) == 2
@@ -0,0 +1,120 @@
+"""Tests for twod's update journal."""
+
+import logging
+import threading
+
+import mock
+
+from twod.twod import Twod, _Data
+from twod._journal import _Journal
+
+
+class TestJournal:
+    """Test journaling of updates."""
+
+    def test_replay(self, tmpdir):
+        """Test that the latest update of every host is replayed."""
+        path = str(tmpdir.join('journal'))
+        journal = _Journal(path)
+        journal.intend('one', 'https://one', {'ip_address': '127.0.0.3'})
+        journal.confirm('one')
+        journal.intend('two', 'https://two', {'ip_address': '127.0.0.3'})
+        journal.close()
+        # Torn line of a crash
+        tmpdir.join('journal').write('{"op": "done", "ho', mode='a')
+
+        journal = _Journal(path)
+        updates = journal.replay()
+        assert updates['one']['done']
+        assert not updates['two']['done']
+        assert updates['two']['record'] == {'ip_address': '127.0.0.3'}
+        assert list(journal.pending) == ['two']
+        assert journal.lines == 4
+
+    def test_compact(self, tmpdir):
+        """Test that compaction keeps only unconfirmed updates."""
+        path = str(tmpdir.join('journal'))
+        journal = _Journal(path)
+        for _ in range(3):
+            journal.intend('one', 'https://one', {'ip_address': '127.0.0.3'})
+            journal.confirm('one')
+        journal.intend('two', 'https://two', {'ip_address': '127.0.0.3'})
+        journal.compact()
+        assert journal.lines == 1
+        journal.confirm('two')
+        journal.close()
+
+        updates = _Journal(path).replay()
+        assert list(updates) == ['two']
+        assert updates['two']['done']
+        assert [p.basename for p in tmpdir.listdir()] == ['journal']
+
+    def test_threads(self, tmpdir):
+        """Test that updates journaled from several threads are not lost."""
+        path = str(tmpdir.join('journal'))
+        journal = _Journal(path)
+
+        def update(name):
+            for _ in range(200):
+                journal.intend(name, 'https://' + name,
+                               {'ip_address': '127.0.0.3'})
+                journal.confirm(name)
+                if journal.compact_due():
+                    journal.compact()
+
+        threads = [threading.Thread(target=update, args=(str(i),))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        journal.close()
+
+        assert journal.lines == len(tmpdir.join('journal').readlines())
+        # Compaction dropped confirmed updates, none is pending
+        updates = _Journal(path).replay()
+        assert all(update['done'] for update in updates.values())
+        assert [p.basename for p in tmpdir.listdir()] == ['journal']
+
+    def test_killed_after_update(self, tmpdir, standin, standin_config):
+        """Test that confirmed updates are not sent again after a restart."""
+        conf = Twod(standin_config(general='state_file = %s' %
+                                   tmpdir.join('state'))).conf
+        data = _Data(conf)
+        for host in data.hosts:
+            host.next_check = 0
+        # Killed before the state file is written
+        with mock.patch.object(data, '_save_state'):
+            data.tick()
+        assert standin.records == {'one': '127.0.0.3', 'two': '127.0.0.3'}
+
+        del standin.requests[:]
+        data = _Data(conf)
+        assert standin.requests == []
+        assert [str(h.rec_ip) for h in data.hosts] == ['127.0.0.3'] * 2
+        for host in data.hosts:
+            host.next_check = 0
+        data.tick()
+        assert standin.requests == [('GET', '/ip', None)]
+        data.close()
+
+    def test_unconfirmed(self, caplog, tmpdir, standin, standin_config):
+        """Test that records of unconfirmed updates are fetched."""
+        conf = Twod(standin_config(general='state_file = %s' %
+                                   tmpdir.join('state'))).conf
+        data = _Data(conf)
+        for host in data.hosts:
+            host.next_check = 0
+        standin.statuses['/hosts/one'] = 503
+        data.tick()
+        data.close()
+        assert not data.journal.compact_due()
+
+        del standin.statuses['/hosts/one']
+        del standin.requests[:]
+        with caplog.at_level(logging.INFO, logger='twod'):
+            data = _Data(conf)
+        assert ("one: Last update may not have reached TwoDNS, fetching "
+                "record.") in caplog.text
+        assert [r[:2] for r in standin.requests] == [('GET', '/hosts/one')]
+        data.close()
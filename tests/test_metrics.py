@@ -0,0 +1,67 @@
+"""Tests for twod's metrics."""
+
+import mock
+import requests
+
+from tests.mocks import response
+from twod.twod import Twod, _Data
+from twod._metrics import _Metrics
+
+
+class TestMetrics:
+    """Test metrics collection and export."""
+
+    def test_render(self):
+        """Test Prometheus text output."""
+        metrics = _Metrics()
+        metrics.request('ip_service', 'https://icanhazip.com', 0.03, True)
+        metrics.request('ip_service', 'https://icanhazip.com', 42, False)
+        metrics.tick(0.2)
+        metrics.updated('example')
+        metrics.checked()
+        host = mock.Mock(rec_ip='127.0.0.2', ext_ip='127.0.0.2',
+                         rec_ip6=None, ext_ip6=None)
+        host.name = 'example'
+        text = metrics.render([host])
+
+        labels = 'endpoint="https://icanhazip.com",kind="ip_service"'
+        assert ('twod_requests_total{%s,result="success"} 1' % labels) in text
+        assert ('twod_requests_total{%s,result="failure"} 1' % labels) in text
+        assert ('twod_request_duration_seconds_bucket{%s,le="0.05"} 1' %
+                labels) in text
+        assert ('twod_request_duration_seconds_bucket{%s,le="30.0"} 1' %
+                labels) in text
+        assert ('twod_request_duration_seconds_bucket{%s,le="+Inf"} 2' %
+                labels) in text
+        assert ('twod_request_duration_seconds_count{%s} 2' % labels) in text
+        assert 'twod_tick_duration_seconds_count 1' in text
+        assert 'twod_updates_total{host="example"} 1' in text
+        assert 'twod_seconds_since_last_successful_check ' in text
+        assert 'twod_ip_in_sync{family="4",host="example"} 1' in text
+
+    def test_serve(self):
+        """Test metrics listener."""
+        metrics = _Metrics()
+        metrics.tick(0.1)
+        server = metrics.serve(('127.0.0.1', 0), [])
+        try:
+            url = 'http://127.0.0.1:%d/metrics' % server.server_port
+            response = requests.get(url, timeout=5)
+            assert response.status_code == 200
+            assert 'twod_tick_duration_seconds_count 1' in response.text
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    @mock.patch('twod.twod.Session.get')
+    def test_instrumentation(self, mock_get, caplog, valid_config_path):
+        """Test that requests made by _Data are recorded."""
+        mock_get.return_value = response(u'{"ip_address": "127.0.0.2"}')
+        data = _Data(Twod(valid_config_path).conf)
+
+        assert data.metrics.requests[
+            ('twodns_get', 'https://api.twodns.de')] == [1, 0]
+        mock_get.side_effect = requests.exceptions.ConnectionError("down")
+        data._fetch_ext_ip('https://icanhazip.com')
+        assert data.metrics.requests[
+            ('ip_service', 'https://icanhazip.com')] == [0, 1]
@@ -0,0 +1,95 @@
+"""Tests for twod's rtnetlink address monitor."""
+
+import socket
+
+import mock
+import pytest
+from struct import pack
+
+from tests.mocks import response
+from twod.twod import Twod, _Data
+from twod._netlink import (parse_addresses, IFA_F_DADFAILED,
+                           IFA_F_SECONDARY, IFA_F_TEMPORARY, IFA_F_TENTATIVE,
+                           IFA_LOCAL, NLMSG_DONE, RTM_DELADDR, RTM_NEWADDR)
+
+
+def message(kind, family=socket.AF_INET, address='192.0.2.1', index=4,
+            scope=0, flags=0):
+    """Build rtnetlink address message."""
+    raw = socket.inet_pton(family, address)
+    attr = pack('=HH', 4 + len(raw), IFA_LOCAL) + raw
+    body = pack('=BBBBI', family, 24, flags, scope, index) + attr
+    return pack('=LHHLL', 16 + len(body), kind, 0, 1, 0) + body
+
+
+class TestNetlink:
+    """Test rtnetlink address monitoring."""
+
+    def test_parse_addresses(self):
+        """Test parsing of address messages."""
+        data = (message(RTM_NEWADDR) +
+                message(RTM_NEWADDR, socket.AF_INET6, '2001:db8::1') +
+                message(RTM_NEWADDR, socket.AF_INET6, 'fe80::1', scope=253) +
+                message(RTM_NEWADDR, address='192.0.2.2',
+                        flags=IFA_F_TENTATIVE) +
+                message(RTM_NEWADDR, address='192.0.2.3',
+                        flags=IFA_F_SECONDARY) +
+                message(RTM_NEWADDR, socket.AF_INET6, '2001:db8::2',
+                        flags=IFA_F_TEMPORARY) +
+                message(RTM_NEWADDR, socket.AF_INET6, '2001:db8::3',
+                        flags=IFA_F_DADFAILED) +
+                message(RTM_DELADDR, index=5) +
+                pack('=LHHLL', 16, NLMSG_DONE, 0, 1, 0))
+        assert list(parse_addresses(data)) == [
+            (RTM_NEWADDR, socket.AF_INET, 4, '192.0.2.1'),
+            (RTM_NEWADDR, socket.AF_INET6, 4, '2001:db8::1'),
+            (RTM_NEWADDR, socket.AF_INET6, 4, None),
+            (RTM_NEWADDR, socket.AF_INET, 4, None),
+            (RTM_NEWADDR, socket.AF_INET, 4, None),
+            (RTM_NEWADDR, socket.AF_INET6, 4, None),
+            (RTM_NEWADDR, socket.AF_INET6, 4, None),
+            (RTM_DELADDR, socket.AF_INET, 5, '192.0.2.1'),
+            (NLMSG_DONE, None, None, None),
+        ]
+
+    @mock.patch('twod.twod.Session.put')
+    @mock.patch('twod.twod.Session.get')
+    @mock.patch('twod._netlink._AddressMonitor.addresses')
+    def test_local_ip(self, mock_addresses, mock_get, mock_put, caplog,
+                      tmpdir, valid_config_path):
+        """Test that the interface address is preferred over IP services."""
+        config = tmpdir.join('twodrc')
+        config.write(config.read().replace(
+            'mode     = random', 'mode = netlink\ninterface = lo'))
+        mock_get.return_value = response(u'{"ip_address": "127.0.0.2"}')
+        data = _Data(Twod(str(config)).conf)
+        mock_get.reset_mock()
+
+        mock_addresses.return_value = ['192.0.2.1', '2001:db8::1']
+        assert str(data._get_ext_ip()) == '192.0.2.1'
+        assert not mock_get.called
+
+        # Fall back to IP services without a global address
+        mock_addresses.return_value = []
+        mock_get.return_value = response('192.0.2.3')
+        assert str(data._get_ext_ip()) == '192.0.2.3'
+        assert mock_get.called
+
+        mock_put.return_value = mock.Mock(status_code=200)
+        data.tick()
+        assert str(data.rec_ip) == '192.0.2.3'
+        assert data.next_delay() > 8000
+        with mock.patch.object(data.monitor, 'wait', return_value=True):
+            data.wait(10)
+        assert data.next_delay() == 0
+        data.close()
+
+    def test_invalid_interface(self, capsys, tmpdir, valid_config_path):
+        """Test config parsing with a missing interface."""
+        config = tmpdir.join('twodrc')
+        config.write(config.read().replace(
+            'mode     = random', 'mode = netlink\ninterface = nonexistent0'))
+        with pytest.raises(SystemExit):
+            Twod(str(config))
+        out, err = capsys.readouterr()
+        assert "Invalid interface: 'nonexistent0'" in err
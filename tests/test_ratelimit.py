@@ -0,0 +1,90 @@
+"""Tests for twod's rate limits."""
+
+import logging
+
+from email.utils import formatdate
+from time import time
+
+from twod.twod import Twod, _Data
+from twod._ratelimit import _RateLimiter, _retry_after
+
+ONE = (('origin', 'https://api.twodns.de'), ('account', 'one'))
+TWO = (('origin', 'https://api.twodns.de'), ('account', 'two'))
+
+
+class TestRateLimit:
+    """Test rate limiting of TwoDNS API calls."""
+
+    def test_reserve(self):
+        """Test that reservations queue up behind the burst."""
+        limiter = _RateLimiter(10, 2, 0, 1)
+        assert limiter.reserve(ONE, 1) == 0
+        assert limiter.reserve(TWO, 1) == 0
+        # The origin bucket is shared, the accounts are unlimited
+        assert 0.09 < limiter.reserve(ONE, 1) <= 0.1
+        assert 0.19 < limiter.reserve(TWO, 1) <= 0.2
+        # Nothing is reserved beyond ``max_wait``
+        assert limiter.reserve(ONE, 0.25) is None
+        assert 0.29 < limiter.reserve(ONE, 1) <= 0.3
+
+    def test_pause(self):
+        """Test that paused accounts wait without affecting others."""
+        limiter = _RateLimiter(0, 10, 0, 10)
+        limiter.pause(ONE[1:], 30)
+        assert 29 < limiter.delay(ONE) <= 30
+        assert limiter.reserve(ONE, 10) is None
+        assert limiter.reserve(TWO, 10) == 0
+
+    def test_retry_after(self):
+        """Test parsing of the ``Retry-After`` header."""
+        assert _retry_after('120') == 120
+        assert 58 < _retry_after(formatdate(time() + 60, usegmt=True)) <= 60
+        assert _retry_after(formatdate(time() - 60, usegmt=True)) == 0
+        assert _retry_after('soon') is None
+        assert _retry_after(None) is None
+
+    def test_too_many_requests(self, caplog, standin, standin_config):
+        """Test that 429 answers pause the account of the host."""
+        cls = Twod(standin_config())
+        data = _Data(cls.conf)
+        one, two = data.hosts
+        standin.statuses['/hosts/one'] = 429
+        standin.retry_after = '120'
+        for host in data.hosts:
+            host.next_check = 0
+        del standin.requests[:]
+        with caplog.at_level(logging.INFO, logger='twod'):
+            data.tick()
+        assert ("one: Rate limited while updating IP, pausing requests for "
+                "120 seconds") in caplog.text
+        assert str(two.rec_ip) == '127.0.0.3'
+        # Retried once the pause is over
+        assert 119 < one.next_check - time() <= 120
+        assert one.stale_since
+
+        one.next_check = 0
+        del standin.requests[:]
+        with caplog.at_level(logging.INFO, logger='twod'):
+            data.tick()
+        assert standin.requests == [('GET', '/ip', None)]
+        assert "one: Rate limit reached, postponing request." in caplog.text
+        data.close()
+
+    def test_stale_first(self, caplog, standin, standin_config):
+        """Test that the longest outdated records are updated first."""
+        # Reading both records at startup leaves one request
+        cls = Twod(standin_config(general='origin_rate = 0.01\n'
+                                          'origin_burst = 3'))
+        data = _Data(cls.conf)
+        one, two = data.hosts
+        for host in data.hosts:
+            host.next_check = 0
+        two.stale_since = time() - 60
+        del standin.requests[:]
+        data.tick()
+        assert [r[1] for r in standin.requests if r[0] == 'PUT'] == [
+            '/hosts/two']
+        assert str(one.rec_ip) == '127.0.0.2'
+        assert str(two.rec_ip) == '127.0.0.3'
+        assert one.stale_since and two.stale_since is None
+        data.close()
@@ -0,0 +1,114 @@
+"""Tests for twod's resolver cache."""
+
+import asyncio
+import socket
+
+import mock
+import pytest
+from requests import Session
+from time import sleep
+
+from twod._aio import _AsyncHTTP
+from twod._resolver import _Resolver
+from twod._transport import _FamilyAdapter
+
+ADDRESSES = [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+              ('192.0.2.1', 443))]
+
+
+def _expire(resolver):
+    for entry in resolver.entries.values():
+        entry.expires = 0
+
+
+class TestResolver:
+    """Test caching of lookups."""
+
+    @mock.patch('twod._resolver.socket.getaddrinfo', return_value=ADDRESSES)
+    def test_cache(self, mock_getaddrinfo):
+        """Test that answers are cached until they expire."""
+        resolver = _Resolver(300, 30, 3600)
+        assert resolver.getaddrinfo('example.com', 443) == ADDRESSES
+        assert resolver.getaddrinfo('example.com', 443) == ADDRESSES
+        assert mock_getaddrinfo.call_count == 1
+        resolver.getaddrinfo('example.com', 443, socket.AF_INET6)
+        assert mock_getaddrinfo.call_count == 2
+
+        _expire(resolver)
+        assert resolver.getaddrinfo('example.com', 443) == ADDRESSES
+        assert mock_getaddrinfo.call_count == 3
+
+    @mock.patch('twod._resolver.socket.getaddrinfo',
+                side_effect=socket.gaierror(socket.EAI_NONAME, "Unknown"))
+    def test_negative(self, mock_getaddrinfo):
+        """Test that failed lookups are cached."""
+        resolver = _Resolver(300, 30, 3600)
+        for _ in range(2):
+            with pytest.raises(socket.gaierror):
+                resolver.getaddrinfo('example.invalid', 443)
+        assert mock_getaddrinfo.call_count == 1
+
+    @mock.patch('twod._resolver.socket.getaddrinfo', return_value=ADDRESSES)
+    def test_stale_if_error(self, mock_getaddrinfo, caplog):
+        """Test that expired answers are used while lookups fail."""
+        resolver = _Resolver(300, 30, 3600)
+        resolver.getaddrinfo('example.com', 443)
+        _expire(resolver)
+        mock_getaddrinfo.side_effect = socket.gaierror(socket.EAI_AGAIN,
+                                                       "Try again")
+        with caplog.at_level('INFO', logger='twod'):
+            assert resolver.getaddrinfo('example.com', 443) == ADDRESSES
+        assert "Looking up example.com failed" in caplog.text
+        # Not asked again until ``negative_ttl`` has passed
+        assert resolver.getaddrinfo('example.com', 443) == ADDRESSES
+        assert mock_getaddrinfo.call_count == 2
+
+        # Too old to be used
+        for entry in resolver.entries.values():
+            entry.expires = entry.stale_until = 0
+        with pytest.raises(socket.gaierror):
+            resolver.getaddrinfo('example.com', 443)
+
+    @mock.patch('twod._resolver._STALE_WAIT', 0.1)
+    @mock.patch('twod._resolver.socket.getaddrinfo', return_value=ADDRESSES)
+    def test_stale_if_slow(self, mock_getaddrinfo):
+        """Test that expired answers are used while lookups are slow."""
+        resolver = _Resolver(300, 30, 3600)
+        resolver.getaddrinfo('example.com', 443)
+        _expire(resolver)
+        fresh = [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                  ('192.0.2.2', 443))]
+
+        def slow(*args):
+            sleep(0.3)
+            return fresh
+        mock_getaddrinfo.side_effect = slow
+        assert resolver.getaddrinfo('example.com', 443) == ADDRESSES
+        assert resolver.getaddrinfo('example.com', 443) == ADDRESSES
+        sleep(0.4)
+        assert resolver.getaddrinfo('example.com', 443) == fresh
+        assert mock_getaddrinfo.call_count == 2
+
+    def test_transports(self, standin):
+        """Test that both HTTP clients resolve through the cache."""
+        resolver = _Resolver(300, 30, 3600)
+        url = standin.url.replace('127.0.0.1', 'localhost') + '/ip'
+        port = int(standin.url.rpartition(':')[2])
+        session = Session()
+        session.mount('http://', _FamilyAdapter(4, resolver))
+        try:
+            assert session.get(url, timeout=1).text == '127.0.0.3'
+        finally:
+            session.close()
+        assert list(resolver.entries) == [
+            ('localhost', port, socket.AF_INET, socket.SOCK_STREAM)]
+
+        client = _AsyncHTTP(0, 1, 0, resolver=resolver)
+
+        async def get():
+            try:
+                return (await client.get(url, timeout=1)).text
+            finally:
+                client.close()
+        assert asyncio.run(get()) == '127.0.0.3'
+        assert len(resolver.entries) == 2
@@ -0,0 +1,123 @@
+"""Tests for twod's scheduling of host checks."""
+
+import logging
+import threading
+
+from random import Random
+from time import time
+
+from twod.twod import Twod, _Data
+from twod._scheduler import _clock, _TimerWheel
+
+
+class TestScheduler:
+    """Test deadlines of host checks."""
+
+    def test_wheel(self):
+        """Test that items come due at their deadlines, however far out."""
+        deadlines = {}
+        wheel = _TimerWheel(deadlines.get, start=0)
+        rng = Random(1)
+        for item in range(500):
+            deadlines[item] = rng.uniform(0, rng.choice([100, 1e4, 1e8]))
+            wheel.add(deadlines[item], item)
+        # Rescheduled items only come due at their latest deadline
+        for item in range(0, 500, 10):
+            deadlines[item] += 50
+            wheel.add(deadlines[item], item)
+
+        popped = {}
+        while len(popped) < len(deadlines):
+            now = wheel.next_deadline()
+            assert now == min(deadline for item, deadline
+                              in deadlines.items() if item not in popped)
+            assert wheel.pop(now - 0.01) == []
+            for item in wheel.pop(now):
+                popped[item] = now
+        assert popped == deadlines
+        assert len(wheel) == 0
+        assert wheel.next_deadline() is None
+
+    def test_wheel_threads(self):
+        """Test that items added from other threads are not lost."""
+        deadlines = {}
+        wheel = _TimerWheel(deadlines.get, start=0)
+
+        def add(first):
+            for item in range(first, first + 2000):
+                deadlines[item] = item % 300 + 0.5
+                wheel.add(deadlines[item], item)
+
+        threads = [threading.Thread(target=add, args=(first,))
+                   for first in range(0, 8000, 2000)]
+        for thread in threads:
+            thread.start()
+        popped = []
+        now = 0
+        while any(thread.is_alive() for thread in threads):
+            wheel.next_deadline()
+            popped.extend(wheel.pop(now))
+            now += 0.25
+        for thread in threads:
+            thread.join()
+        popped.extend(wheel.pop(1000))
+        assert sorted(popped) == list(range(8000))
+
+    def test_ticks(self, caplog, monkeypatch, standin, standin_config):
+        """Test drift-free checks, splay and catching up after a suspend."""
+        clock = [_clock()]
+        monkeypatch.setattr('twod.twod._clock', lambda: clock[0])
+        data = _Data(Twod(standin_config(general='interval = 600')).conf)
+        start = clock[0]
+
+        def tick(seconds):
+            clock[0] += seconds
+            del standin.requests[:]
+            data.tick()
+            return [r[1] for r in standin.requests if r[0] == 'GET']
+
+        assert tick(0) == ['/ip']
+        assert [h.next_check for h in data.hosts] == [start + 600] * 2
+        # Late ticks do not push later checks back
+        assert tick(601.5) == ['/ip']
+        assert [h.next_check for h in data.hosts] == [start + 1200] * 2
+        assert data.next_delay() == 598.5
+
+        with caplog.at_level(logging.INFO, logger='twod'):
+            assert tick(1800) == ['/ip']
+            assert "Catching up on missed checks of 2 hosts." in caplog.text
+            assert [h.next_check for h in data.hosts] == [start + 3000] * 2
+
+            data.catch_up = 'skip'
+            assert tick(1800) == []
+            assert "Skipping missed checks of 2 hosts." in caplog.text
+            assert [h.next_check for h in data.hosts] == [start + 4800] * 2
+
+        data.splay = 30
+        assert tick(598.5) == ['/ip']
+        for host in data.hosts:
+            assert start + 5400 <= host.next_check <= start + 5430
+
+        # Catch-up checks are spread over ``splay`` seconds
+        data.catch_up = 'now'
+        assert tick(1800) == []
+        for host in data.hosts:
+            assert clock[0] <= host.next_check <= clock[0] + 30
+        assert tick(30) == ['/ip']
+        for host in data.hosts:
+            assert start + 7200 <= host.next_check <= start + 7230
+        data.close()
+
+    def test_clock_step(self, monkeypatch, standin, standin_config):
+        """Test that setting the system time does not age records."""
+        data = _Data(Twod(standin_config(
+            general='refresh_interval = 60')).conf)
+        host = data.hosts[0]
+        now = _clock()
+        for step in (-86400, 365 * 86400):
+            monkeypatch.setattr('twod.twod.time', lambda: time() + step)
+            assert not data._refresh_due(host, now + 30)
+            assert data._refresh_due(host, now + 61)
+            data._recorded(host, {None: host.rec_ip})
+            assert not data._refresh_due(host, _clock() + 30)
+        data.close()
@@ -0,0 +1,46 @@
+"""Tests for twod's external IP cache shared between processes."""
+
+from json import dumps
+from time import time
+
+from twod._ip import _parse_ip
+from twod.twod import Twod, _Data
+from twod._sharedcache import _SharedCache
+
+
+class TestSharedCache:
+    """Test sharing discovered IPs between instances."""
+
+    def test_load_publish(self, tmpdir):
+        """Test that published IPs are fresh for ``ttl`` seconds."""
+        path = tmpdir.join('ext_ip')
+        cache = _SharedCache(str(path), 60)
+        assert cache.load([None]) is None
+        cache.publish({4: '127.0.0.3'})
+        cache.publish({6: '::3'})
+        assert cache.load([4, 6]) == {4: '127.0.0.3', 6: '::3'}
+        assert cache.load([None]) is None
+
+        path.write(dumps({'4': ['127.0.0.3', time() - 61]}))
+        assert cache.load([4]) is None
+        path.write('garbage')
+        assert cache.load([4]) is None
+
+    def test_instances(self, tmpdir, standin, standin_config):
+        """Test that instances ask ip services only once between them."""
+        conf = Twod(standin_config(ip_service='shared_cache = %s' %
+                                   tmpdir.join('ext_ip'))).conf
+        one, two = _Data(conf), _Data(conf)
+        del standin.requests[:]
+        assert one._get_ext_ips() == {None: _parse_ip('127.0.0.3')}
+        assert two._get_ext_ips() == {None: _parse_ip('127.0.0.3')}
+        assert [r[1] for r in standin.requests] == ['/ip']
+
+        # Stale entries are discovered again
+        two.shared.ttl = 0
+        standin.ext_ip = '127.0.0.4'
+        assert two._get_ext_ips() == {None: _parse_ip('127.0.0.4')}
+        assert one._get_ext_ips() == {None: _parse_ip('127.0.0.4')}
+        assert [r[1] for r in standin.requests] == ['/ip', '/ip']
+        one.close()
+        two.close()
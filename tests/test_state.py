@@ -0,0 +1,75 @@
+"""Tests for twod's state file."""
+
+import mock
+import pytest
+
+from tests.mocks import response
+from twod.twod import Twod, _Data
+from twod._state import _StateFile
+
+
+@pytest.fixture
+def state_config_path(tmpdir, valid_config_path):
+    """Path to valid config with a state file."""
+    config = tmpdir.join('twodrc')
+    config.write(config.read().replace(
+        'timeout = 9000',
+        'timeout = 9000\nstate_file = %s' % tmpdir.join('state')))
+    return str(config)
+
+
+class TestState:
+    """Test state file handling."""
+
+    def test_save_load(self, tmpdir):
+        """Test that state survives a round trip."""
+        state = _StateFile(str(tmpdir.join('state')))
+        assert state.load() == {}
+        state.save({'one': {'rec_ip': '127.0.0.2'}})
+        state.save({'one': {'rec_ip': '127.0.0.3'}})
+        assert state.load() == {'one': {'rec_ip': '127.0.0.3'}}
+        # No temporary files are left behind
+        assert [p.basename for p in tmpdir.listdir()] == ['state']
+
+    def test_load_corrupt(self, tmpdir):
+        """Test that corrupt state files are rejected."""
+        tmpdir.join('state').write('[]')
+        with pytest.raises(ValueError):
+            _StateFile(str(tmpdir.join('state'))).load()
+
+    @mock.patch('twod.twod.Session.get')
+    def test_fast_start(self, mock_get, caplog, state_config_path):
+        """Test that saved recorded IPs are used at startup."""
+        conf = Twod(state_config_path).conf
+        mock_get.return_value = response(u'{"ip_address": "127.0.0.2"}')
+        _Data(conf)
+        assert mock_get.call_count == 1
+
+        mock_get.reset_mock()
+        data = _Data(conf)
+        assert str(data.rec_ip) == '127.0.0.2'
+        assert data.hosts[0].verify
+        assert not mock_get.called
+
+        # The saved IP is confirmed at the first check
+        mock_get.return_value = response('127.0.0.2')
+        with mock.patch.object(data, '_get_record',
+                               return_value={None: '127.0.0.2'}) as mock_rec:
+            data.tick()
+        assert mock_rec.called
+        assert not data.hosts[0].verify
+        assert str(data.hosts[0].ext_ip) == '127.0.0.2'
+
+    @mock.patch('twod.twod.Session.get')
+    def test_expired(self, mock_get, caplog, state_config_path):
+        """Test that saved recorded IPs expire after ``state_ttl``."""
+        conf = Twod(state_config_path).conf
+        mock_get.return_value = response(u'{"ip_address": "127.0.0.2"}')
+        data = _Data(conf)
+        data.hosts[0].rec_time -= conf['state_ttl']
+        data.dirty = True
+        data._save_state()
+
+        mock_get.reset_mock()
+        _Data(conf)
+        assert mock_get.call_count == 1
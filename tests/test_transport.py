@@ -0,0 +1,45 @@
+"""Tests for twod's HTTP transport."""
+
+import socket
+
+import pytest
+from requests import exceptions, Session
+
+from twod._transport import _FamilyAdapter, create_connection
+
+
+class TestTransport:
+    """Test family-bound connections."""
+
+    def test_create_connection(self):
+        """Test that only addresses of the bound family are tried."""
+        server = socket.socket(socket.AF_INET)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        address = server.getsockname()
+        try:
+            sock = create_connection(address, 1, ('0.0.0.0', 0))
+            assert sock.family == socket.AF_INET
+            sock.close()
+            with pytest.raises(OSError):
+                create_connection(address, 1, ('::', 0))
+        finally:
+            server.close()
+
+    def test_family_adapter(self, standin):
+        """Test sessions bound to one IP version."""
+        sessions = {}
+        for family in (None, 4, 6):
+            sessions[family] = Session()
+            sessions[family].mount('http://', _FamilyAdapter(family))
+        try:
+            for family in (None, 4):
+                response = sessions[family].get(standin.url + '/ip',
+                                                timeout=1)
+                assert response.text == '127.0.0.3'
+            # The stand-in only listens on IPv4
+            with pytest.raises(exceptions.ConnectionError):
+                sessions[6].get(standin.url + '/ip', timeout=1)
+        finally:
+            for session in sessions.values():
+                session.close()
@@ -0,0 +1,74 @@
+"""Tests for twod's worker processes."""
+
+from twod.twod import Twod
+from twod._workers import _Ring, _Supervisor
+
+
+class TestWorkers:
+    """Test sharding hosts across worker processes."""
+
+    def test_ring(self):
+        """Test that adding a worker only moves hosts to it."""
+        names = ['host%d' % i for i in range(1000)]
+        four, five = _Ring(4), _Ring(5)
+        moved = [name for name in names
+                 if four.worker(name) != five.worker(name)]
+        assert set(five.worker(name) for name in moved) == set([4])
+        assert 100 < len(moved) < 350
+        assert set(four.worker(name) for name in names) == set(range(4))
+
+    def test_once(self, standin, standin_config):
+        """Test that workers share one discovery and report results."""
+        cls = Twod(standin_config(general='workers = 2'))
+        del standin.requests[:]
+        assert cls.run_once() == 3
+        assert standin.records == {'one': '127.0.0.3', 'two': '127.0.0.3'}
+        assert [r[1] for r in standin.requests].count('/ip') == 1
+
+    def test_push(self, standin, standin_config):
+        """Test that a changed discovery makes the hosts of workers due."""
+        conf = Twod(standin_config()).conf
+        supervisor = _Supervisor(conf, 1)
+        supervisor._discover()
+        supervisor._start(0)
+        while not supervisor.reports[0]:
+            supervisor._receive(5)
+        assert standin.records == {'one': '127.0.0.3', 'two': '127.0.0.3'}
+
+        standin.ext_ip = '127.0.0.4'
+        supervisor._discover()
+        report = supervisor.reports[0]
+        while supervisor.reports[0] is report:
+            supervisor._receive(5)
+        assert standin.records == {'one': '127.0.0.4', 'two': '127.0.0.4'}
+        supervisor.close()
+
+    def test_restart(self, caplog, standin, standin_config):
+        """Test that restarted workers keep the state of their shard."""
+        conf = Twod(standin_config()).conf
+        supervisor = _Supervisor(conf, 1)
+        supervisor._discover()
+        supervisor._start(0)
+        while not supervisor.reports[0]:
+            supervisor._receive(5)
+        assert standin.records == {'one': '127.0.0.3', 'two': '127.0.0.3'}
+
+        supervisor.workers[0][0].terminate()
+        while supervisor.workers[0]:
+            supervisor._receive(5)
+        assert "Worker 0 exited with status -15" in caplog.text
+        assert supervisor.restart_at[0] > 0
+
+        # Records cannot be read, but the reported ones are kept
+        standin.statuses['/hosts/one'] = 503
+        standin.statuses['/hosts/two'] = 503
+        supervisor._start(0)
+        supervisor._receive(5)
+        state = supervisor.reports[0][0]
+        assert [state[name]['rec_ip'] for name in ('one', 'two')] == [
+            '127.0.0.3', '127.0.0.3']
+
+        metrics = supervisor.render()
+        assert 'twod_updates_total{host="one"} 1' in metrics
+        assert 'twod_ip_in_sync{family="4",host="two"} 1' in metrics
+        supervisor.close()
@@ -0,0 +1,513 @@
+"""asyncio engine for twod.
+
+Runs external IP discovery, record fetches and updates as coroutines, so a
+slow TwoDNS host only delays itself. HTTP is spoken by a small keep-alive
+client on top of asyncio streams. It raises the same ``requests`` exceptions
+as the default engine, so errors are handled and logged identically.
+
+"""
+
+import asyncio
+import socket
+import ssl
+
+from base64 import b64encode
+from time import monotonic, time
+from urllib.parse import urljoin, urlsplit
+
+from requests import exceptions
+from requests.structures import CaseInsensitiveDict
+
+from twod._scheduler import _clock
+from twod._version import __version__
+from twod.twod import _MAX_IP_BODY, _Data, _ResponseTooLarge, _endpoint
+
+_REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class _AsyncResponse(object):
+    """Response returned by :class:`_AsyncHTTP`."""
+
+    def __init__(self, url, status_code, reason, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        charset = 'utf-8'
+        for param in self.headers.get('content-type', '').split(';')[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.lower() == 'charset':
+                charset = value.strip('"\'')
+        try:
+            return self.content.decode(charset, 'replace')
+        except LookupError:
+            return self.content.decode('utf-8', 'replace')
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 500:
+            kind = 'Client'
+        elif 500 <= self.status_code < 600:
+            kind = 'Server'
+        else:
+            return
+        raise exceptions.HTTPError(
+            "%s %s Error: %s for url: %s" %
+            (self.status_code, kind, self.reason, self.url), response=self)
+
+
+def _check_size(size, max_size):
+    if max_size is not None and size > max_size:
+        raise _ResponseTooLarge("Response larger than %d bytes" % max_size)
+
+
+class _AsyncHTTP(object):
+    """Minimal HTTP/1.1 client with a keep-alive connection pool."""
+
+    def __init__(self, redirects, pool_size, keepalive, family=None,
+                 resolver=None):
+        self.redirects = redirects
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        # Only connect over this IP version if set
+        self.family = {4: socket.AF_INET, 6: socket.AF_INET6}.get(family, 0)
+        self.resolver = resolver
+        # (scheme, host, port) -> [(reader, writer, last_used)]
+        self.pools = {}
+        self.ssl = ssl.create_default_context()
+
+    async def get(self, url, auth=None, headers=None, timeout=None,
+                  max_size=None):
+        return await self.request('GET', url, auth=auth, headers=headers,
+                                  timeout=timeout, max_size=max_size)
+
+    async def put(self, url, auth=None, data=None, timeout=None):
+        return await self.request('PUT', url, auth=auth, data=data,
+                                  timeout=timeout)
+
+    async def request(self, method, url, auth=None, data=None, headers=None,
+                      timeout=None, max_size=None):
+        """Send request, following redirects.
+
+        ``headers`` are added to the default headers. ``timeout`` bounds the
+        whole exchange including redirects. Raises _ResponseTooLarge as soon
+        as the body turns out to be larger than ``max_size`` bytes.
+
+        """
+        try:
+            return await asyncio.wait_for(
+                self._request(method, url, auth, data, headers or {},
+                              max_size),
+                timeout)
+        except asyncio.TimeoutError:
+            raise exceptions.Timeout("Request to %s timed out" % url)
+        except (OSError, EOFError, ValueError) as e:
+            raise exceptions.ConnectionError(
+                "Request to %s failed: %s" % (url, e or type(e).__name__))
+
+    async def _request(self, method, url, auth, data, headers, max_size):
+        for _ in range(self.redirects + 1):
+            response = await self._send(method, url, auth, data, headers,
+                                        max_size)
+            location = response.headers.get('location')
+            if response.status_code not in _REDIRECTS or not location:
+                return response
+            new_url = urljoin(url, location)
+            if urlsplit(new_url).netloc != urlsplit(url).netloc:
+                # Never leak credentials to another host
+                auth = None
+            if response.status_code == 303:
+                method, data = 'GET', None
+            url = new_url
+        raise exceptions.TooManyRedirects(
+            "Exceeded %s redirects." % self.redirects)
+
+    async def _send(self, method, url, auth, data, headers, max_size,
+                    fresh=False):
+        parts = urlsplit(url)
+        https = parts.scheme == 'https'
+        origin = (parts.scheme, parts.hostname,
+                  parts.port or (443 if https else 80))
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        head = [
+            "%s %s HTTP/1.1" % (method, target),
+            "Host: %s" % parts.netloc.rpartition('@')[2],
+            "User-Agent: twod/%s" % __version__,
+            "Accept: */*",
+            "Connection: keep-alive",
+        ]
+        head += ["%s: %s" % header for header in headers.items()]
+        if auth:
+            token = b64encode(('%s:%s' % auth).encode('utf-8'))
+            head.append("Authorization: Basic %s" % token.decode('ascii'))
+        body = data.encode('utf-8') if isinstance(data, str) else data or b''
+        if data is not None or method in ('POST', 'PUT'):
+            head.append("Content-Length: %d" % len(body))
+        request = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+        reader, writer, reused = await self._acquire(origin, fresh)
+        try:
+            writer.write(request)
+            await writer.drain()
+            response, keep = await self._read_response(reader, method, url,
+                                                       max_size)
+        except (OSError, EOFError) as e:
+            writer.close()
+            if reused:
+                # The server dropped the idle connection; retry once
+                return await self._send(method, url, auth, data, headers,
+                                        max_size, fresh=True)
+            raise e
+        except BaseException:
+            writer.close()
+            raise
+        self._release(origin, reader, writer, keep)
+        return response
+
+    async def _acquire(self, origin, fresh):
+        """Get pooled connection or open a new one."""
+        pool = self.pools.setdefault(origin, [])
+        now = time()
+        while pool and not fresh:
+            reader, writer, last_used = pool.pop()
+            if (reader.at_eof() or writer.is_closing() or
+                    (self.keepalive and now - last_used > self.keepalive)):
+                writer.close()
+                continue
+            return reader, writer, True
+        scheme, host, port = origin
+        reader, writer = await self._connect(host, port, scheme == 'https')
+        return reader, writer, False
+
+    async def _connect(self, host, port, https):
+        tls = {'ssl': self.ssl if https else None,
+               'server_hostname': host if https else None}
+        if not self.resolver:
+            return await asyncio.open_connection(host, port,
+                                                 family=self.family, **tls)
+        # The resolver may block on a lookup
+        addresses = await asyncio.get_running_loop().run_in_executor(
+            None, self.resolver.getaddrinfo, host, port, self.family,
+            socket.SOCK_STREAM)
+        error = None
+        for af, _, _, _, sa in addresses:
+            try:
+                return await asyncio.open_connection(sa[0], sa[1], family=af,
+                                                     **tls)
+            except OSError as e:
+                error = e
+        raise error or OSError("getaddrinfo returned no addresses")
+
+    def _release(self, origin, reader, writer, keep):
+        pool = self.pools.setdefault(origin, [])
+        if keep and len(pool) < self.pool_size:
+            pool.append((reader, writer, time()))
+        else:
+            writer.close()
+
+    async def _read_response(self, reader, method, url, max_size=None):
+        """Read response with a body of at most ``max_size`` bytes.
+
+        Returns the response and whether the connection can be reused.
+
+        """
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b'', None)
+        version, status, reason = (
+            status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) +
+            [''])[:3]
+        if not version.startswith('HTTP/'):
+            raise ValueError("Malformed status line")
+        status = int(status)
+        headers = CaseInsensitiveDict()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip()] = value.strip()
+
+        keep = (version != 'HTTP/1.0' and
+                headers.get('connection', '').lower() != 'close')
+        if method == 'HEAD' or status in (204, 304) or status < 200:
+            content = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = await self._read_chunked(reader, max_size)
+        elif 'content-length' in headers:
+            size = int(headers['content-length'])
+            _check_size(size, max_size)
+            content = await reader.readexactly(size)
+        else:
+            content = await self._read_until_eof(reader, max_size)
+            keep = False
+        return _AsyncResponse(url, status, reason, headers, content), keep
+
+    async def _read_chunked(self, reader, max_size):
+        chunks = []
+        total = 0
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0], 16)
+            if not size:
+                # Skip trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            total += size
+            _check_size(total, max_size)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    async def _read_until_eof(self, reader, max_size):
+        chunks = []
+        total = 0
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                return b''.join(chunks)
+            total += len(chunk)
+            _check_size(total, max_size)
+            chunks.append(chunk)
+
+    def close(self):
+        """Close all pooled connections."""
+        for pool in self.pools.values():
+            for reader, writer, last_used in pool:
+                writer.close()
+        self.pools.clear()
+
+
+class _AsyncData(_Data):
+    """Asynchronous variant of :class:`twod.twod._Data`.
+
+    Shares parsing, validation and logging with the default engine; only the
+    network calls are coroutines. Call :meth:`start` before the first tick.
+
+    """
+
+    def _new_session(self, family=None):
+        return _AsyncHTTP(self.redirects, self.pool_size, self.keepalive,
+                          family, self.resolver)
+
+    def _get_session(self, family=None):
+        # Idle connections are evicted by the client itself
+        return self.sessions.get(family, self.session)
+
+    def _start(self):
+        """Recorded IPs are fetched by :meth:`start`."""
+
+    async def start(self):
+        """Fetch recorded IPs of hosts without a fresh saved state.
+
+        Requests run concurrently.
+
+        """
+        missing = self._schedule(self._restore_state())
+        records = await asyncio.gather(
+            *[self._get_record(host) for host in missing])
+        for host, record in zip(missing, records):
+            self._recorded(host, record)
+        self._save_state()
+
+    async def _verify(self, host):
+        record = await self._get_record(host)
+        if record:
+            self._refreshed(host, record)
+
+    async def _get_ext_ips(self):
+        cached = self._cached_ext_ips()
+        if cached:
+            return cached
+        ips = await asyncio.gather(
+            *[self._get_ext_ip(family) for family in self.families])
+        return self._cache_ext_ips(dict(zip(self.families, ips)))
+
+    async def _get_ext_ip(self, family=None):
+        return self._local_ip(family) or await self._poll_ext_ip(family)
+
+    async def _poll_ext_ip(self, family=None):
+        if self.gen.mode == 'race':
+            return await self._race_ext_ip(family)
+        url = self._get_service_url(family)
+        if url is None:
+            self.log.warning("Failed to fetch external IP: All IP services "
+                             "are unavailable")
+            return False
+        return await self._fetch_ext_ip(url, family)
+
+    async def _wait(self, timeout):
+        """Wait up to ``timeout`` seconds for an address change.
+
+        Returns early on commands of the control socket.
+
+        """
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        changed = []
+
+        def readable():
+            if self.monitor.changed():
+                changed.append(True)
+                woken.set()
+
+        if self.monitor:
+            loop.add_reader(self.monitor.fileno(), readable)
+        if self.wakeup:
+            loop.add_reader(self.wakeup.fileno(), woken.set)
+        try:
+            await asyncio.wait_for(woken.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if self.monitor:
+                loop.remove_reader(self.monitor.fileno())
+            if self.wakeup:
+                loop.remove_reader(self.wakeup.fileno())
+                self.wakeup.clear()
+        if not changed:
+            return
+        # Collect the rest of the burst
+        await asyncio.sleep(self.monitor.settle)
+        self.monitor.changed()
+        self._address_changed()
+
+    async def _race_ext_ip(self, family=None):
+        urls = self._race_urls(family)
+        deadline = monotonic() + self.timeout
+        pending = set()
+        try:
+            while urls or pending:
+                if urls:
+                    pending.add(asyncio.ensure_future(
+                        self._fetch_ext_ip(urls.pop(0), family)))
+                timeout = deadline - monotonic()
+                if urls:
+                    timeout = min(timeout, self.hedge_delay)
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0, timeout),
+                    return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result():
+                        return task.result()
+                if not done and not urls:
+                    self.log.warning("Failed to fetch external IP: No "
+                                     "service responded within %s seconds"
+                                     % self.timeout)
+                    return False
+            return False
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _fetch_ext_ip(self, url, family=None):
+        self.log.debug("Fetching external IP from %s..." %
+                       _endpoint(url, family))
+        start = monotonic()
+        try:
+            ip_request = await self._get_session(family).get(
+                url, timeout=self.timeout, max_size=_MAX_IP_BODY)
+            ip_request.raise_for_status()
+        except Exception as e:
+            self._record(url, start, False, 'ip_service', family)
+            return self._request_failed(e, 'ext')
+        ip = self._parse_ext_ip(ip_request.text, family)
+        self._record(url, start, bool(ip), 'ip_service', family)
+        return ip
+
+    async def _get_rec_ip(self, host=None):
+        record = await self._get_record(host)
+        return record and record[self.families[0]]
+
+    async def _get_record(self, host=None):
+        host = host or self.hosts[0]
+        if self._blocked(host.url) or not await self._throttle(host):
+            return False
+        self.log.debug("Fetching TwoDNS IP of %s..." % host.name)
+        start = monotonic()
+        try:
+            rec_request = await self.session.get(
+                host.url, auth=host.ident, headers=self._validators(host),
+                timeout=self.timeout)
+            rec_request.raise_for_status()
+        except Exception as e:
+            self._record(host.url, start, False, 'twodns_get')
+            return self._request_failed(e, 'rec', host)
+        record = self._read_record(rec_request, host)
+        self._record(host.url, start, record is not False, 'twodns_get')
+        return record
+
+    async def _throttle(self, host):
+        delay = self._reserve(host)
+        if delay:
+            await asyncio.sleep(delay)
+        return delay is not None
+
+    async def _update_ip(self, new_ip, host=None):
+        host = host or self.hosts[0]
+        if self._blocked(host.url) or not await self._throttle(host):
+            return False
+        self.log.debug("Updating recorded IP of %s..." % host.name)
+        self._journal(host, new_ip)
+        start = monotonic()
+        try:
+            rq = await self.session.put(
+                host.url, auth=host.ident, data=self._update_payload(new_ip),
+                timeout=self.timeout)
+            rq.raise_for_status()
+        except Exception as e:
+            self._record(host.url, start, False, 'twodns_put')
+            return self._request_failed(e, 'update', host)
+        self._record(host.url, start, True, 'twodns_put')
+        return self._updated(new_ip, host)
+
+    async def _check_host(self, host, ext_ips, now):
+        if self._refresh_due(host, now):
+            await self._verify(host)
+        ok = all(ext_ips.values())
+        changes = self._changes(host, ext_ips)
+        if changes:
+            ok = await self._update_ip(changes, host) and ok
+        self._checked(host, ok, now)
+
+    async def tick(self):
+        """Check all hosts that are due and update changed records.
+
+        Hosts are checked concurrently; each request has its own timeout.
+
+        """
+        now = _clock()
+        due = self._due_hosts(now)
+        if not due:
+            return
+        ext_ips = await self._get_ext_ips()
+        await asyncio.gather(*[self._check_host(host, ext_ips, now)
+                               for host in due])
+        self._save_state()
+
+    async def once(self):
+        """Check all hosts once."""
+        try:
+            await self.start()
+            await self.tick()
+        finally:
+            self.close()
+
+    async def run(self):
+        """Main loop."""
+        await self.start()
+        try:
+            while True:
+                start = monotonic()
+                await self.tick()
+                self.metrics.tick(monotonic() - start)
+                if self.monitor or self.wakeup:
+                    await self._wait(self.next_sleep())
+                else:
+                    await asyncio.sleep(self.next_sleep())
+        finally:
+            self.close()
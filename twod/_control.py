@@ -0,0 +1,162 @@
+"""Control socket of the twod daemon.
+
+The running daemon listens on a unix domain socket for one line commands
+like ``status`` or ``check-now HOST...`` and answers every command with a
+line of JSON. Commands that schedule work wake the main loop through a
+:class:`_Wakeup` pipe, so they take effect right away instead of after the
+current sleep.
+
+"""
+
+import os
+import socket
+import stat
+import threading
+
+from json import dumps, loads
+
+# Commands and their replies are short
+_MAX_LINE = 65536
+
+
+class _Wakeup(object):
+    """Pipe to wake a main loop waiting in ``select``."""
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+
+    def fileno(self):
+        return self.read_fd
+
+    def set(self):
+        """Wake the main loop."""
+        try:
+            os.write(self.write_fd, b'x')
+        except BlockingIOError:
+            # Already woken
+            pass
+
+    def clear(self):
+        """Drain pending wakeups."""
+        try:
+            while os.read(self.read_fd, 512):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+def _in_use(path):
+    """Return whether a running daemon listens on socket ``path``."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (IOError, OSError):
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+class _ControlServer(object):
+    """Serve commands on unix socket ``path`` in a background thread.
+
+    ``handle(command, args)`` returns the reply to ``command`` as dict.
+
+    """
+
+    def __init__(self, path, handle):
+        self.path = os.path.expanduser(path)
+        self.handle = handle
+        if os.path.lexists(self.path):
+            if not stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                raise IOError("Control socket '%s' is not a socket" %
+                              self.path)
+            if _in_use(self.path):
+                raise IOError("Control socket '%s' is in use" % self.path)
+            # Left behind by a daemon that did not exit cleanly
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Commands are only accepted from the user twod runs as; the socket
+        # is created with these permissions, so there is no window before a
+        # chmod
+        umask = os.umask(0o177)
+        try:
+            self.sock.bind(self.path)
+        except (IOError, OSError):
+            self.sock.close()
+            raise
+        finally:
+            os.umask(umask)
+        self.sock.listen(8)
+        self.thread = threading.Thread(target=self._serve,
+                                       name='twod-control')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                # Closed
+                return
+            with conn:
+                try:
+                    self._reply(conn)
+                except (IOError, OSError):
+                    pass
+
+    def _reply(self, conn):
+        conn.settimeout(5)
+        words = _read_line(conn).split()
+        if not words:
+            reply = {'error': "No command"}
+        else:
+            try:
+                reply = self.handle(words[0], words[1:])
+            except Exception as e:
+                reply = {'error': str(e)}
+        conn.sendall(dumps(reply).encode('utf-8') + b'\n')
+
+    def close(self):
+        """Stop serving and remove the socket."""
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def _read_line(sock):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+        if len(data) > _MAX_LINE:
+            raise IOError("Line too long")
+    return data.decode('utf-8', 'replace')
+
+
+def _request(path, command, args=(), timeout=30):
+    """Send ``command`` to the daemon listening on ``path``.
+
+    Returns the reply as dict.
+
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(os.path.expanduser(path))
+        sock.sendall((' '.join([command] + list(args)) + '\n').encode(
+            'utf-8'))
+        return loads(_read_line(sock))
+    finally:
+        sock.close()
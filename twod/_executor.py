@@ -0,0 +1,101 @@
+"""Bounded thread pool for the blocking calls of the sync engine.
+
+``requests`` blocks, so the sync engine runs independent calls, like the
+discovery of several families or the checks of several hosts, in a thread
+pool and a tick takes as long as its slowest call instead of all of them
+together. Threads cannot be killed, so tasks stop cooperatively: they call
+:meth:`_Executor.check` between requests, which raises once their deadline
+has passed or the pool is shutting down.
+
+"""
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import monotonic
+
+
+class _Cancelled(Exception):
+    """Raised in tasks past their deadline or at shutdown."""
+
+
+class _Executor(object):
+    """Thread pool of at most ``max_workers`` threads, started on demand."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.pool = None
+        self.closed = threading.Event()
+        # Futures not done yet, cancelled at shutdown
+        self.futures = set()
+        # Deadline of the task running in the current thread
+        self.local = threading.local()
+
+    def submit(self, func, *args, **kwargs):
+        """Run ``func(*args)`` in the pool. Returns a Future.
+
+        The task is cancelled ``timeout`` seconds after it started, so time
+        spent waiting for a free thread does not count.
+
+        """
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        future = self.pool.submit(self._run, kwargs.get('timeout'), func,
+                                  args)
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return future
+
+    def _run(self, timeout, func, args):
+        if timeout is not None:
+            self.local.deadline = monotonic() + timeout
+        try:
+            self.check()
+            return func(*args)
+        finally:
+            self.local.deadline = None
+
+    def check(self):
+        """Raise _Cancelled if the current task has to stop."""
+        if self.closed.is_set():
+            raise _Cancelled("Shutting down")
+        deadline = getattr(self.local, 'deadline', None)
+        if deadline is not None and monotonic() > deadline:
+            raise _Cancelled("Deadline exceeded")
+
+    def run_all(self, func, items, timeout, grace=0):
+        """Call ``func(item)`` for all ``items`` concurrently.
+
+        Every call is cancelled ``timeout`` seconds after it started. Calls
+        only stop at their next check, so they are waited for another
+        ``grace`` seconds, for as many rounds as the calls take with all
+        threads busy. Calls not started by then are dropped.
+        Returns ``(results, late, skipped)``: results in the order of
+        ``items``, None for cancelled calls and calls still running, the
+        number of calls still running and the items whose call never started.
+
+        """
+        futures = [self.submit(func, item, timeout=timeout)
+                   for item in items]
+        rounds = -(-len(futures) // self.max_workers)
+        done, late = wait(futures, rounds * (timeout + grace))
+        skipped = [item for item, future in zip(items, futures)
+                   if future in late and future.cancel()]
+        results = []
+        for future in futures:
+            if future in done and not future.cancelled():
+                try:
+                    results.append(future.result())
+                    continue
+                except _Cancelled:
+                    pass
+            results.append(None)
+        return results, len(late) - len(skipped), skipped
+
+    def shutdown(self, wait=False):
+        """Cancel all tasks, waiting for running ones to stop if ``wait``."""
+        self.closed.set()
+        for future in list(self.futures):
+            future.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait)
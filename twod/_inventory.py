@@ -0,0 +1,78 @@
+"""Host inventory files for twod.
+
+Large fleets of hosts are listed in an inventory file instead of
+``[host:NAME]`` sections. The file is read one line at a time, so apart from
+the compact state of every host nothing has to be kept in memory.
+
+"""
+
+import csv
+
+from json import loads
+
+_FIELDS = ('name', 'host_url', 'user', 'token', 'interval')
+
+
+class _Inventory(object):
+    """Host definitions in a JSONL or CSV inventory file.
+
+    Files ending in ``.csv`` need a header row naming the columns, other
+    files hold one JSON object per line. Only ``host_url`` is required;
+    ``user``, ``token`` and ``interval`` default to ``defaults`` and
+    ``name`` to the last path component of ``host_url``.
+
+    Iterating reads the file again and yields host definitions as accepted
+    by :class:`twod.twod._Host`. Raises ValueError for invalid entries.
+
+    """
+
+    def __init__(self, path, defaults, is_url):
+        self.path = path
+        self.defaults = defaults
+        self.is_url = is_url
+
+    def __iter__(self):
+        with open(self.path, 'r', newline='') as f:
+            if self.path.endswith('.csv'):
+                rows = csv.DictReader(f)
+                entries = ((rows.line_num, row) for row in rows)
+            else:
+                entries = self._json_lines(f)
+            for line, entry in entries:
+                try:
+                    if not isinstance(entry, dict):
+                        entry = loads(entry)
+                    yield self._host(entry)
+                except (TypeError, ValueError) as e:
+                    raise ValueError("%s:%d: Invalid host: %s" %
+                                     (self.path, line, e))
+
+    def _json_lines(self, f):
+        for line, text in enumerate(f, 1):
+            text = text.strip()
+            if text and not text.startswith('#'):
+                yield line, text
+
+    def _host(self, entry):
+        if not isinstance(entry, dict):
+            raise ValueError("Not an object")
+        # Surplus CSV columns end up under ``None``
+        unknown = set(str(field) for field in entry) - set(_FIELDS)
+        if unknown:
+            raise ValueError("Unknown fields: %s" % ', '.join(sorted(unknown)))
+        if not entry.get('host_url'):
+            raise ValueError("No host_url")
+        url = self.is_url(entry['host_url'])
+        host = {
+            'name': entry.get('name') or url.rstrip('/').rsplit('/', 1)[-1],
+            'url': url,
+        }
+        for field in ('user', 'token'):
+            host[field] = entry.get(field) or self.defaults[field]
+            if not host[field]:
+                raise ValueError("No %s" % field)
+        host['interval'] = float(entry.get('interval') or
+                                 self.defaults['interval'])
+        if host['interval'] <= 0:
+            raise ValueError("Invalid interval: '%s'" % host['interval'])
+        return host
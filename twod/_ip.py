@@ -0,0 +1,106 @@
+"""Canonical IP addresses for twod.
+
+IP services and TwoDNS do not agree on how to spell an address: IPv6 comes
+compressed or expanded, in upper or lower case, with zone IDs or as
+IPv4-mapped address. Addresses are therefore parsed once into their packed
+form, so spelling differences are never mistaken for a change of IP.
+
+"""
+
+from socket import inet_ntop, inet_pton, AF_INET, AF_INET6
+
+_V4_MAPPED = b'\0' * 10 + b'\xff' * 2
+
+# Address categories of :mod:`ipaddress` that can be rejected by name
+_CATEGORIES = ('private', 'reserved', 'loopback', 'link_local', 'multicast',
+               'unspecified')
+
+
+class _IP(bytes):
+    """IP address in packed form.
+
+    Addresses compare by their 4 or 16 bytes, never equal to strings; parse
+    those with :func:`_parse_ip` first. ``str()`` gives the canonical
+    spelling.
+
+    """
+
+    __slots__ = ()
+
+    @property
+    def version(self):
+        return 4 if len(self) == 4 else 6
+
+    def __str__(self):
+        return inet_ntop(AF_INET if len(self) == 4 else AF_INET6, self)
+
+    def __repr__(self):
+        return '_IP(%r)' % str(self)
+
+
+def _parse_ip(text, versions=(4, 6)):
+    """Parse textual IP address.
+
+    Zone IDs are dropped and IPv4-mapped IPv6 addresses are IPv4.
+    Returns _IP. Returns None if ``text`` is no IP address of one of the IP
+    ``versions``.
+
+    """
+    if not isinstance(text, str):
+        return None
+    try:
+        if ':' in text:
+            packed = inet_pton(AF_INET6, text.partition('%')[0])
+            if packed[:12] == _V4_MAPPED:
+                packed = packed[12:]
+        else:
+            packed = inet_pton(AF_INET, text)
+    except (OSError, UnicodeEncodeError, ValueError):
+        return None
+    ip = _IP(packed)
+    return ip if ip.version in versions else None
+
+
+def _is_policy(spec):
+    """Validate address policy ``spec``.
+
+    ``spec`` lists category names of :data:`_CATEGORIES` and networks in
+    CIDR notation, separated by whitespace or commas.
+    Returns the entries as tuple. Raises ValueError if one is invalid.
+
+    """
+    from ipaddress import ip_network
+
+    entries = tuple(spec.replace(',', ' ').split())
+    for entry in entries:
+        if entry in _CATEGORIES:
+            continue
+        try:
+            ip_network(entry)
+        except ValueError:
+            raise ValueError("Invalid reject: '%s'" % entry)
+    return entries
+
+
+class _Policy(object):
+    """Reject addresses in the categories and networks of a policy."""
+
+    def __init__(self, entries):
+        from ipaddress import ip_network
+
+        self.categories = [e for e in entries if e in _CATEGORIES]
+        self.networks = [ip_network(e) for e in entries
+                         if e not in _CATEGORIES]
+
+    def rejects(self, ip):
+        """Return the category or network ``ip`` is rejected by, or None."""
+        from ipaddress import ip_address
+
+        address = ip_address(bytes(ip))
+        for category in self.categories:
+            if getattr(address, 'is_' + category):
+                return category
+        for network in self.networks:
+            if address in network:
+                return str(network)
+        return None
@@ -0,0 +1,141 @@
+"""Update journal for twod.
+
+Every update is appended to the journal before it is sent to TwoDNS and
+again once TwoDNS confirmed it. Lines are handed to the operating system
+right away, so a restarted daemon knows which updates of a killed one went
+through and which may not have. Syncing them to disk is batched, once per
+tick. The state file holds confirmed updates as well, so once the journal
+grows long it is rewritten with only the unconfirmed ones.
+
+"""
+
+import os
+import threading
+
+from json import dumps, loads
+from time import time
+
+from twod._state import _replace
+
+# Lines written before the journal is compacted
+_COMPACT_AFTER = 1000
+
+
+class _Journal(object):
+    """Append-only journal of intended and confirmed updates.
+
+    The public methods hold ``lock``, as updates are sent from the threads of
+    the sync engine's pool.
+
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        self.fd = None
+        self.lines = 0
+        self.unsynced = False
+        # Host name -> latest update not confirmed yet
+        self.pending = {}
+
+    def replay(self):
+        """Return the latest update of every host, keyed by host name.
+
+        Updates are dicts with the ``url`` of the host, the ``record`` sent,
+        mapping TwoDNS fields to IPs, their ``time`` and ``done``, which is
+        True if TwoDNS confirmed the update. Torn lines left by a crash are
+        skipped.
+
+        """
+        with self.lock:
+            try:
+                with open(self.path, 'r') as f:
+                    lines = f.readlines()
+            except (IOError, OSError):
+                lines = []
+            return self._replay(lines)
+
+    def _replay(self, lines):
+        updates = {}
+        for line in lines:
+            try:
+                entry = loads(line)
+                name = entry['host']
+                if entry['op'] == 'update':
+                    updates[name] = dict(
+                        (key, entry[key]) for key in ('url', 'record', 'time'))
+                    updates[name]['done'] = False
+                elif entry['op'] == 'done' and name in updates:
+                    updates[name]['done'] = True
+            except (ValueError, TypeError, KeyError):
+                continue
+        self.lines = len(lines)
+        self.pending = dict((name, update) for name, update in updates.items()
+                            if not update['done'])
+        return updates
+
+    def intend(self, name, url, record):
+        """Note that ``record`` is about to be sent for host ``name``."""
+        update = {'url': url, 'record': record, 'time': time()}
+        with self.lock:
+            self._append(dict(update, op='update', host=name))
+            update['done'] = False
+            self.pending[name] = update
+
+    def confirm(self, name):
+        """Note that TwoDNS confirmed the latest update of host ``name``."""
+        with self.lock:
+            self._append({'op': 'done', 'host': name, 'time': time()})
+            self.pending.pop(name, None)
+
+    def _append(self, entry):
+        if self.fd is None:
+            self.fd = os.open(self.path,
+                              os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        # A single write, so concurrent readers never see half a line
+        os.write(self.fd, (dumps(entry) + '\n').encode('utf-8'))
+        self.lines += 1
+        self.unsynced = True
+
+    def sync(self):
+        """Flush appended lines to disk."""
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        if self.unsynced:
+            os.fsync(self.fd)
+            self.unsynced = False
+
+    def compact(self):
+        """Rewrite the journal with only unconfirmed updates.
+
+        Only call this once confirmed updates are saved elsewhere.
+
+        """
+        with self.lock:
+            lines = [dumps({'op': 'update', 'host': name,
+                            'url': update['url'], 'record': update['record'],
+                            'time': update['time']})
+                     for name, update in sorted(self.pending.items())]
+            self._close()
+            _replace(self.path, ''.join(line + '\n' for line in lines),
+                     '.twod-journal-')
+            self.lines = len(lines)
+
+    def compact_due(self):
+        """Whether the journal has grown long enough to be compacted."""
+        return self.lines >= _COMPACT_AFTER
+
+    def close(self):
+        """Sync and close the journal."""
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.fd is not None:
+            try:
+                self._sync()
+            finally:
+                os.close(self.fd)
+                self.fd = None
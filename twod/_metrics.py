@@ -0,0 +1,242 @@
+"""Prometheus metrics for twod.
+
+Recording only bumps counters in preallocated structures; all formatting
+happens when the metrics are scraped.
+
+"""
+
+import threading
+
+from bisect import bisect_left
+from time import time
+
+# Upper bounds of the latency histogram buckets in seconds
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+            30.0)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v))
+                             for k, v in sorted(labels.items()))
+
+
+class _Histogram(object):
+    """Latency histogram with fixed buckets."""
+
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        # The last slot counts values above the largest bucket
+        self.counts = [0] * (len(_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(_BUCKETS, value)] += 1
+        self.sum += value
+
+    def add(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+
+    def render(self, name, lines, **labels):
+        total = 0
+        for bound, count in zip(_BUCKETS + ('+Inf',), self.counts):
+            total += count
+            lines.append('%s_bucket%s %d' %
+                         (name, _labels(le=bound, **labels), total))
+        lines.append('%s_sum%s %r' % (name, _labels(**labels), self.sum))
+        lines.append('%s_count%s %d' % (name, _labels(**labels), total))
+
+
+class _Metrics(object):
+    """Counters and latency histograms collected by twod."""
+
+    def __init__(self):
+        # Only held for a few increments; scrapes copy under it
+        self.lock = threading.Lock()
+        # (kind, endpoint) -> [successes, failures]
+        self.requests = {}
+        # (kind, endpoint) -> _Histogram
+        self.durations = {}
+        self.ticks = _Histogram()
+        # Seconds of the last main loop iteration
+        self.last_tick = None
+        # host name -> number of updates
+        self.updates = {}
+        self.last_success = None
+
+    def __getstate__(self):
+        # Sent from worker processes to the supervisor
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def request(self, kind, endpoint, seconds, ok):
+        """Record request of ``kind`` to ``endpoint``.
+
+        ``kind`` is one of ``ip_service``, ``twodns_get`` or ``twodns_put``.
+        ``endpoint`` is an ip service or the TwoDNS API, so there are only a
+        few of them however many hosts there are.
+
+        """
+        key = (kind, endpoint)
+        with self.lock:
+            if key not in self.requests:
+                self.requests[key] = [0, 0]
+                self.durations[key] = _Histogram()
+            self.requests[key][0 if ok else 1] += 1
+            self.durations[key].observe(seconds)
+
+    def tick(self, seconds):
+        """Record duration of a main loop iteration."""
+        with self.lock:
+            self.ticks.observe(seconds)
+        self.last_tick = seconds
+
+    def checked(self):
+        """Record successful check of a host."""
+        self.last_success = time()
+
+    def updated(self, host):
+        """Record successful update of ``host``."""
+        with self.lock:
+            self.updates[host] = self.updates.get(host, 0) + 1
+
+    def add(self, other):
+        """Add the counts of metrics ``other`` to these."""
+        with self.lock:
+            for key, counts in other.requests.items():
+                if key not in self.requests:
+                    self.requests[key] = [0, 0]
+                    self.durations[key] = _Histogram()
+                self.requests[key][0] += counts[0]
+                self.requests[key][1] += counts[1]
+                self.durations[key].add(other.durations[key])
+            self.ticks.add(other.ticks)
+            for host, count in other.updates.items():
+                self.updates[host] = self.updates.get(host, 0) + count
+        if other.last_success is not None:
+            self.last_success = max(self.last_success or 0,
+                                    other.last_success)
+
+    def render(self, hosts=()):
+        """Return metrics in Prometheus text format."""
+        with self.lock:
+            requests = [(k, list(v)) for k, v in self.requests.items()]
+            durations = [(k, _copy(v)) for k, v in self.durations.items()]
+            ticks = _copy(self.ticks)
+            updates = list(self.updates.items())
+        lines = [
+            '# HELP twod_requests_total HTTP requests by endpoint and result.',
+            '# TYPE twod_requests_total counter',
+        ]
+        for (kind, endpoint), (ok, failed) in sorted(requests):
+            for result, count in (('success', ok), ('failure', failed)):
+                lines.append('twod_requests_total%s %d' % (_labels(
+                    kind=kind, endpoint=endpoint, result=result), count))
+        lines += [
+            '# HELP twod_request_duration_seconds HTTP request latency.',
+            '# TYPE twod_request_duration_seconds histogram',
+        ]
+        for (kind, endpoint), histogram in sorted(durations,
+                                                  key=lambda d: d[0]):
+            histogram.render('twod_request_duration_seconds', lines,
+                             kind=kind, endpoint=endpoint)
+        lines += [
+            '# HELP twod_tick_duration_seconds Duration of main loop '
+            'iterations.',
+            '# TYPE twod_tick_duration_seconds histogram',
+        ]
+        ticks.render('twod_tick_duration_seconds', lines)
+        lines += [
+            '# HELP twod_updates_total Successful updates by host.',
+            '# TYPE twod_updates_total counter',
+        ]
+        for host, count in sorted(updates):
+            lines.append('twod_updates_total%s %d' %
+                         (_labels(host=host), count))
+        if self.last_success is not None:
+            lines += [
+                '# HELP twod_seconds_since_last_successful_check Seconds '
+                'since a host was last checked successfully.',
+                '# TYPE twod_seconds_since_last_successful_check gauge',
+                'twod_seconds_since_last_successful_check %r' %
+                (time() - self.last_success),
+            ]
+        lines += [
+            '# HELP twod_ip_in_sync Whether the recorded IP matches the '
+            'discovered IP.',
+            '# TYPE twod_ip_in_sync gauge',
+        ]
+        # IPs are no labels, every change would start new series
+        for host in hosts:
+            pairs = [(4, host.rec_ip, host.ext_ip)]
+            if host.rec_ip6 or host.ext_ip6:
+                pairs.append((6, host.rec_ip6, host.ext_ip6))
+            for family, recorded, discovered in pairs:
+                lines.append('twod_ip_in_sync%s %d' % (
+                    _labels(host=host.name, family=family),
+                    bool(recorded) and recorded == discovered))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, address, hosts):
+        """Serve metrics on ``address`` in a background thread.
+
+        Returns the server.
+
+        """
+        return _serve(address, lambda: self.render(hosts))
+
+
+def _serve(address, render):
+    """Serve the text returned by ``render`` on ``address``.
+
+    Runs in a background thread. Returns the server.
+
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socket import AF_INET6
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    class Server(HTTPServer):
+        if ':' in address[0]:
+            address_family = AF_INET6
+
+    server = Server(address, Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _copy(histogram):
+    copy = _Histogram()
+    copy.counts = list(histogram.counts)
+    copy.sum = histogram.sum
+    return copy
@@ -0,0 +1,170 @@
+"""rtnetlink address monitor for twod.
+
+Reads the addresses of a network interface from the kernel and listens for
+address change notifications (``RTM_NEWADDR``/``RTM_DELADDR``), so changes of
+a public address bound to a local interface are noticed right away instead
+of at the next refresh. Linux only.
+
+"""
+
+import socket
+
+from select import select
+from struct import calcsize, pack, unpack_from
+from time import monotonic
+
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_FLAGS = 8
+# Secondary IPv4 and temporary IPv6 privacy addresses share a flag
+IFA_F_SECONDARY = IFA_F_TEMPORARY = 0x01
+IFA_F_DADFAILED = 0x08
+IFA_F_DEPRECATED = 0x20
+IFA_F_TENTATIVE = 0x40
+# Addresses that are not usable or change too often to be published
+_IFA_F_SKIP = (IFA_F_TEMPORARY | IFA_F_DADFAILED | IFA_F_DEPRECATED |
+               IFA_F_TENTATIVE)
+RT_SCOPE_UNIVERSE = 0
+
+_NLMSGHDR = '=LHHLL'
+_IFADDRMSG = '=BBBBI'
+_RTATTR = '=HH'
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def parse_addresses(data):
+    """Parse rtnetlink address messages.
+
+    Yields ``(type, family, index, address)`` for every global, usable
+    address. ``address`` is ``None`` for other messages and for secondary
+    IPv4 and temporary IPv6 addresses, which rotate.
+
+    """
+    offset = 0
+    while offset + calcsize(_NLMSGHDR) <= len(data):
+        length, kind, flags, seq, pid = unpack_from(_NLMSGHDR, data, offset)
+        if length < calcsize(_NLMSGHDR):
+            break
+        if kind in (RTM_NEWADDR, RTM_DELADDR):
+            yield (kind,) + _parse_ifaddr(
+                data, offset + calcsize(_NLMSGHDR), offset + length)
+        else:
+            yield kind, None, None, None
+        offset += _align(length)
+
+
+def _parse_ifaddr(data, start, end):
+    family, prefixlen, flags, scope, index = unpack_from(
+        _IFADDRMSG, data, start)
+    attrs = {}
+    offset = start + calcsize(_IFADDRMSG)
+    while offset + calcsize(_RTATTR) <= end:
+        length, kind = unpack_from(_RTATTR, data, offset)
+        if length < calcsize(_RTATTR):
+            break
+        attrs[kind] = data[offset + calcsize(_RTATTR):offset + length]
+        offset += _align(length)
+    if IFA_FLAGS in attrs:
+        flags = unpack_from('=L', attrs[IFA_FLAGS])[0]
+    # IFA_ADDRESS is the peer address on point-to-point links
+    raw = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+    if (raw is None or scope != RT_SCOPE_UNIVERSE or
+            flags & _IFA_F_SKIP or
+            family not in (socket.AF_INET, socket.AF_INET6)):
+        return family, index, None
+    return family, index, socket.inet_ntop(family, raw)
+
+
+class _AddressMonitor(object):
+    """Watch the global addresses of ``interface``."""
+
+    # Address changes come in bursts; wait this long for the rest of them
+    settle = 0.05
+
+    def __init__(self, interface):
+        self.index = socket.if_nametoindex(interface)
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                  socket.NETLINK_ROUTE)
+        self.sock.bind((0, RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+        self.sock.setblocking(False)
+        self.seq = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def addresses(self):
+        """Return global addresses of the interface.
+
+        IPv4 comes first, otherwise the kernel's order is kept, which lists
+        the primary address of every family first.
+
+        """
+        self.seq += 1
+        request = pack(_NLMSGHDR, calcsize(_NLMSGHDR) + calcsize(_IFADDRMSG),
+                       RTM_GETADDR, NLM_F_REQUEST | NLM_F_DUMP, self.seq, 0)
+        request += pack(_IFADDRMSG, socket.AF_UNSPEC, 0, 0, 0, 0)
+        found = []
+        # Use a separate socket so the dump does not mix with notifications
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                           socket.NETLINK_ROUTE) as sock:
+            sock.settimeout(1)
+            sock.sendto(request, (0, 0))
+            while True:
+                for kind, family, index, address in parse_addresses(
+                        sock.recv(65536)):
+                    if kind in (NLMSG_DONE, NLMSG_ERROR):
+                        found.sort(key=lambda item: item[0])
+                        return [a for f, a in found]
+                    if address and index == self.index:
+                        found.append((family != socket.AF_INET, address))
+
+    def changed(self):
+        """Drain pending notifications.
+
+        Returns whether any of them concerns the interface.
+
+        """
+        changed = False
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return changed
+            for kind, family, index, address in parse_addresses(data):
+                if kind in (RTM_NEWADDR, RTM_DELADDR) and index == self.index:
+                    changed = True
+
+    def wait(self, timeout, wakeup=None):
+        """Wait up to ``timeout`` seconds for an address change.
+
+        Returns whether the addresses of the interface changed. Returns
+        early once ``wakeup``, a file descriptor, becomes readable.
+
+        """
+        deadline = monotonic() + timeout
+        fds = [self.sock] + ([wakeup] if wakeup else [])
+        while True:
+            remaining = max(0, deadline - monotonic())
+            readable = select(fds, [], [], remaining)[0]
+            if self.sock not in readable:
+                return False
+            if self.changed():
+                # Collect the rest of the burst
+                while select([self.sock], [], [], self.settle)[0]:
+                    self.changed()
+                return True
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,129 @@
+"""Rate limits for TwoDNS API calls.
+
+Requests are limited by token buckets per API origin and per account, so a
+fleet of hosts changing IP at the same moment does not get throttled.
+``429 Too Many Requests`` answers pause the bucket of the account for as long
+as the ``Retry-After`` header asks.
+
+"""
+
+import threading
+
+from time import monotonic, time
+
+
+def _retry_after(value):
+    """Seconds to wait according to ``Retry-After`` header ``value``.
+
+    Returns None if ``value`` is missing or invalid.
+
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    from email.utils import parsedate_to_datetime
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+class _TokenBucket(object):
+    """Allow ``rate`` requests per second in bursts of up to ``burst``.
+
+    A ``rate`` of 0 does not limit requests, but the bucket can still be
+    paused. Tokens are reserved ahead of time, so concurrent requests queue
+    up behind each other instead of all waiting for the same token.
+
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'paused_until')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now):
+        """Seconds until the next request may be sent."""
+        if self.rate:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+        else:
+            wait = 0.0
+        return max(wait, self.paused_until - now)
+
+    def take(self):
+        """Reserve a token."""
+        self.tokens -= 1
+
+    def pause(self, seconds, now):
+        """Send no requests for ``seconds``."""
+        self.paused_until = max(self.paused_until, now + seconds)
+
+
+class _RateLimiter(object):
+    """Token buckets per API origin and per account.
+
+    Safe to share between threads.
+
+    """
+
+    def __init__(self, origin_rate, origin_burst, account_rate, account_burst):
+        self.lock = threading.Lock()
+        self.limits = {
+            'origin': (origin_rate, origin_burst),
+            'account': (account_rate, account_burst),
+        }
+        # (kind, origin or account) -> _TokenBucket
+        self.buckets = {}
+
+    def _buckets(self, keys):
+        buckets = []
+        for key in keys:
+            if key not in self.buckets:
+                self.buckets[key] = _TokenBucket(*self.limits[key[0]])
+            buckets.append(self.buckets[key])
+        return buckets
+
+    def delay(self, keys):
+        """Seconds until a request limited by ``keys`` may be sent.
+
+        ``keys`` are ``(kind, name)`` tuples, ``kind`` being ``origin`` or
+        ``account``.
+
+        """
+        with self.lock:
+            now = monotonic()
+            return max(bucket.delay(now) for bucket in self._buckets(keys))
+
+    def reserve(self, keys, max_wait):
+        """Reserve a request limited by ``keys``.
+
+        Returns seconds to wait before sending it. Returns None, reserving
+        nothing, if that would be longer than ``max_wait``.
+
+        """
+        with self.lock:
+            now = monotonic()
+            buckets = self._buckets(keys)
+            wait = max(bucket.delay(now) for bucket in buckets)
+            if wait > max_wait:
+                return None
+            for bucket in buckets:
+                bucket.take()
+            return wait
+
+    def pause(self, keys, seconds):
+        """Send no requests limited by any of ``keys`` for ``seconds``."""
+        with self.lock:
+            now = monotonic()
+            for bucket in self._buckets(keys):
+                bucket.pause(seconds, now)
@@ -0,0 +1,129 @@
+"""Resolver cache for twod.
+
+Looking up the names of ip services and TwoDNS through ``getaddrinfo`` can
+block for seconds while the local resolver is struggling, typically right
+after the ISP reconnected. Answers are therefore kept for ``ttl`` seconds and
+failures for ``negative_ttl`` seconds. Once an answer has expired it is still
+used for up to ``stale_ttl`` seconds while lookups fail or take too long.
+
+"""
+
+import logging
+import socket
+import threading
+
+from time import monotonic
+
+# Seconds to wait for a lookup before falling back to an expired answer
+_STALE_WAIT = 1.0
+
+
+class _Entry(object):
+    """Cached answer or failure of a lookup."""
+
+    __slots__ = ('addresses', 'error', 'expires', 'stale_until', 'lookup')
+
+    def __init__(self, addresses, error, expires, stale_until):
+        self.addresses = addresses
+        self.error = error
+        self.expires = expires
+        self.stale_until = stale_until
+        # Event set once a running lookup refreshing this entry is done
+        self.lookup = None
+
+
+class _Resolver(object):
+    """Caching wrapper around :func:`socket.getaddrinfo`.
+
+    ``getaddrinfo`` does not report the TTL of DNS records, so answers are
+    kept for a fixed ``ttl``.
+
+    """
+
+    def __init__(self, ttl, negative_ttl, stale_ttl):
+        self.log = logging.getLogger('twod')
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.lock = threading.Lock()
+        # (host, port, family, type) -> _Entry
+        self.entries = {}
+
+    def getaddrinfo(self, host, port, family=0, type=0):
+        """Resolve ``host`` like :func:`socket.getaddrinfo`.
+
+        Expired answers are refreshed in the background; they are used if
+        that takes longer than ``_STALE_WAIT`` seconds or fails.
+        Raises socket.gaierror if there is no usable answer.
+
+        """
+        key = (host, port, family, type)
+        with self.lock:
+            entry = self.entries.get(key)
+            now = monotonic()
+            if entry and now < entry.expires:
+                return _answer(entry)
+            if not (entry and entry.addresses and now < entry.stale_until):
+                entry = None
+            elif not entry.lookup:
+                entry.lookup = threading.Event()
+                thread = threading.Thread(target=self._refresh,
+                                          args=(key, entry.lookup))
+                thread.daemon = True
+                thread.start()
+            lookup = entry and entry.lookup
+        if not entry:
+            return self._lookup(key)
+        lookup.wait(_STALE_WAIT)
+        with self.lock:
+            current = self.entries[key]
+            if monotonic() < current.expires:
+                return _answer(current)
+        self.log.info("Looking up %s takes too long, using expired addresses."
+                      % host)
+        return entry.addresses
+
+    def _lookup(self, key):
+        """Resolve ``key`` and cache the outcome.
+
+        Failures keep expired addresses that are still usable.
+
+        """
+        try:
+            addresses = socket.getaddrinfo(*key)
+        except socket.gaierror as e:
+            now = monotonic()
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and entry.addresses and now < entry.stale_until:
+                    entry.expires = now + self.negative_ttl
+                    self.log.info("Looking up %s failed, using expired "
+                                  "addresses: %s" % (key[0], e))
+                    return entry.addresses
+                self.entries[key] = _Entry(None, e.args,
+                                           now + self.negative_ttl, 0)
+            raise
+        expires = monotonic() + self.ttl
+        with self.lock:
+            self.entries[key] = _Entry(addresses, None, expires,
+                                       expires + self.stale_ttl)
+        return addresses
+
+    def _refresh(self, key, lookup):
+        try:
+            self._lookup(key)
+        except socket.gaierror:
+            pass
+        finally:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and entry.lookup is lookup:
+                    entry.lookup = None
+            lookup.set()
+
+
+def _answer(entry):
+    """Return cached addresses or raise cached failure of ``entry``."""
+    if entry.error:
+        raise socket.gaierror(*entry.error)
+    return entry.addresses
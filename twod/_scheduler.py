@@ -0,0 +1,176 @@
+"""Deadlines of host checks.
+
+Checks are scheduled on :func:`_clock`, which is not affected when the wall
+clock is set but, unlike :func:`time.monotonic`, keeps counting while the
+machine is suspended, so checks missed during a suspend come due right after
+it. Hosts wait for their next check in a :class:`_TimerWheel`, so finding the
+hosts due at a tick does not look at all the others.
+
+"""
+
+import threading
+
+from time import time
+
+try:
+    from time import CLOCK_BOOTTIME, clock_gettime
+except ImportError:
+    # Not Linux; suspended time is not counted
+    from time import monotonic as _elapsed
+else:
+    def _elapsed():
+        return clock_gettime(CLOCK_BOOTTIME)
+
+# Deadlines are kept on the scale of the wall clock at startup, so they can be
+# compared with the timestamps of the state file
+_OFFSET = time() - _elapsed()
+
+# Sleeps do not count suspended time; waking up at least this often notices
+# checks missed during a suspend
+_MAX_SLEEP = 60.0
+
+
+def _clock():
+    """Seconds since the epoch, counting on steadily when the clock is set."""
+    return _elapsed() + _OFFSET
+
+
+class _TimerWheel(object):
+    """Hierarchical timer wheel of items and their deadlines.
+
+    Level 0 has ``slots`` buckets of ``resolution`` seconds, every further
+    level ``slots`` buckets as long as a whole turn of the level below.
+    Deadlines further out wait in an overflow list. Items move down at most
+    once per level before they come due.
+
+    Rescheduled items are not searched for: ``key(item)`` returns the current
+    deadline of an item and entries with another deadline are dropped.
+
+    The public methods hold ``lock``, as checks and the control socket
+    reschedule hosts from other threads than the main loop.
+
+    """
+
+    def __init__(self, key, resolution=1.0, slots=64, levels=4, start=None):
+        self.key = key
+        self.lock = threading.Lock()
+        self.resolution = resolution
+        self.slots = slots
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        # Number of entries on each level
+        self.counts = [0] * levels
+        self.overflow = []
+        # Entries of ticks already reached
+        self.ready = []
+        self.current = self._tick(_clock() if start is None else start)
+
+    def _tick(self, deadline):
+        return int(deadline // self.resolution)
+
+    def _valid(self, entry):
+        return self.key(entry[1]) == entry[0]
+
+    def add(self, deadline, item):
+        """Schedule ``item`` at ``deadline``."""
+        with self.lock:
+            self._insert((deadline, item))
+
+    def _insert(self, entry):
+        tick = self._tick(entry[0])
+        if tick <= self.current:
+            self.ready.append(entry)
+            return
+        span = 1
+        for level, wheel in enumerate(self.wheels):
+            if tick // span - self.current // span < self.slots:
+                wheel[tick // span % self.slots].append(entry)
+                self.counts[level] += 1
+                return
+            span *= self.slots
+        self.overflow.append(entry)
+
+    def _cascade(self, level):
+        """Move entries of the current bucket of ``level`` down."""
+        wheel = self.wheels[level]
+        index = self.current // self.slots ** level % self.slots
+        entries, wheel[index] = wheel[index], []
+        self.counts[level] -= len(entries)
+        for entry in entries:
+            self._insert(entry)
+
+    def _advance(self, target):
+        """Turn the wheel to tick ``target``."""
+        top = self.slots ** len(self.wheels)
+        while self.current < target:
+            # Skip the buckets of empty levels
+            step = 1
+            for count in self.counts:
+                if count:
+                    break
+                step *= self.slots
+            self.current = min(target, (self.current // step + 1) * step)
+            if self.current % top == 0:
+                entries, self.overflow = self.overflow, []
+                for entry in entries:
+                    self._insert(entry)
+            for level in reversed(range(len(self.wheels))):
+                if self.current % self.slots ** level == 0:
+                    self._cascade(level)
+
+    def pop(self, now):
+        """Remove and return items due at ``now``, earliest first."""
+        with self.lock:
+            return self._pop(now)
+
+    def _pop(self, now):
+        self._advance(self._tick(now))
+        due = []
+        ready = []
+        for entry in self.ready:
+            if not self._valid(entry):
+                continue
+            (due if entry[0] <= now else ready).append(entry)
+        self.ready = ready
+        due.sort(key=lambda entry: entry[0])
+        seen = set()
+        items = []
+        for deadline, item in due:
+            if id(item) not in seen:
+                seen.add(id(item))
+                items.append(item)
+        return items
+
+    def next_deadline(self):
+        """Earliest deadline of all items, None without items."""
+        with self.lock:
+            return self._next_deadline()
+
+    def _next_deadline(self):
+        self.ready = [entry for entry in self.ready if self._valid(entry)]
+        deadlines = [entry[0] for entry in self.ready]
+        span = 1
+        for level, wheel in enumerate(self.wheels):
+            base = self.current // span
+            # Later buckets of a level hold later deadlines
+            for i in range(1, self.slots):
+                if not self.counts[level]:
+                    break
+                index = (base + i) % self.slots
+                entries = [entry for entry in wheel[index]
+                           if self._valid(entry)]
+                self.counts[level] -= len(wheel[index]) - len(entries)
+                wheel[index] = entries
+                if entries:
+                    deadlines.append(min(entry[0] for entry in entries))
+                    break
+            span *= self.slots
+        self.overflow = [entry for entry in self.overflow
+                         if self._valid(entry)]
+        deadlines.extend(entry[0] for entry in self.overflow)
+        return min(deadlines) if deadlines else None
+
+    def __len__(self):
+        """Number of entries, including ones of rescheduled items."""
+        with self.lock:
+            return (len(self.ready) + sum(self.counts) +
+                    len(self.overflow))
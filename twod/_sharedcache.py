@@ -0,0 +1,78 @@
+"""External IP cache shared by twod processes on one machine.
+
+Instances with different accounts or configurations would each ask the ip
+services for the same address. Instead they share discoveries through a
+small JSON file: every instance publishes what it discovered with a
+timestamp and reads the file before asking the services itself. Readers
+hold a shared and writers an exclusive ``flock`` on the file, so nobody
+sees it half written.
+
+"""
+
+import fcntl
+import os
+
+from json import dumps, loads
+from time import time
+
+
+def _key(family):
+    return 'any' if family is None else str(family)
+
+
+def _entries(text):
+    try:
+        entries = loads(text)
+    except ValueError:
+        return {}
+    return entries if isinstance(entries, dict) else {}
+
+
+class _SharedCache(object):
+    """IPs of every address family with the time they were discovered."""
+
+    def __init__(self, path, ttl):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+
+    def _open(self):
+        return os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644),
+                         'r+')
+
+    def load(self, families):
+        """Return dict mapping ``families`` to IPs as strings.
+
+        Returns None unless every family was discovered less than ``ttl``
+        seconds ago.
+
+        """
+        with self._open() as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            entries = _entries(f.read())
+        now = time()
+        ips = {}
+        for family in families:
+            try:
+                ip, stamp = entries[_key(family)]
+                if not 0 <= now - stamp < self.ttl:
+                    return None
+            except (KeyError, TypeError, ValueError):
+                return None
+            ips[family] = ip
+        return ips
+
+    def publish(self, ips):
+        """Record ``ips``, a dict mapping families to IPs, as discovered now.
+
+        Entries of other families are kept.
+
+        """
+        with self._open() as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            entries = _entries(f.read())
+            now = time()
+            for family, ip in ips.items():
+                entries[_key(family)] = [str(ip), now]
+            f.seek(0)
+            f.truncate()
+            f.write(dumps(entries))
@@ -0,0 +1,66 @@
+"""Persistent state file for twod.
+
+Keeps the last recorded and discovered IP of every host across restarts so
+the daemon does not have to wait for TwoDNS before it is ready.
+
+"""
+
+import os
+
+from json import dumps, load
+from tempfile import NamedTemporaryFile
+
+_VERSION = 1
+
+
+class _StateFile(object):
+    """JSON state file that is replaced atomically on every write."""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def load(self):
+        """Return saved state of all hosts, keyed by host name.
+
+        Returns an empty dict if there is no usable state file.
+        Raises ValueError if the state file is corrupt.
+
+        """
+        try:
+            with open(self.path, 'r') as f:
+                state = load(f)
+        except (IOError, OSError):
+            return {}
+        if not isinstance(state, dict) or state.get('version') != _VERSION:
+            raise ValueError("Unsupported state file format")
+        return state['hosts']
+
+    def save(self, hosts):
+        """Write state of ``hosts``, a dict keyed by host name.
+
+        The new state is written to a temporary file which then replaces the
+        old one, so readers never see a partially written file.
+
+        """
+        _replace(self.path, dumps({'version': _VERSION, 'hosts': hosts}),
+                 '.twod-state-')
+
+
+def _replace(path, text, prefix):
+    """Atomically replace file ``path`` by ``text`` and sync it to disk."""
+    directory = os.path.dirname(path) or '.'
+    with NamedTemporaryFile('w', dir=directory, prefix=prefix,
+                            delete=False) as f:
+        try:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
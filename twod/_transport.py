@@ -0,0 +1,237 @@
+"""HTTP transport for twod.
+
+Connections made by :class:`_FamilyAdapter` can be bound to one IP version,
+so the IPv4 and the IPv6 address of a dual-stack link are each discovered by
+asking the IP service over that protocol. Server names can be resolved
+through a :class:`twod._resolver._Resolver`. Requests made within
+:func:`deadline` are bounded as a whole, not just per socket operation.
+Imported on first use since it pulls in ``requests``.
+
+"""
+
+import io
+import socket
+import threading
+
+from contextlib import contextmanager
+from http.client import HTTPResponse
+from time import monotonic
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import (ConnectTimeoutError, NewConnectionError,
+                                ReadTimeoutError)
+from urllib3.util.retry import Retry
+
+# The classes below override urllib3 internals: ``_new_conn`` and
+# ``_dns_host`` of connections, ``response_class`` of http.client
+# connections, ``ConnectionCls`` of pools and ``pool_classes_by_scheme`` of
+# pool managers. They were checked against urllib3 1.26.20 and 2.8.0.
+
+# Binding to the wildcard address of a family restricts a socket to that
+# family. The source address is part of urllib3's pool key, so pools of
+# different families never share connections.
+_ANY_ADDRESS = {4: ('0.0.0.0', 0), 6: ('::', 0)}
+
+# Deadline of the requests made in the current thread
+_local = threading.local()
+
+
+@contextmanager
+def deadline(when):
+    """Bound requests made in this thread by ``when``.
+
+    ``when`` is a :func:`time.monotonic` timestamp. Connecting and every
+    read of the answer, headers included, only get the time left before it,
+    so a server trickling bytes cannot hold a request open.
+
+    """
+    previous = getattr(_local, 'deadline', None)
+    _local.deadline = when
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def _remaining(timeout):
+    """Shorten socket ``timeout`` to the time left before the deadline.
+
+    Raises socket.timeout once the deadline has passed.
+
+    """
+    when = getattr(_local, 'deadline', None)
+    if when is None:
+        return timeout
+    remaining = when - monotonic()
+    if remaining <= 0:
+        raise socket.timeout("Deadline exceeded")
+    if isinstance(timeout, (int, float)):
+        return min(timeout, remaining)
+    return remaining
+
+
+def _family(source_address):
+    """Socket address family implied by ``source_address``."""
+    if not source_address:
+        return socket.AF_UNSPEC
+    return socket.AF_INET6 if ':' in source_address[0] else socket.AF_INET
+
+
+def create_connection(address, timeout=None, source_address=None,
+                      socket_options=None, resolver=None):
+    """Connect to ``(host, port)`` and return the socket.
+
+    Only addresses of the family of ``source_address`` are resolved and
+    tried, so an IPv4-bound connection never ends up on IPv6 or vice versa.
+    Names are resolved with ``resolver`` if given.
+
+    """
+    host, port = address
+    timeout = _remaining(timeout)
+    err = None
+    getaddrinfo = resolver.getaddrinfo if resolver else socket.getaddrinfo
+    for af, socktype, proto, _, sa in getaddrinfo(
+            host.strip('[]'), port, _family(source_address),
+            socket.SOCK_STREAM):
+        sock = socket.socket(af, socktype, proto)
+        try:
+            for option in socket_options or ():
+                sock.setsockopt(*option)
+            # urllib3 passes a sentinel for the global default timeout
+            if timeout is None or isinstance(timeout, (int, float)):
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sa)
+            return sock
+        except OSError as e:
+            err = e
+            sock.close()
+    raise err or OSError("getaddrinfo returned no addresses")
+
+
+class _DeadlineReader(io.RawIOBase):
+    """Reads from ``sock``, each bounded by the deadline if there is one."""
+
+    def __init__(self, sock):
+        super(_DeadlineReader, self).__init__()
+        self.sock = sock
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if getattr(_local, 'deadline', None) is not None:
+            self.sock.settimeout(_remaining(self.sock.gettimeout()))
+        return self.sock.recv_into(b)
+
+
+class _DeadlineSocket(object):
+    """Hands :class:`http.client.HTTPResponse` a :class:`_DeadlineReader`."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def makefile(self, mode):
+        return io.BufferedReader(_DeadlineReader(self.sock))
+
+
+class _DeadlineResponse(HTTPResponse):
+    """Response whose headers and body are read within the deadline."""
+
+    def __init__(self, sock, *args, **kwargs):
+        super(_DeadlineResponse, self).__init__(_DeadlineSocket(sock), *args,
+                                                **kwargs)
+
+
+class _ConnectionMixin(object):
+    """Open connections with :func:`create_connection`."""
+
+    resolver = None
+    response_class = _DeadlineResponse
+
+    def _new_conn(self):
+        try:
+            return create_connection(
+                (self._dns_host, self.port), self.timeout,
+                source_address=self.source_address,
+                socket_options=self.socket_options, resolver=self.resolver)
+        except socket.timeout as e:
+            raise ConnectTimeoutError(
+                self, "Connection to %s timed out. (connect timeout=%s)" %
+                (self.host, self.timeout)) from e
+        except OSError as e:
+            raise NewConnectionError(
+                self, "Failed to establish a new connection: %s" % e) from e
+
+
+class _HTTPConnection(_ConnectionMixin, HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_ConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _HTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+
+class _HTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+
+_POOL_CLASSES = {'http': _HTTPConnectionPool, 'https': _HTTPSConnectionPool}
+
+
+def _pool_classes(resolver):
+    """Pool classes whose connections resolve names with ``resolver``."""
+    if not resolver:
+        return _POOL_CLASSES
+    # urllib3 rejects unknown pool arguments, so bind it to the classes
+    classes = {}
+    for scheme, pool in _POOL_CLASSES.items():
+        connection = type(pool.ConnectionCls.__name__,
+                          (pool.ConnectionCls,), {'resolver': resolver})
+        classes[scheme] = type(pool.__name__, (pool,),
+                               {'ConnectionCls': connection})
+    return classes
+
+
+class _FamilyAdapter(HTTPAdapter):
+    """Transport adapter whose connections only use IP version ``family``.
+
+    ``family`` is ``4``, ``6`` or ``None`` for whatever the name of the
+    server resolves to. Names are resolved with ``resolver`` if given.
+
+    """
+
+    __attrs__ = HTTPAdapter.__attrs__ + ['family', 'resolver']
+
+    def __init__(self, family=None, resolver=None, **kwargs):
+        self.family = family
+        self.resolver = resolver
+        super(_FamilyAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.family:
+            kwargs['source_address'] = _ANY_ADDRESS[self.family]
+        super(_FamilyAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _pool_classes(self.resolver)
+
+
+class _KeepAliveRetry(Retry):
+    """Retry requests once if a pooled connection turns out to be dead.
+
+    Servers silently close idle keep-alive connections. urllib3 only notices
+    when the request is sent, which shows up as a read error. Read timeouts
+    are raised right away so a slow server does not cost ``timeout`` twice.
+
+    """
+
+    def increment(self, *args, **kwargs):
+        if isinstance(kwargs.get('error'), ReadTimeoutError):
+            raise kwargs['error']
+        return super(_KeepAliveRetry, self).increment(*args, **kwargs)
@@ -0,0 +1,319 @@
+"""Worker processes for large host fleets.
+
+With ``--workers N`` hosts are sharded across N processes by consistent
+hashing, so the TLS and JSON handling of thousands of hosts is not limited
+to one core. The supervisor discovers the external IP once for all workers,
+gathers the state and metrics they report after every tick and restarts
+workers that exit, handing them the last state their shard reported.
+
+"""
+
+import logging
+import multiprocessing
+
+from bisect import bisect
+from collections import namedtuple
+from itertools import chain
+from multiprocessing.connection import wait
+from threading import Lock
+from time import monotonic
+from zlib import crc32
+
+from twod._metrics import _Metrics, _serve
+from twod.twod import _Data, _backoff, _setup_logging
+
+# Points of every worker on the hash ring
+_REPLICAS = 64
+
+_HostView = namedtuple('_HostView', 'name rec_ip rec_ip6 ext_ip ext_ip6')
+
+
+class _Ring(object):
+    """Consistent hash ring mapping host names to workers.
+
+    Changing the number of workers only moves hosts to or from the workers
+    that were added or removed.
+
+    """
+
+    def __init__(self, workers, replicas=_REPLICAS):
+        points = sorted((crc32(('%d:%d' % (worker, replica)).encode()), worker)
+                        for worker in range(workers)
+                        for replica in range(replicas))
+        self.keys = [key for key, _ in points]
+        self.workers = [worker for _, worker in points]
+
+    def worker(self, name):
+        """Worker responsible for host ``name``."""
+        index = bisect(self.keys, crc32(name.encode('utf-8')))
+        return self.workers[index % len(self.keys)]
+
+
+def _shard(hosts, workers):
+    """Split host definitions ``hosts`` into ``workers`` shards."""
+    ring = _Ring(workers)
+    shards = [[] for _ in range(workers)]
+    for host in hosts:
+        shards[ring.worker(host['name'])].append(host)
+    return shards
+
+
+def _work(conf, conn):
+    """Check the hosts of ``conf`` until the supervisor goes away.
+
+    Reports ``(state, metrics, failed)`` through ``conn`` after every tick
+    and takes discovered IPs pushed by the supervisor. Pushed IPs are used by
+    the next tick and then for ``cache_ttl`` seconds; all hosts are checked
+    right away when they differ from the previous ones.
+
+    """
+    # Workers are started by a fork server without the setup of the daemon
+    _setup_logging(conf['loglevel'])
+    loop = None
+    if conf['engine'] == 'asyncio':
+        import asyncio
+        from twod._aio import _AsyncData
+        loop = asyncio.new_event_loop()
+        data = _AsyncData(conf)
+        loop.run_until_complete(data.start())
+    else:
+        data = _Data(conf)
+    pushed = None
+    try:
+        while True:
+            while conn.poll():
+                ips = conn.recv()
+                if pushed and ips != pushed:
+                    # Like a changed address in netlink mode
+                    for host in data.hosts:
+                        host.next_check = 0
+                pushed = data.pushed_ips = ips
+                data.ext_cache = (monotonic(), ips)
+            start = monotonic()
+            try:
+                if loop:
+                    loop.run_until_complete(data.tick())
+                else:
+                    data.tick()
+            finally:
+                # Later ticks discover on their own once cache_ttl is over
+                data.pushed_ips = None
+            data.metrics.tick(monotonic() - start)
+            conn.send((data._state_entries(), data.metrics,
+                       any(host.retries for host in data.hosts)))
+            if conf.get('once'):
+                return
+            if not data.monitor:
+                conn.poll(data.next_sleep())
+            elif loop:
+                loop.run_until_complete(data._wait(data.next_sleep()))
+            else:
+                data.wait(data.next_sleep())
+    except (EOFError, OSError):
+        # The supervisor exited
+        pass
+    finally:
+        data.close()
+        if loop:
+            loop.close()
+
+
+class _Supervisor(object):
+    """Run the hosts of ``conf`` in ``workers`` worker processes."""
+
+    def __init__(self, conf, workers):
+        self.log = logging.getLogger('twod')
+        self.conf = conf
+        # Forking the threaded supervisor could copy locks held by threads
+        self.context = multiprocessing.get_context('forkserver')
+        self.shards = [shard for shard in _shard(
+            chain(conf['hosts'], conf['inventory'] or ()), workers) if shard]
+        count = len(self.shards)
+        # (process, connection) of every running worker
+        self.workers = [None] * count
+        # Last (state, metrics, failed) reported by every worker
+        self.reports = [None] * count
+        self.restarts = [0] * count
+        self.restart_at = [0.0] * count
+        # Counts of workers that exited
+        self.retired = _Metrics()
+        self.lock = Lock()
+        self.period = min(host['interval']
+                          for host in chain.from_iterable(self.shards))
+        # Netlink addresses are read locally by every worker
+        self.discovery = None
+        if conf['ip_mode'] != 'netlink':
+            self.discovery = _Data(dict(conf, hosts=[], inventory=None,
+                                        state_file=None, spread=False,
+                                        cache_ttl=0))
+        self.ext_ips = None
+
+    def _worker_conf(self, index):
+        # Workers are not controlled through the socket
+        conf = dict(self.conf, hosts=self.shards[index], inventory=None,
+                    control_socket=None)
+        if self.reports[index]:
+            conf['saved'] = self.reports[index][0]
+        if conf['state_file']:
+            conf['state_file'] = '%s.%d' % (conf['state_file'], index)
+        return conf
+
+    def _start(self, index):
+        parent, child = self.context.Pipe()
+        process = self.context.Process(
+            target=_work, args=(self._worker_conf(index), child),
+            name='twod-worker-%d' % index)
+        process.daemon = True
+        process.start()
+        child.close()
+        if self.ext_ips:
+            parent.send(self.ext_ips)
+        self.workers[index] = (process, parent)
+
+    def _discover(self):
+        """Discover external IPs and push them to all workers."""
+        ips = self.discovery._get_ext_ips()
+        if not all(ips.values()):
+            # Workers discover on their own until the next try
+            return
+        self.ext_ips = ips
+        for worker in self.workers:
+            if worker:
+                try:
+                    worker[1].send(ips)
+                except (EOFError, OSError):
+                    pass
+
+    def _receive(self, timeout):
+        """Handle reports and exits of workers for up to ``timeout``."""
+        waiting = {}
+        for index, worker in enumerate(self.workers):
+            if worker:
+                waiting[worker[0].sentinel] = index
+                waiting[worker[1]] = index
+        for ready in wait(list(waiting), timeout):
+            index = waiting[ready]
+            if not self.workers[index]:
+                continue
+            if ready is not self.workers[index][1] or not self._report(index):
+                self._exited(index)
+
+    def _report(self, index):
+        """Take pending reports of worker ``index``.
+
+        Returns False if the worker closed its end of the pipe.
+
+        """
+        conn = self.workers[index][1]
+        try:
+            while conn.poll():
+                report = conn.recv()
+                with self.lock:
+                    self.reports[index] = report
+                self.restarts[index] = 0
+        except (EOFError, OSError):
+            return False
+        return True
+
+    def _exited(self, index):
+        process, conn = self.workers[index]
+        self._report(index)
+        process.join()
+        conn.close()
+        self.workers[index] = None
+        report = self.reports[index]
+        if report:
+            with self.lock:
+                self.retired.add(report[1])
+                self.reports[index] = (report[0], _Metrics(), report[2])
+        if self.conf.get('once'):
+            return
+        delay = _backoff(self.restarts[index], self.conf['backoff'],
+                         self.conf['max_backoff'])
+        self.restarts[index] += 1
+        self.restart_at[index] = monotonic() + delay
+        self.log.warning("Worker %d exited with status %s, restarting in %d "
+                         "seconds." % (index, process.exitcode, delay))
+
+    def render(self):
+        """Metrics of the supervisor and all workers in Prometheus format."""
+        metrics = self._metrics()
+        reports = [report for report in self.reports if report]
+        if self.discovery:
+            metrics.add(self.discovery.metrics)
+        hosts = [_HostView(name, entry['rec_ip'], entry['rec_ip6'],
+                           entry['ext_ip'], entry['ext_ip6'])
+                 for report in reports
+                 for name, entry in sorted(report[0].items())]
+        return metrics.render(hosts)
+
+    def run(self):
+        """Run workers until killed."""
+        next_discovery = monotonic()
+        if self.discovery:
+            self._discover()
+            next_discovery += self.period
+        for index in range(len(self.shards)):
+            self._start(index)
+        if self.conf['metrics_listen']:
+            _serve(self.conf['metrics_listen'], self.render)
+        try:
+            while True:
+                now = monotonic()
+                if self.discovery and now >= next_discovery:
+                    self._discover()
+                    next_discovery = now + self.period
+                wakeup = [next_discovery] if self.discovery else []
+                for index, worker in enumerate(self.workers):
+                    if worker:
+                        continue
+                    if now >= self.restart_at[index]:
+                        self._start(index)
+                    else:
+                        wakeup.append(self.restart_at[index])
+                self._receive(max(0, min(wakeup) - now) if wakeup else None)
+        finally:
+            self.close()
+
+    def once(self):
+        """Check every shard once.
+
+        Returns ``(failed, updated)``: whether a check failed, counting
+        workers that exited without report, and whether a record was
+        updated.
+
+        """
+        if self.discovery:
+            self._discover()
+        for index in range(len(self.shards)):
+            self._start(index)
+        try:
+            while any(self.workers):
+                self._receive(None)
+        finally:
+            self.close()
+        reports = [report for report in self.reports if report]
+        failed = (len(reports) < len(self.shards) or
+                  any(report[2] for report in reports))
+        return failed, any(self._metrics().updates.values())
+
+    def _metrics(self):
+        """Metrics of all workers, past and present."""
+        metrics = _Metrics()
+        with self.lock:
+            metrics.add(self.retired)
+            for report in self.reports:
+                if report:
+                    metrics.add(report[1])
+        return metrics
+
+    def close(self):
+        """Stop all workers."""
+        for index, worker in enumerate(self.workers):
+            if worker:
+                worker[0].terminate()
+                worker[0].join()
+                worker[1].close()
+                self.workers[index] = None
+        if self.discovery:
+            self.discovery.close()
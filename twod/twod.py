@@ -23,40 +23,117 @@ along with this program.  If not, see [http://www.gnu.org/licenses/].
 
 from __future__ import absolute_import
 
-import logging.handlers
-import logging.config
+import logging
+import socket
+import sys
+import threading
 
 from argparse import ArgumentParser
+from collections import namedtuple
 from configparser import (SafeConfigParser, MissingSectionHeaderError,
                           NoSectionError, NoOptionError)
+from importlib import import_module
+from itertools import chain
 from json import dumps, loads
-from lockfile.pidlockfile import PIDLockFile
 from os import access, path, W_OK, X_OK
-from random import randint
+from random import choice, randint, random, uniform
 from re import match
-from socket import inet_pton, error as socket_error, AF_INET, AF_INET6
-from time import sleep
-
-from daemon import DaemonContext
-from requests import exceptions, Session
+from select import select
+from socket import error as socket_error
+from time import monotonic, sleep, time
+from urllib.parse import urlsplit
+from zlib import crc32
 
+from twod._ip import _is_policy, _parse_ip, _Policy
+from twod._metrics import _Metrics
+from twod._ratelimit import _RateLimiter, _retry_after
+from twod._scheduler import _MAX_SLEEP, _clock, _TimerWheel
 from twod._version import __version__
 
+_ENGINES = ('sync', 'asyncio')
+
+# What to do about regular checks missed, e.g. while suspended
+_CATCH_UP = ('now', 'skip')
+
+# Commands of the control socket that schedule checks
+_COMMANDS = ('check-now', 'refresh-record')
+
+# Exit status of ``--once``
+_EXIT_UNCHANGED = 0
+_EXIT_UPDATED = 3
+_EXIT_FAILED = 4
+
+# Longer IP service answers are rejected; an IP takes at most 45 characters
+_MAX_IP_BODY = 64
+
+# Heavy dependencies are imported on first use, so ``--help``, ``--version``
+# and ``--check-config`` do not pay for them. They are still available as
+# attributes of this module.
+_LAZY = {
+    'DaemonContext': ('daemon', 'DaemonContext'),
+    'PIDLockFile': ('lockfile.pidlockfile', 'PIDLockFile'),
+    'Session': ('requests', 'Session'),
+    'exceptions': ('requests', 'exceptions'),
+}
+
+
+def __getattr__(name):
+    """Import lazy module attribute ``name`` (PEP 562)."""
+    if name not in _LAZY:
+        raise AttributeError("module '%s' has no attribute '%s'" %
+                             (__name__, name))
+    module, attr = _LAZY[name]
+    value = getattr(import_module(module), attr)
+    globals()[name] = value
+    return value
+
+
+def _lazy(name):
+    """Get lazy module attribute ``name``, importing it if necessary."""
+    if name in globals():
+        return globals()[name]
+    return __getattr__(name)
+
+
+_Family = namedtuple('_Family', 'rec ext field versions')
+
+# Host attributes, TwoDNS record field and accepted IP versions per tracked
+# address family. ``None`` tracks whatever family the IP services answer.
+_FAMILIES = {
+    None: _Family('rec_ip', 'ext_ip', 'ip_address', (4, 6)),
+    4: _Family('rec_ip', 'ext_ip', 'ip_address', (4,)),
+    6: _Family('rec_ip6', 'ext_ip6', 'ipv6_address', (6,)),
+}
+
 
 class _ServiceGenerator(object):
-    """Select service URL depending on mode."""
+    """Select service URL depending on mode.
+
+    Keeps an exponentially weighted moving average of latency and success
+    rate per service. In ``adaptive`` mode services are picked at random,
+    weighted by success rate over latency. With probability ``explore`` any
+    service is picked, so a recovered service can earn traffic back.
 
-    def __init__(self, services, mode):
+    """
+
+    # Weight of the most recent sample in the moving averages
+    alpha = 0.3
+
+    def __init__(self, services, mode, explore=0.1):
         self.services = services
         self.mode = mode
+        self.explore = explore
         self.cur = -1
+        # service -> [latency, success rate, requests, failures]
+        self._stats = dict((service, [None, 1.0, 0, 0])
+                           for service in services)
 
     def __iter__(self):
         return self
 
     def next(self):
         self.cur = self.cur + 1
-        if self.mode == 'round_robin':
+        if self.mode in ('round_robin', 'race', 'netlink'):
             if self.cur < len(self.services):
                 service = self.services[self.cur]
             else:
@@ -67,6 +144,204 @@ class _ServiceGenerator(object):
             self.cur = randint(0, (len(self.services) - 1))
             service = self.services[self.cur]
             return service
+        elif self.mode == 'adaptive':
+            return self._pick_adaptive()
+
+    def _pick_adaptive(self):
+        untried = [s for s in self.services if self._stats[s][2] == 0]
+        if untried:
+            return untried[0]
+        if random() < self.explore:
+            return choice(self.services)
+        weights = [max(success, 0.01) / max(latency, 0.001)
+                   for latency, success, requests, failures
+                   in (self._stats[s] for s in self.services)]
+        pick = uniform(0, sum(weights))
+        for service, weight in zip(self.services, weights):
+            pick -= weight
+            if pick <= 0:
+                break
+        return service
+
+    def record(self, service, latency, ok):
+        """Record outcome of a request to ``service``."""
+        stats = self._stats[service]
+        if stats[0] is None:
+            stats[0] = latency
+        else:
+            stats[0] += self.alpha * (latency - stats[0])
+        stats[1] += self.alpha * ((1.0 if ok else 0.0) - stats[1])
+        stats[2] += 1
+        if not ok:
+            stats[3] += 1
+
+    def stats(self):
+        """Return latency and success statistics per service."""
+        return dict((service, {
+            'latency': latency,
+            'success_rate': success,
+            'requests': requests,
+            'failures': failures,
+        }) for service, (latency, success, requests, failures)
+            in self._stats.items())
+
+    def take(self, n):
+        """Return up to ``n`` distinct services, starting with the next."""
+        return [self.next() for _ in range(min(n, len(self.services)))]
+
+
+class _ResponseTooLarge(Exception):
+    """Response body is larger than allowed."""
+
+
+def _endpoint(url, family):
+    """Name of ``url`` for breakers and metrics when bound to ``family``."""
+    if not family:
+        return url
+    return '%s (IPv%d)' % (url, family)
+
+
+def _origin(url):
+    """Scheme and host of ``url``, e.g. the TwoDNS API of a host URL."""
+    parts = urlsplit(url)
+    return '%s://%s' % (parts.scheme, parts.netloc)
+
+
+def _phase(name):
+    """Offset of host ``name`` within its interval, between 0 and 1.
+
+    Stable across restarts, so a restart does not bunch checks together.
+
+    """
+    return crc32(name.encode('utf-8')) / 2.0 ** 32
+
+
+def _staleness(host):
+    """Sort key putting the longest outdated records first."""
+    if host.stale_since is None:
+        return (1, host.rec_time)
+    return (0, host.stale_since)
+
+
+def _next_check(host):
+    return host.next_check
+
+
+def _str(ip):
+    """Text of ``ip`` as saved in the state file, None if unknown."""
+    return str(ip) if ip else None
+
+
+def _backoff(attempt, base, cap):
+    """Exponential backoff delay with jitter.
+
+    Returns a delay between half and all of ``base * 2 ** attempt`` seconds,
+    capped at ``cap``.
+
+    """
+    delay = min(cap, base * 2 ** min(attempt, 32))
+    return delay / 2 + uniform(0, delay / 2)
+
+
+class _Breaker(object):
+    """Circuit breaker for one endpoint.
+
+    The breaker opens after ``threshold`` consecutive failures and rejects
+    requests for a backoff delay that doubles each time it opens again.
+    After that delay it is half-open and lets a single trial request through
+    every ``base`` seconds; success closes it, failure opens it again.
+
+    """
+
+    def __init__(self, threshold, base, cap):
+        self.threshold = threshold
+        self.base = base
+        self.cap = cap
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0
+        self.until = 0
+
+    def allow(self):
+        """Return whether a request may be sent."""
+        if self.state == 'closed':
+            return True
+        now = monotonic()
+        if now < self.until:
+            return False
+        # Half-open; trials that are never recorded expire after ``base``
+        self.state = 'half-open'
+        self.until = now + self.base
+        return True
+
+    def success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0
+
+    def failure(self):
+        """Record failure. Returns the backoff delay if the breaker opened."""
+        self.failures += 1
+        if self.state == 'half-open' or self.failures >= self.threshold:
+            delay = _backoff(self.opened, self.base, self.cap)
+            self.state = 'open'
+            self.opened += 1
+            self.until = monotonic() + delay
+            return delay
+
+
+class _Host(object):
+    """TwoDNS host and its recorded state."""
+
+    # Fleets have thousands of hosts; keep them small
+    __slots__ = ('name', 'ident', 'url', 'interval', 'rec_ip', 'rec_ip6',
+                 'rec_time', 'rec_clock', 'ext_ip', 'ext_ip6', 'deadline',
+                 'wheel', '_next_check', 'retries', 'checks', 'etag',
+                 'last_modified', 'verify', 'stale_since', 'limits')
+
+    def __init__(self, name, user, token, url, interval):
+        self.name = name
+        self.ident = (user, token)
+        self.url = url
+        self.interval = interval
+        self.rec_ip = None
+        self.rec_ip6 = None
+        self.rec_time = 0
+        # rec_time on the scale of _clock(), which setting the time leaves
+        # alone; rec_time is what the state file keeps
+        self.rec_clock = 0
+        self.ext_ip = None
+        self.ext_ip6 = None
+        # Time of the regular check, without splay; None before the first
+        self.deadline = None
+        # Timer wheel of the hosts, told about every new next_check
+        self.wheel = None
+        self.next_check = 0
+        self.retries = 0
+        # Checks since the record was last read or written
+        self.checks = 0
+        # Validators of the last record read, for conditional requests
+        self.etag = None
+        self.last_modified = None
+        # Recorded IP was restored from the state file and not confirmed yet
+        self.verify = False
+        # Time a check first found the record outdated
+        self.stale_since = None
+        # Rate limiter keys of the API origin and account
+        split = urlsplit(url)
+        self.limits = (('origin', '%s://%s' % (split.scheme, split.netloc)),
+                       ('account', user))
+
+    @property
+    def next_check(self):
+        """Time of the next check on the scale of :func:`_clock`."""
+        return self._next_check
+
+    @next_check.setter
+    def next_check(self, deadline):
+        self._next_check = deadline
+        if self.wheel is not None:
+            self.wheel.add(deadline, self)
 
 
 class _Data(object):
@@ -74,155 +349,1218 @@ class _Data(object):
 
     def __init__(self, conf):
         self.log = logging.getLogger('twod')
-        self.ident = (conf['user'], conf['token'])
-        self.url = conf['url']
+        self.hosts = []
+        self.wheel = _TimerWheel(_next_check)
+        # Hosts sharing credentials or rate limits share one tuple
+        shared = {}
+        for host in chain(conf['hosts'], conf['inventory'] or ()):
+            host = _Host(**host)
+            host.ident = shared.setdefault(host.ident, host.ident)
+            host.limits = shared.setdefault(host.limits, host.limits)
+            host.wheel = self.wheel
+            host.next_check = 0
+            self.hosts.append(host)
+        self.splay = conf['splay']
+        self.catch_up = conf['catch_up']
         self.timeout = conf['timeout']
         self.redirects = conf['redirects']
+        self.pool_size = conf['pool_size']
+        self.keepalive = conf['keepalive']
+        self.families = conf['families']
         self.gen = _ServiceGenerator(conf['ip_url'].split(' '),
-                                     conf['ip_mode'])
-        self.rec_ip = self._get_rec_ip()
+                                     conf['ip_mode'], conf['explore'])
+        self.race_width = conf['race_width']
+        self.hedge_delay = conf['hedge_delay']
+        self.threads = conf['threads']
+        self.executor = None
+        self.threshold = conf['failure_threshold']
+        self.backoff = conf['backoff']
+        self.max_backoff = conf['max_backoff']
+        self.breakers = {}
+        self.limiter = _RateLimiter(conf['origin_rate'], conf['origin_burst'],
+                                    conf['account_rate'],
+                                    conf['account_burst'])
+        self.metrics = _Metrics()
+        self.monitor = None
+        if conf['ip_mode'] == 'netlink':
+            from twod._netlink import _AddressMonitor
+            self.interface = conf['interface']
+            self.monitor = _AddressMonitor(self.interface)
+        self.state = None
+        self.journal = None
+        if conf['state_file']:
+            from twod._journal import _Journal
+            from twod._state import _StateFile
+            self.state = _StateFile(conf['state_file'])
+            self.journal = _Journal(conf['state_file'] + '.journal')
+        self.state_ttl = conf['state_ttl']
+        # State of the shard of a restarted worker, as reported before
+        self.saved = conf.get('saved')
+        # Single runs trust saved records until ``refresh_interval``
+        self.trust_state = conf.get('once', False)
+        # Single runs check all hosts right away
+        self.spread = conf['spread'] and not self.trust_state
+        self.cache_ttl = conf['cache_ttl']
+        self.policy = _Policy(conf['reject']) if conf['reject'] else None
+        # (time, IPs) of the last successful discovery
+        self.ext_cache = None
+        # Discoveries of other instances; netlink reads its own address
+        self.shared = None
+        if conf['shared_cache'] and conf['ip_mode'] != 'netlink':
+            from twod._sharedcache import _SharedCache
+            self.shared = _SharedCache(conf['shared_cache'],
+                                       conf['shared_cache_ttl'])
+        # Set by ``check-now`` so the next discovery asks the IP services
+        self.skip_shared = False
+        # Discovery pushed by the supervisor of worker processes
+        self.pushed_ips = None
+        self.refresh_every = conf['refresh_every']
+        self.refresh_interval = conf['refresh_interval']
+        # Commands received on the control socket, run at the next tick
+        self.commands = []
+        self.commands_lock = threading.Lock()
+        self.wakeup = None
+        if conf['control_socket']:
+            from twod._control import _Wakeup
+            self.wakeup = _Wakeup()
+        self.dirty = False
+        self.resolver = None
+        if conf['dns_ttl']:
+            from twod._resolver import _Resolver
+            self.resolver = _Resolver(conf['dns_ttl'],
+                                      conf['dns_negative_ttl'],
+                                      conf['dns_stale_ttl'])
+        self.session = self._new_session()
+        # Sessions bound to one IP version for discovery of its address
+        self.sessions = dict((family, self._new_session(family))
+                             for family in self.families if family)
+        self.last_used = time()
+        try:
+            self._start()
+        except BaseException:
+            # E.g. SystemExit on SIGTERM; cancel queued record reads
+            self.close()
+            raise
 
-    def _validate_ip(self, ip, families=[4, 6]):
-        """Validate textual IP address representation.
+    def _start(self):
+        """Fetch recorded IPs of hosts without a fresh saved state.
 
-        Returns passed IP string if valid.
-        Returns False on failure.
+        Requests run concurrently.
 
         """
-        for family in families:
+        missing = self._schedule(self._restore_state())
+        for host, record in zip(missing,
+                                self._run_all(self._get_record, missing)):
+            self._recorded(host, record)
+        self._save_state()
+
+    def _schedule(self, missing):
+        """Schedule first checks.
+
+        With ``spread`` the first checks are spread over the interval of
+        each host and ``missing`` records are fetched at the first check.
+        Returns hosts whose recorded IP has to be fetched right away.
+
+        """
+        if not self.spread:
+            return missing
+        now = _clock()
+        for host in self.hosts:
+            host.deadline = now + _phase(host.name) * host.interval
+            host.next_check = self._splayed(host)
+        for host in missing:
+            host.verify = True
+        return []
+
+    def _restore_state(self):
+        """Restore host state from state file.
+
+        Recorded IPs younger than ``state_ttl`` are used right away and
+        confirmed with TwoDNS at the first check of their host.
+
+        Returns hosts whose recorded IP still has to be fetched.
+
+        """
+        if self.saved is not None:
+            saved = self.saved
+        elif not self.state:
+            return list(self.hosts)
+        else:
             try:
-                if family == 4:
-                    inet_pton(AF_INET, ip)
-                elif family == 6:
-                    inet_pton(AF_INET6, ip)
-            except (socket_error, UnicodeEncodeError):
-                # This is fine
-                pass
+                saved = self.state.load()
+            except ValueError as e:
+                self.log.warning("Ignoring state file: %s" % e)
+                saved = {}
+        now = time()
+        missing = []
+        for host in self.hosts:
+            entry = saved.get(host.name)
+            if not entry or entry.get('url') != host.url:
+                missing.append(host)
+                continue
+            host.ext_ip = _parse_ip(entry.get('ext_ip'))
+            host.ext_ip6 = _parse_ip(entry.get('ext_ip6'))
+            rec_time = entry.get('rec_time', 0)
+            record = dict(
+                (family, _parse_ip(entry.get(_FAMILIES[family].rec)))
+                for family in self.families)
+            if any(record.values()) and 0 <= now - rec_time < self.state_ttl:
+                for family, ip in record.items():
+                    if ip:
+                        self.log.debug("%s: Using saved IP %s." %
+                                       (host.name, ip))
+                    setattr(host, _FAMILIES[family].rec, ip)
+                self._stamp(host, rec_time)
+                host.verify = not self.trust_state
             else:
-                return ip
-        return False
+                missing.append(host)
+        if not self.journal:
+            return missing
+        return self._replay_journal(missing)
 
-    def _get_service_url(self):
-        """Get next URL from service generator."""
-        return self.gen.next()
+    def _replay_journal(self, missing):
+        """Apply confirmed updates newer than the saved state.
 
-    def _get_ext_ip(self):
-        """Get external IP.
+        Hosts whose last update may not have reached TwoDNS have their
+        record fetched rather than sending it again.
+        Returns hosts whose recorded IP still has to be fetched.
 
-        Returns external IP as string.
-        Returns False on failure.
+        """
+        updates = self.journal.replay()
+        now = time()
+        for host in self.hosts:
+            update = updates.get(host.name)
+            if not update or update['url'] != host.url:
+                continue
+            if not update['done']:
+                self.log.info("%s: Last update may not have reached TwoDNS, "
+                              "fetching record." % host.name)
+                if host not in missing:
+                    missing.append(host)
+            elif (update['time'] > host.rec_time and
+                    0 <= now - update['time'] < self.state_ttl):
+                for family in self.families:
+                    field = _FAMILIES[family].field
+                    if field in update['record']:
+                        setattr(host, _FAMILIES[family].rec, _parse_ip(
+                            update['record'][field]))
+                self._stamp(host, update['time'])
+                # TwoDNS confirmed this record itself
+                host.verify = False
+                self.dirty = True
+                if host in missing:
+                    missing.remove(host)
+        return missing
+
+    def _journal(self, host, new_ip=None):
+        """Note update of ``host`` to ``new_ip`` in the journal.
+
+        Without ``new_ip`` the latest update of ``host`` is confirmed.
+
+        """
+        if not self.journal:
+            return
+        try:
+            if new_ip is None:
+                self.journal.confirm(host.name)
+            else:
+                self.journal.intend(host.name, host.url,
+                                    self._update_fields(new_ip))
+        except (IOError, OSError) as e:
+            self.log.warning("Error while writing update journal: %s" % e)
+
+    def _save_state(self):
+        """Write host state to state file if it changed.
+
+        Syncs the update journal first and compacts it once the state file
+        holds the updates it confirmed.
 
         """
-        self.log.debug("Fetching external IP...")
+        if self.journal:
+            try:
+                self.journal.sync()
+            except (IOError, OSError) as e:
+                self.log.warning("Error while writing update journal: %s" % e)
+        if not (self.state and self.dirty):
+            return
         try:
-            with Session() as s:
-                s.max_redirects = self.redirects
-                ip_request = s.get(self._get_service_url(), verify=True,
-                                   timeout=self.timeout)
-            ip_request.raise_for_status()
-        except (exceptions.ConnectionError, exceptions.HTTPError) as e:
-            self.log.warning("Error while fetching external IP: %s" % e)
+            self.state.save(self._state_entries())
+        except (IOError, OSError) as e:
+            self.log.warning("Error while writing state file: %s" % e)
+            return
+        self.dirty = False
+        if self.journal.compact_due():
+            try:
+                self.journal.compact()
+            except (IOError, OSError) as e:
+                self.log.warning("Error while compacting update journal: %s"
+                                 % e)
+
+    def _state_entries(self):
+        """State of all hosts as saved in the state file."""
+        return dict((host.name, {
+            'url': host.url,
+            'rec_ip': _str(host.rec_ip),
+            'rec_ip6': _str(host.rec_ip6),
+            'rec_time': host.rec_time,
+            'ext_ip': _str(host.ext_ip),
+            'ext_ip6': _str(host.ext_ip6),
+        }) for host in self.hosts)
+
+    def _recorded(self, host, record):
+        """Set IPs recorded at TwoDNS for ``host``.
+
+        ``record`` maps address families to IPs; other families are left
+        alone. A false ``record`` marks all tracked families as unknown.
+
+        """
+        if not record:
+            record = dict.fromkeys(self.families, record)
+        for family, ip in record.items():
+            setattr(host, _FAMILIES[family].rec, ip)
+        if any(record.values()):
+            self._stamp(host, time())
+            host.checks = 0
+            host.verify = False
+        self.dirty = True
+
+    def _stamp(self, host, rec_time):
+        """Set ``rec_time``, the time the record of ``host`` was read."""
+        host.rec_time = rec_time
+        host.rec_clock = _clock() - (time() - rec_time)
+
+    def _verify(self, host):
+        """Replace known recorded IPs by the ones stored at TwoDNS."""
+        record = self._get_record(host)
+        if record:
+            self._refreshed(host, record)
+
+    def _refreshed(self, host, record):
+        """Set record read from TwoDNS, logging changes made elsewhere."""
+        for family, ip in record.items():
+            old_ip = getattr(host, _FAMILIES[family].rec)
+            if old_ip and ip != old_ip:
+                self.log.info("%s: Record changed to %s outside of twod." %
+                              (host.name, ip))
+        self._recorded(host, record)
+
+    def _refresh_due(self, host, now):
+        """Return whether the record of ``host`` should be read again.
+
+        Restored records are always confirmed. Otherwise the record is read
+        every ``refresh_every`` checks or once it is ``refresh_interval``
+        seconds old, whichever comes first; ``0`` disables either. ``now``
+        is a :func:`_clock` time.
+
+        """
+        if host.verify:
+            return True
+        if self.refresh_every and host.checks >= self.refresh_every:
+            return True
+        return bool(self.refresh_interval and
+                    now - host.rec_clock >= self.refresh_interval)
+
+    @property
+    def rec_ip(self):
+        """Recorded IP of the first configured host."""
+        return self.hosts[0].rec_ip
+
+    @rec_ip.setter
+    def rec_ip(self, ip):
+        self.hosts[0].rec_ip = ip
+
+    def _new_session(self, family=None):
+        """Create HTTP session shared by all requests.
+
+        Connections are kept alive per origin so DNS lookups and TCP/TLS
+        handshakes are only paid when a connection has to be (re)opened.
+        With ``family`` the session only connects over that IP version.
+
+        """
+        from twod._transport import _FamilyAdapter, _KeepAliveRetry
+        s = _lazy('Session')()
+        s.max_redirects = self.redirects
+        adapter = _FamilyAdapter(
+            family, self.resolver,
+            pool_connections=len(self.gen.services) + len(self.hosts),
+            pool_maxsize=self.pool_size,
+            # 429 answers are left to the rate limiter
+            max_retries=_KeepAliveRetry(total=1, connect=0, read=1,
+                                        redirect=0, status=0,
+                                        respect_retry_after_header=False))
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        return s
+
+    def _get_session(self, family=None):
+        """Get HTTP session, dropping connections idle for too long.
+
+        Returns the session bound to ``family`` if there is one.
+
+        """
+        now = time()
+        if self.keepalive and now - self.last_used > self.keepalive:
+            self.log.debug("Closing idle connections...")
+            # Pools are rebuilt on demand by the adapters
+            self.session.close()
+            for session in self.sessions.values():
+                session.close()
+        self.last_used = now
+        return self.sessions.get(family, self.session)
+
+    def _pool(self):
+        """Thread pool for concurrent requests, created on first use."""
+        if self.executor is None:
+            from twod._executor import _Executor
+            # Each family may race ``race_width`` services at once
+            self.executor = _Executor(max(
+                self.threads, len(self.families) * (self.race_width + 1)))
+        return self.executor
+
+    def _run_all(self, func, items, skipped=None):
+        """Call ``func(item)`` for all ``items``.
+
+        Several items are handled concurrently in the thread pool, each
+        within the time of two rate limited requests. ``skipped(item)`` is
+        called for items whose call never started because others overran.
+        Returns results in the order of ``items``, None for calls that did not
+        finish in time.
+
+        """
+        if len(items) < 2:
+            return [func(item) for item in items]
+        results, late, dropped = self._pool().run_all(
+            func, items, 4 * self.timeout, self.timeout)
+        if late or dropped:
+            self.log.warning("%d of %d requests still running and %d not "
+                             "started in time" % (late, len(items),
+                                                  len(dropped)))
+        for item in dropped:
+            if skipped:
+                skipped(item)
+        return results
+
+    def _check_cancelled(self):
+        """Raise _Cancelled if the running pool task has to stop."""
+        if self.executor:
+            self.executor.check()
+
+    def close(self):
+        """Close all pooled connections."""
+        if self.monitor:
+            self.monitor.close()
+        if self.wakeup:
+            self.wakeup.close()
+        if self.executor:
+            self.executor.shutdown()
+        self.session.close()
+        for session in self.sessions.values():
+            session.close()
+        if self.journal:
+            try:
+                self.journal.close()
+            except (IOError, OSError) as e:
+                self.log.warning("Error while writing update journal: %s" % e)
+
+    def _get_service_url(self, family=None):
+        """Get next URL from service generator.
+
+        Skips services whose circuit breaker for ``family`` is open.
+        Returns None if all of them are.
+
+        """
+        for _ in self.gen.services:
+            url = self.gen.next()
+            if self._breaker(_endpoint(url, family)).allow():
+                return url
+        return None
+
+    def _breaker(self, url):
+        """Get circuit breaker for endpoint ``url``."""
+        breaker = self.breakers.get(url)
+        if breaker is None:
+            # Hosts checked concurrently may get here at the same time
+            breaker = self.breakers.setdefault(url, _Breaker(
+                self.threshold, self.backoff, self.max_backoff))
+        return breaker
+
+    def _record(self, url, start, ok, kind, family=None):
+        """Record outcome of request to ``url`` started at ``start``.
+
+        ``kind`` is one of ``ip_service``, ``twodns_get`` or ``twodns_put``.
+        Requests bound to IP version ``family`` are tracked separately.
+        Metrics of TwoDNS requests are kept per API, not per host.
+
+        """
+        elapsed = monotonic() - start
+        endpoint = _endpoint(url, family)
+        self.metrics.request(
+            kind, endpoint if kind == 'ip_service' else _origin(url),
+            elapsed, ok)
+        if kind == 'ip_service':
+            self.gen.record(url, elapsed, ok)
+        breaker = self._breaker(endpoint)
+        if ok:
+            breaker.success()
+            return
+        delay = breaker.failure()
+        if delay is not None:
+            self.log.warning("%s keeps failing, skipping it for %d seconds" %
+                             (endpoint, delay))
+
+    def _throttle(self, host):
+        """Wait until the rate limits of ``host`` allow a request.
+
+        Returns False without waiting if that would take longer than
+        ``timeout``.
+
+        """
+        delay = self._reserve(host)
+        if delay:
+            sleep(delay)
+            self._check_cancelled()
+        return delay is not None
+
+    def _reserve(self, host):
+        """Reserve a request to TwoDNS for ``host``.
+
+        Returns seconds to wait before sending it, or None if the request
+        has to be postponed.
+
+        """
+        delay = self.limiter.reserve(host.limits, self.timeout)
+        if delay is None:
+            self.log.info("%s: Rate limit reached, postponing request." %
+                          host.name)
+        return delay
+
+    def _throttled(self, host, response):
+        """Pause requests of the account of ``host`` after a 429 answer.
+
+        Honors the ``Retry-After`` header, falling back to ``backoff``.
+        Returns the pause in seconds.
+
+        """
+        delay = _retry_after(response.headers.get('Retry-After'))
+        delay = min(self.max_backoff,
+                    self.backoff if delay is None else delay)
+        self.limiter.pause(host.limits[1:], delay)
+        return delay
+
+    def _blocked(self, url):
+        """Return whether requests to ``url`` are currently skipped."""
+        if self._breaker(url).allow():
             return False
-        except exceptions.Timeout:
-            self.log.warning("Failed to fetch external IP: Server did not "
-                             "respond within %s seconds" % self.timeout)
+        self.log.debug("Skipping %s, circuit breaker is open" % url)
+        return True
+
+    def _request_failed(self, e, action, host=None):
+        """Log failed HTTP request.
+
+        ``action`` is one of ``ext``, ``rec`` or ``update``.
+        Always returns False.
+
+        """
+        doing, do = {
+            'ext': ("fetching external IP", "fetch external IP"),
+            'rec': ("fetching IP from TwoDNS", "fetch TwoDNS IP"),
+            'update': ("updating IP", "update IP"),
+        }[action]
+        prefix = "%s: " % host.name if host else ""
+        exceptions = _lazy('exceptions')
+        response = getattr(e, 'response', None)
+        if host and response is not None and response.status_code == 429:
+            self.log.warning("%sRate limited while %s, pausing requests for "
+                             "%d seconds" %
+                             (prefix, doing, self._throttled(host, response)))
+        elif isinstance(e, (exceptions.ConnectionError,
+                            exceptions.HTTPError)):
+            self.log.warning("%sError while %s: %s" % (prefix, doing, e))
+        elif isinstance(e, exceptions.Timeout):
+            self.log.warning("%sFailed to %s: Server did not respond within "
+                             "%s seconds" % (prefix, do, self.timeout))
+        elif isinstance(e, exceptions.TooManyRedirects):
+            self.log.warning("%sFailed to %s: Too many redirects" %
+                             (prefix, do))
+        elif isinstance(e, _ResponseTooLarge):
+            self.log.warning("%sFailed to %s: %s" % (prefix, do, e))
+        else:
+            self.log.error("%sUnexpected error while %s, retrying at next "
+                           "interval: %s" % (prefix, doing, e))
+        return False
+
+    def _parse_ext_ip(self, text, family=None):
+        """Extract external IP from IP service response body.
+
+        Returns IP as _IP. Returns False if the IP is invalid, not of IP
+        version ``family`` or rejected by the ``reject`` policy.
+
+        """
+        ip = _parse_ip(text.strip(), _FAMILIES[family].versions)
+        if not ip:
+            self.log.warning("External IP discovery returned invalid IP")
             return False
-        except exceptions.TooManyRedirects:
-            self.log.warning("Failed to fetch external IP: "
-                             "Too many redirects")
+        rejected = self.policy and self.policy.rejects(ip)
+        if rejected:
+            self.log.warning("External IP discovery returned %s, which is "
+                             "rejected as %s" % (ip, rejected))
             return False
-        except Exception as e:
-            self.log.error("Unexpected error while fetching external IP "
-                           ", retrying at next interval: %s" % e)
+        return ip
+
+    def _parse_record(self, text, host):
+        """Extract recorded IPs from TwoDNS response body.
+
+        Returns dict mapping tracked address families to IPs as _IP, or
+        None if there is no record for the family yet.
+        Returns False if the body is no record or an IP is invalid.
+
+        """
+        record = {}
+        try:
+            fields = loads(text)
+            for family in self.families:
+                ip = fields.get(_FAMILIES[family].field)
+                if ip is not None:
+                    ip = _parse_ip(ip, _FAMILIES[family].versions)
+                    if not ip:
+                        self.log.warning("%s: TwoDNS returned invalid IP" %
+                                         host.name)
+                        return False
+                record[family] = ip
+        except (ValueError, AttributeError, TypeError):
+            # E.g. the login page of a captive portal
+            self.log.warning("%s: TwoDNS returned invalid record" %
+                             host.name)
             return False
+        return record
+
+    def _get_ext_ips(self):
+        """Get external IP of every tracked address family.
+
+        Families are discovered concurrently.
+        Returns dict mapping families to IPs as _IP, False for families
+        whose discovery failed.
+
+        """
+        cached = self._cached_ext_ips()
+        if cached:
+            return cached
+        if len(self.families) == 1:
+            ips = {self.families[0]: self._get_ext_ip(self.families[0])}
         else:
-            ip = ip_request.text.rstrip()
-            if not self._validate_ip(ip):
-                self.log.warning("External IP discovery returned invalid IP")
-            else:
-                return ip
+            futures = [(family, self._pool().submit(self._get_ext_ip, family))
+                       for family in self.families]
+            ips = dict((family, future.result())
+                       for family, future in futures)
+        return self._cache_ext_ips(ips)
 
-    def _get_rec_ip(self):
-        """Get IP stored by TwoDNS.
+    def _cached_ext_ips(self):
+        """Return IPs discovered less than ``cache_ttl`` seconds ago.
 
-        Returns IP as string. Returns False on failure.
+        Falls back to IPs in the shared cache that are younger than
+        ``shared_cache_ttl``, unless ``check-now`` asked to skip it once.
+        IPs pushed by the supervisor of worker processes are used as they
+        are.
 
         """
-        self.log.debug("Fetching TwoDNS IP...")
+        if self.pushed_ips:
+            return self.pushed_ips
+        if self.ext_cache and monotonic() - self.ext_cache[0] < self.cache_ttl:
+            return self.ext_cache[1]
+        if self.skip_shared:
+            self.skip_shared = False
+            return None
+        if self.shared:
+            return self._shared_ext_ips()
+        return None
+
+    def _shared_ext_ips(self):
+        """Return IPs of all families from the shared cache, or None."""
         try:
-            with Session() as s:
-                s.max_redirects = self.redirects
-                rec_request = s.get(
-                    self.url, auth=self.ident, verify=True,
-                    timeout=self.timeout)
-            rec_request.raise_for_status()
-        except (exceptions.ConnectionError, exceptions.HTTPError) as e:
-            self.log.warning("Error while fetching IP from TwoDNS: %s" % e)
+            shared = self.shared.load(self.families)
+        except (IOError, OSError) as e:
+            self.log.warning("Error while reading shared cache: %s" % e)
+            return None
+        if not shared:
+            return None
+        ips = {}
+        for family, text in shared.items():
+            ip = _parse_ip(text, _FAMILIES[family].versions)
+            if not ip or (self.policy and self.policy.rejects(ip)):
+                return None
+            ips[family] = ip
+        self.log.debug("Using external IP from shared cache.")
+        return ips
+
+    def _cache_ext_ips(self, ips):
+        """Remember ``ips`` if all families were discovered.
+
+        They are also published to the shared cache.
+        Returns ``ips``.
+
+        """
+        if not all(ips.values()):
+            return ips
+        if self.cache_ttl:
+            self.ext_cache = (monotonic(), ips)
+        if self.shared:
+            try:
+                self.shared.publish(ips)
+            except (IOError, OSError) as e:
+                self.log.warning("Error while writing shared cache: %s" % e)
+        return ips
+
+    def _get_ext_ip(self, family=None):
+        """Get external IP of IP version ``family``.
+
+        Returns external IP as _IP.
+        Returns False on failure.
+
+        """
+        return self._local_ip(family) or self._poll_ext_ip(family)
+
+    def _local_ip(self, family=None):
+        """Get external IP of IP version ``family`` from monitored interface.
+
+        Returns IP as _IP. Returns False if there is no monitored interface
+        or it has no global address passing the ``reject`` policy.
+
+        """
+        if not self.monitor:
+            return False
+        try:
+            addresses = [ip for ip in (
+                _parse_ip(a, _FAMILIES[family].versions)
+                for a in self.monitor.addresses())
+                if ip and not (self.policy and self.policy.rejects(ip))]
+        except (OSError, socket_error) as e:
+            self.log.warning("Error while reading addresses of %s: %s" %
+                             (self.interface, e))
+            return False
+        if not addresses:
+            self.log.debug("%s has no global address, falling back to IP "
+                           "services" % self.interface)
             return False
-        except exceptions.Timeout:
-            self.log.warning("Failed to fetch TwoDNS IP: Server did not "
-                             "respond within %s seconds" % self.timeout)
+        return addresses[0]
+
+    def wait(self, timeout):
+        """Wait up to ``timeout`` seconds for the external IP to change.
+
+        Makes all hosts due if the address of the monitored interface
+        changed. Returns early on commands of the control socket.
+
+        """
+        if self.monitor:
+            if self.monitor.wait(timeout, self.wakeup):
+                self._address_changed()
+        elif self.wakeup:
+            select([self.wakeup], [], [], timeout)
+        else:
+            sleep(timeout)
+        if self.wakeup:
+            self.wakeup.clear()
+
+    def _address_changed(self):
+        """Make all hosts due after the monitored address changed."""
+        self.log.info("Address of %s changed." % self.interface)
+        self.ext_cache = None
+        for host in self.hosts:
+            host.next_check = 0
+
+    def _poll_ext_ip(self, family=None):
+        """Get external IP of IP version ``family`` from IP services.
+
+        Returns external IP as _IP.
+        Returns False on failure.
+
+        """
+        if self.gen.mode == 'race':
+            return self._race_ext_ip(family)
+        url = self._get_service_url(family)
+        if url is None:
+            self.log.warning("Failed to fetch external IP: All IP services "
+                             "are unavailable")
             return False
-        except exceptions.TooManyRedirects:
-            self.log.warning("Failed to fetch TwoDNS IP: Too many redirects")
+        return self._fetch_ext_ip(url, family)
+
+    def _race_urls(self, family=None):
+        """Get services for the next race, skipping open breakers."""
+        urls = []
+        for url in self.gen.take(len(self.gen.services)):
+            if (len(urls) < self.race_width and
+                    self._breaker(_endpoint(url, family)).allow()):
+                urls.append(url)
+        if not urls:
+            self.log.warning("Failed to fetch external IP: All IP services "
+                             "are unavailable")
+        return urls
+
+    def _race_ext_ip(self, family=None):
+        """Get external IP from the first of several services to answer.
+
+        Requests are started ``hedge_delay`` seconds apart, or right away if
+        the previous one failed. Gives up after ``timeout`` seconds; requests
+        still running then are abandoned.
+
+        Returns external IP as _IP.
+        Returns False on failure.
+
+        """
+        from concurrent.futures import FIRST_COMPLETED, wait
+        urls = self._race_urls(family)
+        deadline = monotonic() + self.timeout
+        pending = set()
+        try:
+            while urls or pending:
+                if urls:
+                    pending.add(self._pool().submit(self._fetch_ext_ip,
+                                                    urls.pop(0), family))
+                timeout = deadline - monotonic()
+                if urls:
+                    timeout = min(timeout, self.hedge_delay)
+                done, pending = wait(pending, max(0, timeout),
+                                     FIRST_COMPLETED)
+                for future in done:
+                    if future.result():
+                        return future.result()
+                if not done and not urls:
+                    self.log.warning("Failed to fetch external IP: No "
+                                     "service responded within %s seconds"
+                                     % self.timeout)
+                    return False
             return False
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _fetch_ext_ip(self, url, family=None):
+        """Get external IP from ``url`` over IP version ``family``.
+
+        Returns external IP as _IP.
+        Returns False on failure.
+
+        """
+        from twod._transport import deadline
+        self.log.debug("Fetching external IP from %s..." %
+                       _endpoint(url, family))
+        start = monotonic()
+        try:
+            # Bounds the whole exchange, a service trickling its headers
+            # or body cannot hold it up
+            with deadline(start + self.timeout):
+                ip_request = self._get_session(family).get(
+                    url, verify=True, timeout=self.timeout, stream=True)
+                try:
+                    ip_request.raise_for_status()
+                    text = self._read_ip_body(ip_request)
+                finally:
+                    ip_request.close()
         except Exception as e:
-            self.log.error("Unexpected error while fetching TwoDNS IP, "
-                           "retrying at next interval: %s" % e)
+            self._record(url, start, False, 'ip_service', family)
+            return self._request_failed(e, 'ext')
+        ip = self._parse_ext_ip(text, family)
+        self._record(url, start, bool(ip), 'ip_service', family)
+        return ip
+
+    def _read_ip_body(self, response):
+        """Read body of streamed IP service ``response`` as text.
+
+        Reads at most ``_MAX_IP_BODY`` bytes, so a misbehaving service cannot
+        flood twod. Raises _ResponseTooLarge.
+
+        """
+        body = b''
+        for chunk in response.iter_content(_MAX_IP_BODY + 1):
+            body += chunk
+            if len(body) > _MAX_IP_BODY:
+                raise _ResponseTooLarge("Response larger than %d bytes" %
+                                        _MAX_IP_BODY)
+        return body.decode('utf-8', 'replace')
+
+    def _get_rec_ip(self, host=None):
+        """Get IP stored by TwoDNS for the first tracked address family.
+
+        Defaults to the first configured host.
+        Returns IP as _IP. Returns False on failure.
+
+        """
+        record = self._get_record(host)
+        return record and record[self.families[0]]
+
+    def _get_record(self, host=None):
+        """Get IPs stored by TwoDNS.
+
+        Defaults to the first configured host.
+        Returns dict mapping tracked address families to IPs.
+        Returns False on failure.
+
+        """
+        host = host or self.hosts[0]
+        if self._blocked(host.url) or not self._throttle(host):
             return False
-        else:
-            rec_json = loads(rec_request.text)
-            ip = rec_json['ip_address']
-            if not self._validate_ip(ip):
-                self.log.warning("TwoDNS returned invalid IP")
-            else:
-                return ip
+        self.log.debug("Fetching TwoDNS IP of %s..." % host.name)
+        start = monotonic()
+        try:
+            rec_request = self._get_session().get(
+                host.url, auth=host.ident, headers=self._validators(host),
+                verify=True, timeout=self.timeout)
+            rec_request.raise_for_status()
+        except Exception as e:
+            self._record(host.url, start, False, 'twodns_get')
+            return self._request_failed(e, 'rec', host)
+        record = self._read_record(rec_request, host)
+        self._record(host.url, start, record is not False, 'twodns_get')
+        return record
 
-    def _check_ip(self):
-        """Check if external IP matches recorded IP.
+    def _validators(self, host):
+        """Headers making a record request conditional.
 
-        Returns external IP as string if IPs differ. Returns False if the IPs
+        Only sent while the recorded IPs of ``host`` are known, since a
+        ``304 Not Modified`` answer carries no record.
+
+        """
+        headers = {}
+        if not all(getattr(host, _FAMILIES[family].rec)
+                   for family in self.families):
+            return headers
+        if host.etag:
+            headers['If-None-Match'] = host.etag
+        if host.last_modified:
+            headers['If-Modified-Since'] = host.last_modified
+        return headers
+
+    def _read_record(self, response, host):
+        """Extract recorded IPs from TwoDNS response.
+
+        Keeps the validators of the response for the next request. A ``304
+        Not Modified`` answer returns the known record without parsing.
+
+        """
+        if response.status_code == 304:
+            self.log.debug("%s: Record not modified." % host.name)
+            return dict((family, getattr(host, _FAMILIES[family].rec))
+                        for family in self.families)
+        host.etag = response.headers.get('ETag')
+        host.last_modified = response.headers.get('Last-Modified')
+        return self._parse_record(response.text, host)
+
+    def _check_ip(self, host=None, ext_ip=None, family=None):
+        """Check if external IP matches recorded IP of IP version ``family``.
+
+        Defaults to the first configured host. The external IP is fetched
+        unless passed in as ``ext_ip``.
+
+        Returns external IP as _IP if IPs differ. Returns False if the IPs
         match or an error occured.
 
         """
-        self.log.debug("Checking if recorded IP matches current IP...")
-        ext_ip = self._get_ext_ip()
+        host = host or self.hosts[0]
+        fields = _FAMILIES[family]
+        self.log.debug("Checking if recorded IP of %s matches current IP..." %
+                       host.name)
+        if ext_ip is None:
+            ext_ip = self._get_ext_ip(family)
         # something went wrong while fetching external IP but it's possible to
         # continue
         if not ext_ip:
             return False
+        if ext_ip != getattr(host, fields.ext):
+            setattr(host, fields.ext, ext_ip)
+            self.dirty = True
 
-        rec_ip = self.rec_ip
+        rec_ip = getattr(host, fields.rec)
         if ext_ip == rec_ip:
             self.log.debug("IP has not changed.")
             return False
         else:
             return ext_ip
 
-    def _update_ip(self, new_ip):
-        """Update IP stored at TwoDNS."""
-        self.log.debug("Updating recorded IP...")
-        payload = {"ip_address": new_ip}
+    def _changes(self, host, ext_ips):
+        """Compare discovered IPs of all tracked families with ``host``.
+
+        Returns dict mapping families whose IP changed to the new IP.
+
+        """
+        changes = {}
+        for family, ext_ip in ext_ips.items():
+            changed_ip = self._check_ip(host, ext_ip, family)
+            if changed_ip:
+                changes[family] = changed_ip
+        if not changes:
+            host.stale_since = None
+        elif host.stale_since is None:
+            host.stale_since = time()
+        return changes
+
+    def _update_ip(self, new_ip, host=None):
+        """Update IP stored at TwoDNS.
+
+        Defaults to the first configured host. ``new_ip`` is the new IP of
+        the first tracked address family or a dict mapping families to new
+        IPs; only those families are sent.
+        Returns True on success. Returns False on failure.
+
+        """
+        host = host or self.hosts[0]
+        if self._blocked(host.url) or not self._throttle(host):
+            return False
+        self.log.debug("Updating recorded IP of %s..." % host.name)
+        self._journal(host, new_ip)
+        start = monotonic()
         try:
-            with Session() as s:
-                s.max_redirects = self.redirects
-                rq = s.put(
-                    self.url, auth=self.ident, data=dumps(payload),
-                    verify=True, timeout=self.timeout)
+            rq = self._get_session().put(
+                host.url, auth=host.ident, data=self._update_payload(new_ip),
+                verify=True, timeout=self.timeout)
             rq.raise_for_status()
-        except (exceptions.ConnectionError, exceptions.HTTPError) as e:
-            self.log.warning("Error while updating IP: %s" % e)
-        except exceptions.Timeout:
-            self.log.warning("Failed to update IP: Server did not respond "
-                             "within %s seconds" % self.timeout)
-        except exceptions.TooManyRedirects:
-            self.log.warning("Failed to update IP: Too many redirects")
         except Exception as e:
-            self.log.error("Unexpected error while updating TwoDNS IP, "
-                           "retrying at next interval: %s" % e)
-        else:
-            self.log.info("IP changed to %s." % new_ip)
-            self.rec_ip = new_ip
+            self._record(host.url, start, False, 'twodns_put')
+            return self._request_failed(e, 'update', host)
+        self._record(host.url, start, True, 'twodns_put')
+        return self._updated(new_ip, host)
+
+    def _as_record(self, new_ip):
+        """Map bare IP to the first tracked address family."""
+        if isinstance(new_ip, dict):
+            return new_ip
+        return {self.families[0]: new_ip}
+
+    def _update_fields(self, new_ip):
+        """TwoDNS fields of update request."""
+        return dict((_FAMILIES[family].field, str(ip)) for family, ip
+                    in self._as_record(new_ip).items())
+
+    def _update_payload(self, new_ip):
+        """Body of update request."""
+        return dumps(self._update_fields(new_ip))
+
+    def _updated(self, new_ip, host):
+        """Record successful update. Always returns True."""
+        record = self._as_record(new_ip)
+        for ip in record.values():
+            self.log.info("%s: IP changed to %s." % (host.name, ip))
+        self.metrics.updated(host.name)
+        # Validators of the old record no longer match
+        host.etag = host.last_modified = None
+        host.stale_since = None
+        self._journal(host)
+        self._recorded(host, record)
+        return True
+
+    def _due_hosts(self, now):
+        """Hosts due for a check; schedules their next check.
+
+        Regular checks stay ``interval`` apart however long checks take;
+        early checks, like retries, leave them alone. Hosts whose records
+        have been outdated the longest come first, so they get the first
+        turn when updates are rate limited.
+
+        """
+        self._run_commands()
+        due = []
+        missed = 0
+        for host in self.wheel.pop(now):
+            if host.deadline is None:
+                host.deadline = now
+            if host.deadline > now:
+                host.next_check = self._splayed(host)
+                due.append(host)
+                continue
+            periods = int((now - host.deadline) // host.interval)
+            host.deadline += (periods + 1) * host.interval
+            if not periods:
+                host.next_check = self._splayed(host)
+                due.append(host)
+                continue
+            # A whole interval passed without a check
+            missed += 1
+            if self.catch_up == 'skip':
+                host.next_check = self._splayed(host)
+            elif self.splay:
+                # Spread the catch-up checks of all hosts
+                host.next_check = now + uniform(
+                    0, min(self.splay, host.interval))
+            else:
+                host.next_check = self._splayed(host)
+                due.append(host)
+        if missed:
+            self.log.info("%s missed checks of %d hosts." % (
+                'Skipping' if self.catch_up == 'skip' else 'Catching up on',
+                missed))
+        due.sort(key=_staleness)
+        return due
+
+    def _splayed(self, host):
+        """Time of the regular check of ``host``, delayed up to ``splay``."""
+        if not self.splay:
+            return host.deadline
+        return host.deadline + uniform(0, min(self.splay, host.interval))
+
+    def _checked(self, host, ok, now):
+        """Reschedule host after a check.
+
+        Failed checks are retried with exponential backoff, but never later
+        than the regular interval.
+
+        """
+        host.checks += 1
+        if ok:
+            host.retries = 0
+            self.metrics.checked()
+            return
+        # Not before the rate limits allow another request
+        delay = max(_backoff(host.retries, self.backoff, host.interval),
+                    self.limiter.delay(host.limits))
+        host.next_check = min(host.next_check, now + delay)
+        host.retries += 1
+        self.log.info("%s: Retrying in %d seconds." % (host.name, delay))
+
+    def tick(self):
+        """Check all hosts that are due and update changed records.
+
+        External IP discovery happens once and is shared by all due hosts.
+        Only families whose IP changed are updated.
+
+        """
+        now = _clock()
+        due = self._due_hosts(now)
+        if not due:
+            return
+        ext_ips = self._get_ext_ips()
+        self._run_all(lambda host: self._check_host(host, ext_ips, now), due,
+                      lambda host: self._checked(host, False, now))
+        self._save_state()
+
+    def _check_host(self, host, ext_ips, now):
+        """Check ``host`` against ``ext_ips`` and update changed records.
+
+        Stops between requests once cancelled.
+
+        """
+        from twod._executor import _Cancelled
+        ok = False
+        try:
+            if self._refresh_due(host, now):
+                self._verify(host)
+                self._check_cancelled()
+            ok = all(ext_ips.values())
+            changes = self._changes(host, ext_ips)
+            if changes:
+                ok = self._update_ip(changes, host) and ok
+        except _Cancelled as e:
+            self.log.warning("%s: Check cancelled: %s" % (host.name, e))
+            ok = False
+        self._checked(host, ok, now)
+
+    def next_delay(self):
+        """Seconds until the next host is due."""
+        return max(0, self.wheel.next_deadline() - _clock())
+
+    def next_sleep(self):
+        """Seconds to sleep until the next tick.
+
+        Sleeps do not count time spent suspended, so they are cut short to
+        notice checks missed meanwhile.
+
+        """
+        return min(self.next_delay(), _MAX_SLEEP)
+
+    def control(self, command, args):
+        """Reply to ``command`` received on the control socket.
+
+        ``status`` returns the state of all hosts. ``check-now`` and
+        ``refresh-record`` make the hosts named in ``args``, or all hosts,
+        due right away; ``refresh-record`` also reads their records again.
+        Runs in the thread of the control socket.
+
+        """
+        if command == 'status':
+            return self._status()
+        if command not in _COMMANDS:
+            raise ValueError("Unknown command: '%s'" % command)
+        hosts = self.hosts
+        if args:
+            by_name = dict((host.name, host) for host in self.hosts)
+            for name in args:
+                if name not in by_name:
+                    raise ValueError("Unknown host: '%s'" % name)
+            hosts = [by_name[name] for name in args]
+        with self.commands_lock:
+            self.commands.append((command, hosts))
+        self.wakeup.set()
+        return {'scheduled': [host.name for host in hosts]}
+
+    def _run_commands(self):
+        """Make hosts of commands received since the last tick due."""
+        with self.commands_lock:
+            commands, self.commands = self.commands, []
+        for command, hosts in commands:
+            self.log.info("Control: %s for %d hosts." % (command, len(hosts)))
+            if command == 'check-now':
+                # Discover the external IP again, our own discoveries are
+                # in the shared cache too
+                self.ext_cache = None
+                self.skip_shared = True
+            for host in hosts:
+                host.next_check = 0
+                if command == 'refresh-record':
+                    host.verify = True
+
+    def _status(self):
+        """State and timings of all hosts for the control socket."""
+        now = _clock()
+        entries = self._state_entries()
+        for host in self.hosts:
+            entries[host.name].update({
+                'next_check': max(0, host.next_check - now),
+                'retries': host.retries,
+                'checks': host.checks,
+                'stale_since': host.stale_since,
+                'verify': host.verify,
+            })
+        return {
+            'hosts': entries,
+            'next_check': self.next_delay() if self.hosts else None,
+            'last_success': self.metrics.last_success,
+            'last_tick': self.metrics.last_tick,
+            'services': self.gen.stats(),
+        }
+
+
+def _setup_logging(level='WARNING'):
+    """Setup logging. Returns the logger of twod."""
+    import logging.config
+    logging.config.dictConfig({
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'daemon': {
+                'format': '%(asctime)s %(module)s[%(process)d]: '
+                          '%(message)s'
+            },
+        },
+        'handlers': {
+            'syslog': {
+                'formatter': 'daemon',
+                'class': 'logging.handlers.SysLogHandler',
+                'address': '/dev/log',
+                'level': 'DEBUG',
+            },
+            'stderr': {
+                'formatter': 'daemon',
+                'class': 'logging.StreamHandler',
+                'stream': 'ext://sys.stderr',
+                'level': 'DEBUG',
+            },
+        },
+        'loggers': {
+            'twod': {
+                'handlers': ['syslog', 'stderr'],
+                'level': level,
+                'propagate': True
+            }
+        }
+    })
+    return logging.getLogger('twod')
 
 
 class Twod(object):
@@ -249,44 +1587,54 @@ class Twod(object):
         return url
 
     def _is_mode(self, mode):
-        if mode not in ('random', 'round_robin'):
+        if mode not in ('random', 'round_robin', 'race', 'adaptive',
+                        'netlink'):
             raise ValueError("Invalid mode: '%s'" % mode)
         return mode
 
+    def _is_interface(self, interface):
+        if not hasattr(socket, 'AF_NETLINK'):
+            raise ValueError("Mode 'netlink' is only supported on Linux")
+        try:
+            socket.if_nametoindex(interface)
+        except (OSError, socket_error):
+            raise ValueError("Invalid interface: '%s'" % interface)
+        return interface
+
+    def _is_address(self, address):
+        """Parse ``host:port`` listen address."""
+        host, _, port = address.rpartition(':')
+        if not host or not port.isdigit() or int(port) > 65535:
+            raise ValueError("Invalid listen address: '%s'" % address)
+        return (host.strip('[]'), int(port))
+
+    def _is_families(self, families):
+        """Parse IP versions to track, ``any`` or some of ``4`` and ``6``."""
+        if families.strip() == 'any':
+            return (None,)
+        versions = families.split()
+        if not versions or not set(versions) <= set(['4', '6']):
+            raise ValueError("Invalid families: '%s'" % families)
+        return tuple(sorted(set(int(v) for v in versions)))
+
+    def _is_engine(self, engine):
+        if engine not in _ENGINES:
+            raise ValueError("Invalid engine: '%s'" % engine)
+        return engine
+
+    def _is_interval(self, interval):
+        if interval <= 0:
+            raise ValueError("Invalid interval: '%s'" % interval)
+        return interval
+
+    def _is_catch_up(self, catch_up):
+        if catch_up not in _CATCH_UP:
+            raise ValueError("Invalid catch_up: '%s'" % catch_up)
+        return catch_up
+
     def _setup_logger(self, level='WARNING'):
         """Setup logging."""
-        logging.config.dictConfig({
-            'version': 1,
-            'disable_existing_loggers': False,
-            'formatters': {
-                'daemon': {
-                    'format': '%(asctime)s %(module)s[%(process)d]: '
-                              '%(message)s'
-                },
-            },
-            'handlers': {
-                'syslog': {
-                    'formatter': 'daemon',
-                    'class': 'logging.handlers.SysLogHandler',
-                    'address': '/dev/log',
-                    'level': 'DEBUG',
-                },
-                'stderr': {
-                    'formatter': 'daemon',
-                    'class': 'logging.StreamHandler',
-                    'stream': 'ext://sys.stderr',
-                    'level': 'DEBUG',
-                },
-            },
-            'loggers': {
-                'twod': {
-                    'handlers': ['syslog', 'stderr'],
-                    'level': level,
-                    'propagate': True
-                }
-            }
-        })
-        self.log = logging.getLogger('twod')
+        self.log = _setup_logging(level)
 
     def _read_config(self, config_path):
         """Read config.
@@ -297,13 +1645,43 @@ class Twod(object):
         self.log.debug("Reading config...")
         conf = {}
         defaults = {
-            'interval': '3600',
-            'timeout': '16',
-            'redirects': '2',
+            'interval': 3600.0,
+            'timeout': 16.0,
+            'redirects': 2,
+            'pool_size': 2,
+            'keepalive': 120.0,
+            'engine': 'sync',
+            'workers': 1,
+            'threads': 8,
+            'splay': 0.0,
+            'catch_up': 'now',
             'ip_mode': 'random',
+            'families': 'any',
+            'race_width': 2,
+            'hedge_delay': 1.0,
+            'explore': 0.1,
+            'reject': '',
+            'shared_cache': None,
+            'shared_cache_ttl': 60.0,
+            'control_socket': None,
+            'state_file': '',
+            'state_ttl': 3600.0,
+            'refresh_every': 0,
+            'refresh_interval': 0.0,
+            'inventory': '',
+            'failure_threshold': 3,
+            'backoff': 30.0,
+            'max_backoff': 1800.0,
+            'dns_ttl': 300.0,
+            'dns_negative_ttl': 30.0,
+            'dns_stale_ttl': 3600.0,
+            'origin_rate': 0.0,
+            'origin_burst': 10,
+            'account_rate': 0.0,
+            'account_burst': 10,
             'loglevel': 'WARNING',
         }
-        config = SafeConfigParser(defaults=defaults)
+        config = SafeConfigParser()
         try:
             # Check if config is even readable
             f = open(path.expanduser(config_path), 'r')
@@ -312,30 +1690,297 @@ class Twod(object):
             config.readfp(f)
             f.close()
 
-            conf['user'] = config.get('general', 'user')
-            conf['token'] = config.get('general', 'token')
-            conf['url'] = self._is_url(config.get('general', 'host_url'))
-            conf['interval'] = config.getfloat('general', 'interval')
-            conf['timeout'] = config.getfloat('general', 'timeout')
-            conf['redirects'] = config.getint('general', 'redirects')
-            conf['ip_mode'] = self._is_mode(config.get('ip_service', 'mode'))
+            conf['interval'] = self._is_interval(config.getfloat(
+                'general', 'interval', fallback=defaults['interval']))
+            conf['splay'] = config.getfloat(
+                'general', 'splay', fallback=defaults['splay'])
+            if conf['splay'] < 0:
+                raise ValueError("Invalid splay: '%s'" % conf['splay'])
+            conf['catch_up'] = self._is_catch_up(config.get(
+                'general', 'catch_up', fallback=defaults['catch_up']))
+            conf['timeout'] = config.getfloat(
+                'general', 'timeout', fallback=defaults['timeout'])
+            conf['redirects'] = config.getint(
+                'general', 'redirects', fallback=defaults['redirects'])
+            conf['pool_size'] = config.getint(
+                'general', 'pool_size', fallback=defaults['pool_size'])
+            if conf['pool_size'] < 1:
+                raise ValueError("Invalid pool_size: '%s'" %
+                                 conf['pool_size'])
+            conf['keepalive'] = config.getfloat(
+                'general', 'keepalive', fallback=defaults['keepalive'])
+            conf['threads'] = config.getint(
+                'general', 'threads', fallback=defaults['threads'])
+            if conf['threads'] < 1:
+                raise ValueError("Invalid threads: '%s'" % conf['threads'])
+            conf['failure_threshold'] = config.getint(
+                'general', 'failure_threshold',
+                fallback=defaults['failure_threshold'])
+            if conf['failure_threshold'] < 1:
+                raise ValueError("Invalid failure_threshold: '%s'" %
+                                 conf['failure_threshold'])
+            conf['backoff'] = config.getfloat(
+                'general', 'backoff', fallback=defaults['backoff'])
+            conf['max_backoff'] = config.getfloat(
+                'general', 'max_backoff', fallback=defaults['max_backoff'])
+            for ttl in ('dns_ttl', 'dns_negative_ttl', 'dns_stale_ttl'):
+                conf[ttl] = config.getfloat('general', ttl,
+                                            fallback=defaults[ttl])
+                if conf[ttl] < 0:
+                    raise ValueError("Invalid %s: '%s'" % (ttl, conf[ttl]))
+            for limit in ('origin', 'account'):
+                rate = config.getfloat('general', '%s_rate' % limit,
+                                       fallback=defaults['%s_rate' % limit])
+                if rate < 0:
+                    raise ValueError("Invalid %s_rate: '%s'" % (limit, rate))
+                burst = config.getint('general', '%s_burst' % limit,
+                                      fallback=defaults['%s_burst' % limit])
+                if burst < 1:
+                    raise ValueError("Invalid %s_burst: '%s'" % (limit, burst))
+                conf['%s_rate' % limit] = rate
+                conf['%s_burst' % limit] = burst
+            conf['state_file'] = config.get(
+                'general', 'state_file', fallback=defaults['state_file'])
+            conf['state_ttl'] = config.getfloat(
+                'general', 'state_ttl', fallback=defaults['state_ttl'])
+            conf['refresh_every'] = config.getint(
+                'general', 'refresh_every', fallback=defaults['refresh_every'])
+            conf['refresh_interval'] = config.getfloat(
+                'general', 'refresh_interval',
+                fallback=defaults['refresh_interval'])
+            conf['engine'] = self._is_engine(config.get(
+                'general', 'engine', fallback=defaults['engine']))
+            conf['inventory'] = self._read_inventory(config.get(
+                'general', 'inventory', fallback=defaults['inventory']),
+                config, conf)
+            conf['hosts'] = self._read_hosts(config, conf)
+            # State, journal and control socket know hosts by name
+            names = set()
+            for host in chain(conf['hosts'], conf['inventory'] or ()):
+                if host['name'] in names:
+                    raise ValueError("Duplicate host: '%s'" % host['name'])
+                names.add(host['name'])
+            if not names:
+                raise ValueError("No hosts configured")
+            conf['spread'] = config.getboolean(
+                'general', 'spread', fallback=bool(conf['inventory']))
+            conf['workers'] = config.getint(
+                'general', 'workers', fallback=defaults['workers'])
+            if conf['workers'] < 1:
+                raise ValueError("Invalid workers: '%s'" % conf['workers'])
+            conf['control_socket'] = config.get(
+                'general', 'control_socket',
+                fallback=defaults['control_socket'])
+            conf['ip_mode'] = self._is_mode(config.get(
+                'ip_service', 'mode', fallback=defaults['ip_mode']))
             conf['ip_url'] = self._is_url(config.get('ip_service', 'ip_urls'))
+            conf['families'] = self._is_families(config.get(
+                'ip_service', 'families', fallback=defaults['families']))
+            if conf['ip_mode'] == 'netlink':
+                conf['interface'] = self._is_interface(
+                    config.get('ip_service', 'interface'))
+            conf['race_width'] = config.getint(
+                'ip_service', 'race_width', fallback=defaults['race_width'])
+            if conf['race_width'] < 1:
+                raise ValueError("Invalid race_width: '%s'" %
+                                 conf['race_width'])
+            conf['hedge_delay'] = config.getfloat(
+                'ip_service', 'hedge_delay', fallback=defaults['hedge_delay'])
+            conf['explore'] = config.getfloat(
+                'ip_service', 'explore', fallback=defaults['explore'])
+            if not 0 <= conf['explore'] <= 1:
+                raise ValueError("Invalid explore: '%s'" % conf['explore'])
+            # Spread checks would otherwise each ask the IP service again
+            conf['cache_ttl'] = config.getfloat(
+                'ip_service', 'cache_ttl',
+                fallback=60.0 if conf['spread'] else 0.0)
+            conf['reject'] = _is_policy(config.get(
+                'ip_service', 'reject', fallback=defaults['reject']))
+            conf['shared_cache'] = config.get(
+                'ip_service', 'shared_cache',
+                fallback=defaults['shared_cache'])
+            conf['shared_cache_ttl'] = config.getfloat(
+                'ip_service', 'shared_cache_ttl',
+                fallback=defaults['shared_cache_ttl'])
+            if conf['shared_cache_ttl'] < 0:
+                raise ValueError("Invalid shared_cache_ttl: '%s'" %
+                                 conf['shared_cache_ttl'])
+            conf['metrics_listen'] = config.get('metrics', 'listen',
+                                                fallback=None)
+            if conf['metrics_listen']:
+                conf['metrics_listen'] = self._is_address(
+                    conf['metrics_listen'])
             conf['loglevel'] = config.get('logging', 'level',
-                                          fallback='WARNING')
+                                          fallback=defaults['loglevel'])
         except (MissingSectionHeaderError, NoSectionError, NoOptionError,
                 ValueError, IOError) as e:
             self.log.critical("Configuration error: %s" % e)
             exit(1)
         return conf
 
+    def _read_hosts(self, config, conf):
+        """Read host definitions.
+
+        The host in the ``general`` section is named after its URL. Each
+        ``host:NAME`` section adds another host; ``user``, ``token`` and
+        ``interval`` default to the values of the ``general`` section.
+
+        """
+        hosts = []
+        sections = [s for s in config.sections() if s.startswith('host:')]
+        if (config.has_option('general', 'host_url') or
+                not (sections or conf['inventory'])):
+            url = self._is_url(config.get('general', 'host_url'))
+            hosts.append({
+                'name': url.rstrip('/').rsplit('/', 1)[-1],
+                'user': config.get('general', 'user'),
+                'token': config.get('general', 'token'),
+                'url': url,
+                'interval': conf['interval'],
+            })
+        for section in sections:
+            hosts.append({
+                'name': section.split(':', 1)[1].strip(),
+                'user': (config.get(section, 'user')
+                         if config.has_option(section, 'user')
+                         else config.get('general', 'user')),
+                'token': (config.get(section, 'token')
+                          if config.has_option(section, 'token')
+                          else config.get('general', 'token')),
+                'url': self._is_url(config.get(section, 'host_url')),
+                'interval': self._is_interval(config.getfloat(
+                    section, 'interval', fallback=conf['interval'])),
+            })
+        return hosts
+
+    def _read_inventory(self, inventory_path, config, conf):
+        """Read inventory file at ``inventory_path``.
+
+        Returns None if there is none. The file is read once to validate it
+        along with the other hosts; hosts are streamed from it again when
+        twod starts.
+
+        """
+        from twod._inventory import _Inventory
+
+        if not inventory_path:
+            return None
+        return _Inventory(path.expanduser(inventory_path), {
+            'user': config.get('general', 'user', fallback=None),
+            'token': config.get('general', 'token', fallback=None),
+            'interval': conf['interval'],
+        }, self._is_url)
+
     def run(self):
         """Main loop."""
+        if self.conf['workers'] > 1:
+            from twod._workers import _Supervisor
+            if self.conf['control_socket']:
+                self.log.warning("The control socket is not available with "
+                                 "worker processes.")
+            return _Supervisor(self.conf, self.conf['workers']).run()
+        if self.conf['engine'] == 'asyncio':
+            return self._run_async()
         data = _Data(self.conf)
-        while(True):
-            changed_ip = data._check_ip()
-            if changed_ip:
-                data._update_ip(changed_ip)
-            sleep(self.interval)
+        self._serve_metrics(data)
+        control = self._serve_control(data)
+        # Wake up early on address changes of the monitored interface and on
+        # commands
+        pause = sleep
+        if self.conf['ip_mode'] == 'netlink' or control:
+            pause = data.wait
+        try:
+            while(True):
+                start = monotonic()
+                data.tick()
+                data.metrics.tick(monotonic() - start)
+                pause(data.next_sleep())
+        finally:
+            if control:
+                control.close()
+            data.close()
+
+    def run_once(self):
+        """Check and update all hosts once.
+
+        Returns exit status: 0 if all records were current, 3 if records were
+        updated and 4 if a check or update failed.
+
+        """
+        self.conf['once'] = True
+        if self.conf['workers'] > 1:
+            from twod._workers import _Supervisor
+            failed, updated = _Supervisor(self.conf,
+                                          self.conf['workers']).once()
+        else:
+            if self.conf['engine'] == 'asyncio':
+                import asyncio
+                from twod._aio import _AsyncData
+                data = _AsyncData(self.conf)
+                asyncio.run(data.once())
+            else:
+                data = _Data(self.conf)
+                try:
+                    data.tick()
+                finally:
+                    data.close()
+            failed = any(host.retries for host in data.hosts)
+            updated = any(data.metrics.updates.values())
+        if failed:
+            return _EXIT_FAILED
+        if updated:
+            return _EXIT_UPDATED
+        return _EXIT_UNCHANGED
+
+    def _serve_metrics(self, data):
+        """Start metrics listener if configured."""
+        if self.conf['metrics_listen']:
+            data.metrics.serve(self.conf['metrics_listen'], data.hosts)
+
+    def _serve_control(self, data):
+        """Start control socket if configured. Returns the server."""
+        if not self.conf['control_socket']:
+            return None
+        from twod._control import _ControlServer
+        try:
+            return _ControlServer(self.conf['control_socket'], data.control)
+        except (IOError, OSError) as e:
+            self.log.critical("Unable to open control socket: %s" % e)
+            exit(1)
+
+    def _run_async(self):
+        """Main loop of the asyncio engine."""
+        import asyncio
+        from twod._aio import _AsyncData
+        data = _AsyncData(self.conf)
+        self._serve_metrics(data)
+        control = self._serve_control(data)
+        try:
+            asyncio.run(data.run())
+        finally:
+            if control:
+                control.close()
+
+
+def _ctl(parser, args):
+    """Send command of ``twod ctl`` to the daemon. Returns exit status."""
+    from twod._control import _request
+    socket_path = args.socket
+    if not socket_path:
+        twod = Twod(args.config) if args.config else Twod()
+        socket_path = twod.conf['control_socket']
+    if not socket_path:
+        parser.error("No control_socket configured")
+    try:
+        reply = _request(socket_path, args.action, args.hosts)
+    except (IOError, OSError, ValueError) as e:
+        print("Unable to reach twod: %s" % e, file=sys.stderr)
+        return 1
+    if 'error' in reply:
+        print(reply['error'], file=sys.stderr)
+        return 1
+    print(dumps(reply, indent=2, sort_keys=True))
+    return 0
 
 
 def main():
@@ -348,15 +1993,50 @@ def main():
     parser.add_argument('-D', '--no-detach', dest='nodetach',
                         action='store_true',
                         help="do not detach from console")
+    parser.add_argument('-e', '--engine', choices=_ENGINES,
+                        help="override engine set in configuration")
+    parser.add_argument('-w', '--workers', metavar='N', type=int,
+                        help="check hosts in N worker processes")
+    parser.add_argument('--once', action='store_true',
+                        help="check all hosts once in the foreground and "
+                        "exit with 0 if unchanged, 3 if updated or 4 on "
+                        "failure")
+    parser.add_argument('-C', '--check-config', dest='check',
+                        action='store_true',
+                        help="check configuration and exit")
     parser.add_argument('-V', '--version', action='version',
                         version='twod ' + __version__)
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    ctl = commands.add_parser('ctl', help="send a command to the running "
+                              "daemon")
+    ctl.add_argument('action', choices=('status',) + _COMMANDS,
+                     help="show state of all hosts, check hosts now or "
+                     "check hosts after reading their records again")
+    ctl.add_argument('hosts', nargs='*', metavar='HOST',
+                     help="hosts to check, all hosts by default")
+    ctl.add_argument('-s', '--socket', metavar='FILE',
+                     help="use control socket FILE instead of the one set "
+                     "in the configuration")
     args = parser.parse_args()
 
     if args.config and not path.isfile(path.expanduser(args.config)):
         parser.error("'%s' is not a file" % args.config)
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers has to be at least 1")
+    if args.command == 'ctl':
+        exit(_ctl(parser, args))
 
     twod = Twod(args.config) if args.config else Twod()
-    if args.nodetach:
+    if args.workers:
+        twod.conf['workers'] = args.workers
+    if args.engine:
+        twod.conf['engine'] = args.engine
+    if args.check:
+        # Invalid configurations already exited
+        print("Configuration OK")
+    elif args.once:
+        exit(twod.run_once())
+    elif args.nodetach:
         twod.run()
     else:
         pidfile = '/var/run/twod.pid'
@@ -369,7 +2049,7 @@ def main():
         if not access(path.dirname(pidfile), W_OK | X_OK):
             twod.log.critical("Unable to write pidfile")
             exit(1)
-        with DaemonContext(pidfile=PIDLockFile(pidfile)):
+        with _lazy('DaemonContext')(pidfile=_lazy('PIDLockFile')(pidfile)):
             twod.run()
 
 